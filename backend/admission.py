@@ -0,0 +1,295 @@
+"""按成本的准入控制和按模型的并发限制
+
+每个预测在训练前按序列长度、模型类型和参数（num_samples、季节周期、协变量等）估计成本，
+单位约为 "ARIMA 在1000个点上训练一次"。执行前需要同时满足：
+- 该模型正在执行的预测数小于模型的并发上限（ADMISSION_MODEL_LIMITS）；
+- 所有正在执行的预测的成本之和加上本次成本不超过全局容量（ADMISSION_CAPACITY），
+  没有其他预测在执行时，超过容量的单个预测也可以执行。
+
+不满足时进入有界队列等待：队列已满时返回429，等待超过 ADMISSION_MAX_WAIT 秒时返回503，
+单次成本超过 ADMISSION_MAX_COST 时直接返回429，均带 Retry-After。
+因全局容量不足而等待的请求优先于之后到达的请求，避免大请求一直被小请求插队。
+队列长度、执行数和等待时间通过 /api/metrics 和 /api/admission 查看。
+
+多worker部署时容量和并发上限对所有worker进程合计生效：执行中的预测登记在 ADMISSION_STATE_DIR
+（默认与 DATA_SNAPSHOT_DIR 相同）下的共享状态文件中，读写时加文件锁；进程退出后遗留的登记按PID清除。
+等待顺序只在同一worker内保证，其他worker的预测结束时不会唤醒本进程，等待中的请求每 ADMISSION_POLL 秒重试一次。
+未配置共享目录（例如直接运行 python app.py 的单进程模式）时只在进程内统计。
+"""
+import os
+import json
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+from metrics import (ADMISSION_QUEUE_DEPTH, ADMISSION_RUNNING, ADMISSION_RUNNING_COST,
+                     ADMISSION_WAIT, ADMISSION_DECISIONS, _pid_alive)
+
+# 全局容量（成本单位），默认每个CPU核2个单位
+ADMISSION_CAPACITY = float(os.getenv('ADMISSION_CAPACITY', 2 * (os.cpu_count() or 1)))
+# 单次预测允许的最大成本
+ADMISSION_MAX_COST = float(os.getenv('ADMISSION_MAX_COST', 500))
+# 每个模型的并发上限，格式为 模型:数量，逗号分隔；未列出的模型使用默认上限
+ADMISSION_MODEL_LIMITS = os.getenv('ADMISSION_MODEL_LIMITS', 'auto_arima:1,prophet:1')
+ADMISSION_DEFAULT_MODEL_LIMIT = int(os.getenv('ADMISSION_DEFAULT_MODEL_LIMIT', 2))
+# 等待队列长度和最长等待时间（秒）
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 16))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 30))
+# 跨进程共享执行状态的目录，以及等待其他worker释放容量时的重试间隔（秒）
+ADMISSION_STATE_DIR = os.getenv('ADMISSION_STATE_DIR', os.getenv('DATA_SNAPSHOT_DIR', ''))
+ADMISSION_POLL = float(os.getenv('ADMISSION_POLL', 0.1))
+
+try:
+    import fcntl
+except ImportError:  # Windows 下不做跨进程统计
+    fcntl = None
+
+# 各模型相对ARIMA的单位成本
+MODEL_COST_WEIGHTS = {
+    'arima': 1.0,
+    'auto_arima': 8.0,
+    'prophet': 4.0,
+    'batch_ets': 0.2
+}
+
+
+class AdmissionRejected(Exception):
+    """预测未被准入，status 为HTTP状态码，retry_after 为建议的重试间隔（秒）"""
+
+    def __init__(self, message, status=429, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _parse_limits(text):
+    limits = {}
+    for item in text.split(','):
+        if ':' in item:
+            model, limit = item.split(':', 1)
+            limits[model.strip()] = int(limit)
+    return limits
+
+
+class SharedSlots:
+    """所有worker进程共享的执行中预测登记，保存在加文件锁的JSON文件中"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'admission.json')
+        self._ids = itertools.count()
+
+    @contextmanager
+    def _locked(self):
+        """持有文件锁期间读取并可修改登记列表，退出时写回"""
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path) as f:
+                        tickets = json.load(f)
+                except (OSError, ValueError):
+                    tickets = []
+                # 清除已退出进程的登记
+                alive = [ticket for ticket in tickets if _pid_alive(ticket['pid'])]
+                state = {'tickets': alive, 'changed': len(alive) != len(tickets)}
+                yield state
+                if state['changed']:
+                    tmp = f'{self.path}.{os.getpid()}.tmp'
+                    with open(tmp, 'w') as f:
+                        json.dump(state['tickets'], f)
+                    os.replace(tmp, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _totals(tickets):
+        running = {}
+        for ticket in tickets:
+            running[ticket['model']] = running.get(ticket['model'], 0) + 1
+        return running, sum(ticket['cost'] for ticket in tickets)
+
+    def try_acquire(self, ticket, allowed):
+        """allowed(全局各模型执行数, 全局执行成本) 为真时登记 ticket 并返回True"""
+        with self._locked() as state:
+            if not allowed(*self._totals(state['tickets'])):
+                return False
+            ticket['id'] = f'{os.getpid()}-{next(self._ids)}'
+            state['tickets'].append({'id': ticket['id'], 'pid': os.getpid(),
+                                     'model': ticket['model'], 'cost': ticket['cost']})
+            state['changed'] = True
+            return True
+
+    def release(self, ticket):
+        with self._locked() as state:
+            state['tickets'] = [item for item in state['tickets'] if item['id'] != ticket['id']]
+            state['changed'] = True
+
+    def totals(self):
+        with self._locked() as state:
+            return self._totals(state['tickets'])
+
+    def reset(self):
+        """清空登记（服务启动时调用）"""
+        with self._locked() as state:
+            state['tickets'] = []
+            state['changed'] = True
+
+
+def estimate_cost(model_type, params, length):
+    """按模型类型、序列长度和参数估计一次训练加预测的成本"""
+    cost = MODEL_COST_WEIGHTS.get(model_type, 1.0) * max(int(length), 1) / 1000
+
+    # 季节项使状态维度随周期增长
+    if model_type == 'arima':
+        seasonal = any(int(params.get(f'seasonal_order_{name}', 0) or 0) > 0 for name in 'PDQ')
+        if seasonal:
+            cost *= 1 + int(params.get('seasonal_periods', 24)) / 12
+    elif model_type == 'auto_arima':
+        cost *= 1 + int(params.get('season_length', 12)) / 12
+    elif model_type == 'batch_ets' and params.get('mode') == 'holt_winters':
+        cost *= 1 + int(params.get('seasonal_periods', 24)) / 100
+
+    # 没有解析区间时按 num_samples 采样
+    cost *= 1 + int(params.get('num_samples', 1) or 1) / 200
+    if bool(params.get('use_covariates', False)):
+        cost *= 1.5
+    return round(cost, 3)
+
+
+class AdmissionController:
+    """全局成本容量、按模型并发上限和有界等待队列"""
+
+    def __init__(self, capacity=ADMISSION_CAPACITY, max_cost=ADMISSION_MAX_COST, model_limits=ADMISSION_MODEL_LIMITS,
+                 default_limit=ADMISSION_DEFAULT_MODEL_LIMIT, queue_size=ADMISSION_QUEUE_SIZE,
+                 max_wait=ADMISSION_MAX_WAIT, state_dir=ADMISSION_STATE_DIR):
+        self.capacity = capacity
+        self.max_cost = max_cost
+        self.model_limits = _parse_limits(model_limits) if isinstance(model_limits, str) else dict(model_limits)
+        self.default_limit = default_limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._condition = threading.Condition()
+        self._running = {}
+        self._running_cost = 0.0
+        # 等待中的请求，按到达顺序
+        self._waiting = []
+        self._recent_waits = []
+        # 跨进程共享的执行登记，未配置时只在进程内统计
+        self._shared = SharedSlots(state_dir) if state_dir and fcntl is not None else None
+
+    def model_limit(self, model_type):
+        return self.model_limits.get(model_type, self.default_limit)
+
+    def _model_free(self, ticket, running):
+        return running.get(ticket['model'], 0) < self.model_limit(ticket['model'])
+
+    def _capacity_free(self, ticket, running, running_cost):
+        return not any(running.values()) or running_cost + ticket['cost'] <= self.capacity
+
+    def _allowed(self, ticket, running, running_cost):
+        """模型并发和全局容量都允许，且之前没有因全局容量不足而等待的请求"""
+        if not (self._model_free(ticket, running) and self._capacity_free(ticket, running, running_cost)):
+            return False
+        for earlier in self._waiting:
+            if earlier is ticket:
+                break
+            if self._model_free(earlier, running) and not self._capacity_free(earlier, running, running_cost):
+                return False
+        return True
+
+    def _can_start(self, ticket):
+        """按所有worker合计（或进程内）的执行数和成本判断，可以执行时完成登记（持有条件锁时调用）"""
+        if self._shared is None:
+            return self._allowed(ticket, self._running, self._running_cost)
+        return self._shared.try_acquire(ticket, lambda running, cost: self._allowed(ticket, running, cost))
+
+    def _retry_after(self):
+        return max(int(self.max_wait // 2), 1)
+
+    def _update_gauges(self, model_type):
+        ADMISSION_RUNNING.set(self._running.get(model_type, 0), model=model_type)
+        ADMISSION_QUEUE_DEPTH.set(sum(1 for ticket in self._waiting if ticket['model'] == model_type),
+                                  model=model_type)
+        ADMISSION_RUNNING_COST.set(self._running_cost)
+
+    @contextmanager
+    def admit(self, model_type, cost):
+        """准入后执行代码块（as 得到本次等待的秒数），未准入时抛出 AdmissionRejected"""
+        if cost > self.max_cost:
+            ADMISSION_DECISIONS.inc(model=model_type, result='rejected_cost')
+            raise AdmissionRejected(
+                f"预测成本过高 ({cost:.1f} > {self.max_cost:.1f})，请缩短数据范围、减少 num_samples 或季节周期",
+                status=429)
+
+        ticket = {'model': model_type, 'cost': cost}
+        start = time.perf_counter()
+        with self._condition:
+            if self._can_start(ticket):
+                result = 'admitted'
+            elif len(self._waiting) >= self.queue_size:
+                ADMISSION_DECISIONS.inc(model=model_type, result='rejected_queue_full')
+                raise AdmissionRejected(f"预测队列已满 ({self.queue_size})，请稍后重试",
+                                        status=429, retry_after=self._retry_after())
+            else:
+                result = 'queued'
+                self._waiting.append(ticket)
+                self._update_gauges(model_type)
+                deadline = start + self.max_wait
+                try:
+                    while not self._can_start(ticket):
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            ADMISSION_DECISIONS.inc(model=model_type, result='rejected_timeout')
+                            raise AdmissionRejected(f"服务繁忙，等待超过 {self.max_wait:g} 秒仍未执行，请稍后重试",
+                                                    status=503, retry_after=self._retry_after())
+                        # 其他worker释放容量时不会通知本进程，需要定期重试
+                        self._condition.wait(remaining if self._shared is None else min(remaining, ADMISSION_POLL))
+                finally:
+                    self._waiting.remove(ticket)
+                    self._update_gauges(model_type)
+                    # 队首变化后其他等待者可能可以执行
+                    self._condition.notify_all()
+
+            self._running[model_type] = self._running.get(model_type, 0) + 1
+            self._running_cost += cost
+            self._update_gauges(model_type)
+            waited = time.perf_counter() - start
+            self._recent_waits = (self._recent_waits + [waited])[-100:]
+        ADMISSION_DECISIONS.inc(model=model_type, result=result)
+        ADMISSION_WAIT.observe(waited, model=model_type)
+
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                if self._shared is not None:
+                    self._shared.release(ticket)
+                self._running[model_type] -= 1
+                # 没有执行中的预测时归零，避免浮点误差累积
+                self._running_cost = self._running_cost - cost if any(self._running.values()) else 0.0
+                self._update_gauges(model_type)
+                self._condition.notify_all()
+
+    def status(self):
+        with self._condition:
+            waits = sorted(self._recent_waits)
+            running, running_cost = self._shared.totals() if self._shared else (self._running, self._running_cost)
+            return {
+                'capacity': self.capacity,
+                'max_cost': self.max_cost,
+                # 所有worker合计，shared 为 false 时只统计本进程
+                'shared': self._shared is not None,
+                'running_cost': round(running_cost, 3),
+                'running': dict(running),
+                'worker_running': dict(self._running),
+                'queue_depth': len(self._waiting),
+                'queue_size': self.queue_size,
+                'queued': [dict(ticket) for ticket in self._waiting],
+                'model_limits': {**self.model_limits, '*': self.default_limit},
+                'recent_wait_seconds': {
+                    'count': len(waits),
+                    'p50': waits[len(waits) // 2] if waits else None,
+                    'max': waits[-1] if waits else None
+                }
+            }
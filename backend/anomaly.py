@@ -0,0 +1,296 @@
+"""基于预测区间的流式异常检测
+
+预测流水线每完成一次带置信区间的预测，就把该设备的预测区间登记到 AnomalyDetector 中；
+之后新到达的观测值只需与已登记的区间比较，不必重新训练模型。
+
+每个设备的状态（异常分数的指数加权平均、连续越界次数、最后观测时间）保存在按设备行号
+索引的NumPy数组中，一批观测（可包含多个设备、每个设备多个点）的查找、打分和状态更新
+全部向量化完成，每个点的开销为O(1)。
+
+预测区间和检测状态持久化在预测结果存储的SQLite文件中（ANOMALY_STORE_PATH），所有worker进程共享：
+任一worker训练的模型登记的区间，其他worker打分时同样可用；每次打分在写锁内读取本批设备的区间和状态、
+打分并写回，同一设备的指数加权平均不会因请求落在不同worker而分叉。进程内的数组只是本批设备的工作副本。
+
+不晚于设备最后一个已打分时间的点（重放或乱序到达）以及同一批中重复的点不参与打分，也不更新状态，
+在结果中标记为 replayed。
+"""
+import os
+import threading
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from forecast_store import FORECAST_STORE_PATH, connect_store
+
+# 异常分数的指数加权平滑系数
+ANOMALY_EWMA_ALPHA = float(os.getenv('ANOMALY_EWMA_ALPHA', 0.3))
+# 平滑后的异常分数超过该值判定为异常（1表示平均越界一个区间半宽）
+ANOMALY_EWMA_THRESHOLD = float(os.getenv('ANOMALY_EWMA_THRESHOLD', 1.0))
+# 连续越界达到该次数判定为异常
+ANOMALY_MIN_CONSECUTIVE = int(os.getenv('ANOMALY_MIN_CONSECUTIVE', 3))
+# 预测区间和检测状态的存储文件，默认与预测结果存储相同
+ANOMALY_STORE_PATH = os.getenv('ANOMALY_STORE_PATH', FORECAST_STORE_PATH)
+
+_NO_TIME = np.iinfo(np.int64).min
+
+
+class AnomalyDetector:
+    """按设备保存预测区间和检测状态，批量为新观测值打分"""
+
+    def __init__(self, alpha=ANOMALY_EWMA_ALPHA, ewma_threshold=ANOMALY_EWMA_THRESHOLD,
+                 min_consecutive=ANOMALY_MIN_CONSECUTIVE, path=ANOMALY_STORE_PATH):
+        self.path = path
+        self.alpha = alpha
+        self.ewma_threshold = ewma_threshold
+        self.min_consecutive = min_consecutive
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._devices = []
+        # 每个设备一行：预测起点、步长(纳秒)和预测长度
+        self._start = np.zeros(0, dtype=np.int64)
+        self._step = np.ones(0, dtype=np.int64)
+        self._length = np.zeros(0, dtype=np.int64)
+        # 预测值和上下界，形状为 (设备数, 最长预测步数, 3)
+        self._bands = np.full((0, 0, 3), np.nan)
+        # 检测状态
+        self._ewma = np.zeros(0)
+        self._consecutive = np.zeros(0, dtype=np.int64)
+        self._last_time = np.full(0, _NO_TIME, dtype=np.int64)
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with connect_store(path) as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS anomaly_intervals (
+                        device_id TEXT PRIMARY KEY,
+                        start INTEGER,
+                        step INTEGER,
+                        length INTEGER,
+                        bands BLOB
+                    );
+                    CREATE TABLE IF NOT EXISTS anomaly_state (
+                        device_id TEXT PRIMARY KEY,
+                        ewma REAL,
+                        consecutive INTEGER,
+                        last_time INTEGER
+                    );
+                ''')
+
+    def _grow(self, rows, horizon):
+        """扩展状态数组以容纳更多设备或更长的预测"""
+        n_rows, width = self._bands.shape[:2]
+        if horizon > width:
+            padding = np.full((n_rows, horizon - width, 3), np.nan)
+            self._bands = np.concatenate([self._bands, padding], axis=1)
+            width = horizon
+        if rows > n_rows:
+            extra = max(rows - n_rows, n_rows)
+            self._bands = np.concatenate([self._bands, np.full((extra, width, 3), np.nan)])
+            self._start = np.concatenate([self._start, np.zeros(extra, dtype=np.int64)])
+            self._step = np.concatenate([self._step, np.ones(extra, dtype=np.int64)])
+            self._length = np.concatenate([self._length, np.zeros(extra, dtype=np.int64)])
+            self._ewma = np.concatenate([self._ewma, np.zeros(extra)])
+            self._consecutive = np.concatenate([self._consecutive, np.zeros(extra, dtype=np.int64)])
+            self._last_time = np.concatenate([self._last_time, np.full(extra, _NO_TIME, dtype=np.int64)])
+
+    def _row(self, device_id):
+        """设备的行号，新设备分配新行（持有锁时调用）"""
+        row = self._rows.get(device_id)
+        if row is None:
+            row = len(self._rows)
+            self._rows[device_id] = row
+            self._devices.append(device_id)
+            self._grow(row + 1, 0)
+        return row
+
+    def _set_interval(self, row, start, step, bands):
+        self._grow(row + 1, len(bands))
+        self._start[row] = start
+        self._step[row] = step
+        self._length[row] = len(bands)
+        self._bands[row] = np.nan
+        self._bands[row, :len(bands)] = bands
+
+    def register_forecast(self, device_id, times, values, lower, upper):
+        """登记（替换）设备最新的预测区间，已有的检测状态保留"""
+        times = pd.DatetimeIndex(times)
+        if len(times) == 0:
+            return
+        step = times[1] - times[0] if len(times) > 1 else pd.Timedelta(hours=1)
+        device_id = str(device_id)
+        bands = np.column_stack([values, lower, upper]).astype(np.float64)
+        with self._lock:
+            self._set_interval(self._row(device_id), times[0].value, step.value, bands)
+        if self.path:
+            with connect_store(self.path) as conn:
+                conn.execute('INSERT OR REPLACE INTO anomaly_intervals VALUES (?, ?, ?, ?, ?)',
+                             (device_id, int(times[0].value), int(step.value), len(bands), bands.tobytes()))
+
+    def _load(self, conn, device_ids):
+        """从存储中读取设备的区间和检测状态到工作数组（持有锁时调用）"""
+        for start in range(0, len(device_ids), 500):
+            chunk = [str(device_id) for device_id in device_ids[start:start + 500]]
+            placeholders = ','.join('?' * len(chunk))
+            for device_id, begin, step, length, bands in conn.execute(
+                    f'SELECT * FROM anomaly_intervals WHERE device_id IN ({placeholders})', chunk):
+                self._set_interval(self._row(device_id), begin, step,
+                                   np.frombuffer(bands, dtype=np.float64).reshape(length, 3))
+            stored = {row[0]: row[1:] for row in conn.execute(
+                f'SELECT * FROM anomaly_state WHERE device_id IN ({placeholders})', chunk)}
+            for device_id in chunk:
+                if device_id in self._rows or device_id in stored:
+                    row = self._row(device_id)
+                    self._ewma[row], self._consecutive[row], self._last_time[row] = \
+                        stored.get(device_id, (0.0, 0, _NO_TIME))
+
+    def _save_state(self, conn, rows):
+        conn.executemany('INSERT OR REPLACE INTO anomaly_state VALUES (?, ?, ?, ?)', [
+            (self._devices[row], float(self._ewma[row]), int(self._consecutive[row]), int(self._last_time[row]))
+            for row in rows
+        ])
+
+    @property
+    def device_count(self):
+        if self.path:
+            with connect_store(self.path) as conn:
+                return conn.execute('SELECT COUNT(*) FROM anomaly_intervals').fetchone()[0]
+        with self._lock:
+            return len(self._rows)
+
+    def score(self, device_ids, times, values):
+        """为一批观测打分并更新设备状态
+
+        观测按(设备, 时间)排序后处理，每个点对应离它最近的预测步。
+        score 为越出区间的距离除以区间半宽（区间内为0），ewma 为设备的平滑异常分数，
+        consecutive 为连续越界次数；连续越界达到阈值或平滑分数超过阈值时判定为异常。
+        没有覆盖该时间点的预测区间时 has_forecast 为False；重放、乱序或批内重复的点 replayed 为True，
+        两者都不参与打分和状态更新。
+
+        返回按输入顺序排列的各字段数组。
+        """
+        device_ids = np.asarray(device_ids).astype(str)
+        times = pd.to_datetime(np.asarray(times)).asi8
+        values = np.asarray(values, dtype=float)
+        codes, uniques = pd.factorize(device_ids)
+
+        with self._lock:
+            if not self.path:
+                result, _ = self._score(codes, uniques, times, values)
+                return result
+            # 写锁覆盖读取、打分和写回，多个进程对同一设备的打分按顺序执行
+            with connect_store(self.path, immediate=True) as conn:
+                self._load(conn, list(uniques))
+                result, updated_rows = self._score(codes, uniques, times, values)
+                self._save_state(conn, updated_rows)
+            return result
+
+    def _score(self, codes, uniques, times, values):
+        """在工作数组上打分并更新状态，返回 (结果, 更新了状态的行号)（持有锁时调用）"""
+        n = len(values)
+        rows = np.array([self._rows.get(device_id, -1) for device_id in uniques], dtype=np.int64)
+        point_rows = rows[codes]
+
+        # 查找每个点对应的预测步
+        known = point_rows >= 0
+        safe_rows = np.where(known, point_rows, 0)
+        if len(self._start):
+            step_index = np.rint((times - self._start[safe_rows]) / self._step[safe_rows]).astype(np.int64)
+            in_range = known & (step_index >= 0) & (step_index < self._length[safe_rows])
+            last_time = np.where(known, self._last_time[safe_rows], _NO_TIME)
+        else:
+            step_index = np.zeros(n, dtype=np.int64)
+            in_range = np.zeros(n, dtype=bool)
+            last_time = np.full(n, _NO_TIME, dtype=np.int64)
+
+        bands = np.full((n, 3), np.nan)
+        bands[in_range] = self._bands[point_rows[in_range], step_index[in_range]]
+        expected, lower, upper = bands[:, 0], bands[:, 1], bands[:, 2]
+        has_forecast = in_range & np.isfinite(values) & np.isfinite(lower) & np.isfinite(upper)
+
+        # 不晚于设备最后一个已打分时间的点是重放或乱序到达的，批内同一设备同一时间的点只保留第一个
+        replayed = has_forecast & (times <= last_time)
+        candidates = np.flatnonzero(has_forecast & ~replayed)
+        # 按(设备行号, 时间)排序（稳定排序，重复点中输入靠前的排在前面），同一设备的点连续排列
+        order = candidates[np.lexsort((times[candidates], point_rows[candidates]))]
+        duplicate = np.zeros(len(order), dtype=bool)
+        duplicate[1:] = (point_rows[order][1:] == point_rows[order][:-1]) & (times[order][1:] == times[order][:-1])
+        replayed[order[duplicate]] = True
+        order = order[~duplicate]
+        valid = has_forecast & ~replayed
+
+        # 越界距离按区间半宽归一化
+        with np.errstate(divide='ignore', invalid='ignore'):
+            half_width = np.maximum((upper - lower) / 2, 1e-12)
+            distance = np.maximum(values - upper, lower - values)
+            score = np.where(valid, np.maximum(distance, 0) / half_width, np.nan)
+        outside = valid & (score > 0)
+
+        ewma = np.full(n, np.nan)
+        consecutive = np.zeros(n, dtype=np.int64)
+        last_rows = np.zeros(0, dtype=np.int64)
+        if len(order):
+            sorted_rows = point_rows[order]
+            sorted_score = score[order]
+            sorted_outside = outside[order]
+            m = len(order)
+            position = np.arange(m)
+            group_first = np.r_[True, sorted_rows[1:] != sorted_rows[:-1]]
+            group_start = np.maximum.accumulate(np.where(group_first, position, 0))
+
+            # 各设备的指数加权平均：整体滤波一次，再修正每组起点前的状态
+            decay = 1 - self.alpha
+            filtered = lfilter([self.alpha], [1, -decay], sorted_score)
+            previous = np.where(group_start > 0, filtered[np.maximum(group_start - 1, 0)], 0.0)
+            steps_in_group = position - group_start + 1
+            sorted_ewma = filtered + decay ** steps_in_group * (self._ewma[sorted_rows] - previous)
+
+            # 连续越界次数：距上一个区间内的点的距离，组内没有时接上之前的计数
+            last_inside = np.maximum.accumulate(np.where(~sorted_outside, position, -1))
+            sorted_consecutive = np.where(
+                last_inside >= group_start, position - last_inside,
+                steps_in_group + self._consecutive[sorted_rows])
+
+            ewma[order] = sorted_ewma
+            consecutive[order] = sorted_consecutive
+
+            # 每个设备的最后一个点写回状态
+            group_last = np.r_[sorted_rows[1:] != sorted_rows[:-1], True]
+            last_rows = sorted_rows[group_last]
+            self._ewma[last_rows] = sorted_ewma[group_last]
+            self._consecutive[last_rows] = sorted_consecutive[group_last]
+            self._last_time[last_rows] = times[order][group_last]
+
+        anomaly = valid & ((consecutive >= self.min_consecutive) | (ewma >= self.ewma_threshold))
+        return {
+            'has_forecast': has_forecast,
+            'replayed': replayed,
+            'expected': expected,
+            'lower': lower,
+            'upper': upper,
+            'score': score,
+            'ewma': ewma,
+            'consecutive': consecutive,
+            'outside': outside,
+            'anomaly': anomaly
+        }, last_rows
+
+    def device_state(self, device_ids=None):
+        """返回设备当前的检测状态"""
+        with self._lock:
+            items = self._rows.items() if device_ids is None else \
+                [(device_id, self._rows[device_id]) for device_id in device_ids if device_id in self._rows]
+            return {
+                device_id: {
+                    'ewma': float(self._ewma[row]),
+                    'consecutive': int(self._consecutive[row]),
+                    'forecast_start': pd.Timestamp(self._start[row]).strftime('%Y-%m-%d %H:%M:%S')
+                    if self._length[row] else None,
+                    'forecast_periods': int(self._length[row]),
+                    'last_observation': pd.Timestamp(self._last_time[row]).strftime('%Y-%m-%d %H:%M:%S')
+                    if self._last_time[row] > _NO_TIME else None
+                }
+                for device_id, row in items
+            }
+
+
+# 全局异常检测器，由预测流水线登记预测区间
+detector = AnomalyDetector()
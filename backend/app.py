@@ -1,17 +1,28 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS
 import pandas as pd
-from darts import TimeSeries
-from darts.metrics import mape, rmse, mae, mse
-import json
 import numpy as np
-from datetime import datetime, timedelta
-import os
+from datetime import datetime
 import warnings
-import glob
+from collections import Counter
 import sys
 # 添加模型管理器导入
 from models.model_manager import ModelManager
+from data_store import load_raw_data, get_data_version, get_rollups, get_data_time_range
+from metric_series import load_metric_data, prepare_arima_data, summarize_data
+from forecast_pipeline import ForecastPipeline
+from admission import AdmissionController, AdmissionRejected, estimate_cost
+from memory import memory_tracker
+from forecast_store import ForecastStore, ForecastScheduler, FORECAST_SCHEDULER_ENABLED
+from metrics import render_metrics, time_stage, ANOMALY_POINTS
+from anomaly import detector
+from fleet import screen_fleet, ForecastQueue, FLEET_THRESHOLD, bucket_matrix
+from autocorrelation import analyze, suggest, consensus, parameter_configs
+from http_cache import etag_cached
+from precision import to_json_list
+from hierarchy import HierarchicalForecaster, RECONCILIATION_METHODS, hourly_matrix
+from models.batch_exponential_smoothing import BatchExponentialSmoothing, SMOOTHING_MODES
+from profiling import profiled, is_profiling, is_trusted_caller, PROFILE_DIR
 from loguru import logger
 # 设置系统编码为UTF-8
 if hasattr(sys.stdout, 'reconfigure'):
@@ -27,226 +38,435 @@ app.config['JSON_AS_ASCII'] = False
 app.config['JSONIFY_MIMETYPE'] = 'application/json;charset=utf-8'
 CORS(app)  # 解决跨域问题
 
-# 全局变量存储模型和数据
-models_cache = {}
-data_cache = {}
-trained_model = None
-train_series = None
-val_series = None
-
 # 创建全局模型管理器实例
 model_manager = ModelManager()
 
-def load_metric_data(resource_id=None):
-    """加载存储空间使用率数据"""
-    # 查找data目录下的所有CSV文件
-    # 支持多种路径：容器内部路径和本地开发路径
-    data_dir = os.getenv('DATA_DIR', '/app/data')
-    if not os.path.exists(data_dir):
-        # 如果容器内路径不存在，尝试本地开发路径
-        local_data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
-        if os.path.exists(local_data_dir):
-            data_dir = local_data_dir
-        else:
-            raise FileNotFoundError(f"数据目录不存在: {data_dir} 和 {local_data_dir}")
-    
-    csv_files = glob.glob(os.path.join(data_dir, '*.csv'))
-    
-    if not csv_files:
-        raise FileNotFoundError(f"data目录中没有找到CSV文件: {data_dir}")
-    
-    # 读取所有CSV文件
-    all_data = []
-    for file_path in csv_files:
-        try:
-            df = pd.read_csv(file_path)
-            all_data.append(df)
-        except Exception as e:
-            print(f"警告: 无法读取文件 {file_path}: {e}")
-    
-    if not all_data:
-        raise FileNotFoundError("没有成功读取任何CSV文件")
-    
-    # 合并所有数据
-    df = pd.concat(all_data, ignore_index=True)
-    
-    # 转换时间列
-    df['datetime'] = pd.to_datetime(df['time'])
-    
-    # 如果指定了资源ID，则过滤数据
-    if resource_id:
-        df = df[df['ci_id'] == resource_id]
-    
-    # 过滤有效数据 (value > 0，去除连接失败的数据)
-    valid_data = df[df['value'] > 0].copy()
-    
-    if valid_data.empty:
-        raise ValueError("没有找到有效的数据 (value > 0)")
-    
-    # 选择数据最完整的设备
-    device_counts = valid_data['ci_id'].value_counts()
-    best_device = device_counts.index[0]
-    
-    # 获取最佳设备的数据
-    device_data = valid_data[valid_data['ci_id'] == best_device].copy()
-    device_data = device_data.sort_values('datetime')
-    
-    # 按小时聚合数据（减少数据量，提高预测效果）
-    device_data.set_index('datetime', inplace=True)
-    hourly_data = device_data['value'].resample('H').mean().dropna()
-    
-    return hourly_data, best_device
-
-def prepare_arima_data(series, train_ratio=0.8, 
-                      data_start_date=None, data_end_date=None):
-    """准备ARIMA模型的训练和验证数据，支持时间范围过滤"""
-     # 1. 首先处理无效值 (-2 表示连接失败)
-    series = series[series > 0]  # 过滤掉无效值
-
-    # 2. 重新索引到规则的5分钟频率时间序列，填充缺失值
-    series = series.asfreq('5T')  # '5T' 表示5分钟频率
-
-    # 3. 处理缺失值 - 可以选择插值或前向填充
-    series = series.interpolate(method='time')  # 时间序列插值
-    # 或者使用前向填充: series = series.fillna(method='ffill')
-    # 转换为Darts TimeSeries
-    # ts = TimeSeries.from_series(series, freq='H')  # 小时频率
-    # 如果原始数据是分钟级
-    # ts = TimeSeries.from_series(series, freq='T')  # 分钟频率
-    # 如果原始数据是秒级
-    # ts = TimeSeries.from_series(series, freq='S')  # 秒频率
-    ts = TimeSeries.from_series(series, freq='5T')
-    # 根据指定的时间范围过滤数据
-    if data_start_date or data_end_date:
-        if data_start_date:
-            ts = ts.drop_before(pd.Timestamp(data_start_date))
-        if data_end_date:
-            ts = ts.drop_after(pd.Timestamp(data_end_date))
-    
-    # 划分训练集和验证集
-    train_size = int(len(ts) * train_ratio)
-    ts_train = ts[:train_size]
-    ts_val = ts[train_size:]
-    
-    return ts_train, ts_val
-
+# 按成本的准入控制：限制同时训练的总成本和每个模型的并发数，超出时排队或拒绝
+admission = AdmissionController()
+# 创建预测流水线（每个请求的状态独立，相同的并发请求只训练一次）
+forecast_pipeline = ForecastPipeline(model_manager, load_metric_data, prepare_arima_data, admission)
+# 预测结果存储：后台定期预计算，/api/forecast 命中新鲜结果时直接返回
+forecast_scheduler = ForecastScheduler(forecast_pipeline, ForecastStore())
+if FORECAST_SCHEDULER_ENABLED:
+    forecast_scheduler.start()
+# 设备群筛查后，为高风险设备在后台排队执行完整预测（启用后台预计算时结果同时写入预测存储）
+fleet_queue = ForecastQueue(forecast_scheduler.compute)
+# 按 ci_type 分层的聚合预测
+hierarchical_forecaster = HierarchicalForecaster(model_manager)
+
+
+def _rejected_response(e):
+    """未准入的预测返回429或503，并带 Retry-After"""
+    logger.warning(f"预测未准入: {str(e)}")
+    response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+    response.status_code = e.status
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
 
 
 @app.route('/api/forecast', methods=['POST'])
+@profiled
 def forecast():
     """完整的训练和预测流程（向后兼容）"""
     try:
         # 获取前端传递的参数
         data = request.json if request.json else {}
         model_type = data.get('model', 'arima')
-        forecast_periods = int(data.get('periods', 24))
-        train_ratio = float(data.get('train_ratio', 0.8))
 
-        # 获取时间范围参数
-        data_start_date = data.get('data_start_date')
-        data_end_date = data.get('data_end_date')
-        
-        # 获取资源ID参数
-        resource_id = data.get('resource_id')
-
-        # 加载数据，支持根据资源ID过滤
-        series_data, device_id = load_metric_data(resource_id)
-
-        # 准备训练数据
-        train_series, val_series = prepare_arima_data(
-            series_data, 
-            train_ratio=train_ratio,
-            data_start_date=data_start_date,
-            data_end_date=data_end_date
-        )
-
-        # 根据模型类型创建模型
-        model_obj = model_manager.get_model(model_type)
-        if not model_obj:
+        # 根据模型类型检查模型是否存在
+        if not model_manager.get_model(model_type):
             return jsonify({'error': f'不支持的模型类型: {model_type}'}), 400
-            
-        # 创建并训练模型
-        model = model_obj.create_model(**data)
-        model = model_obj.fit(model, train_series)
-        
-        # 获取模型参数描述
-        model_params = str(data)  # 简化处理，实际应根据模型类型生成具体描述
-
-        # 预测
-        forecast_result = model_obj.predict(model, forecast_periods)
-        # 处理预测结果（可能包含置信区间）
-        if isinstance(forecast_result, tuple):
-            forecast, forecast_interval = forecast_result
-        else:
-            forecast = forecast_result
-            forecast_interval = None
-
-        # 在验证集上评估（如果有足够的验证数据）
-        if len(val_series) >= forecast_periods:
-            val_forecast_result = model_obj.predict(model, len(val_series))
-            if isinstance(val_forecast_result, tuple):
-                val_forecast, val_forecast_interval = val_forecast_result
-            else:
-                val_forecast = val_forecast_result
-                val_forecast_interval = None
-            actual = val_series
-
-            mape_score = float(mape(actual, val_forecast))
-            rmse_score = float(rmse(actual, val_forecast))
-            mae_score = float(mae(actual, val_forecast))
-            mse_score = float(mse(actual, val_forecast))
-        else:
-            val_forecast = None
-            mape_score = rmse_score = mae_score = mse_score = None
 
-        # 准备响应数据
-        response = {
-            'historical': {
-                'dates': train_series.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
-                'values': train_series.values().flatten().tolist()
-            },
-            'forecast': {
-                'dates': forecast.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
-                'values': forecast.values().flatten().tolist()
-            },
-            'validation': {
-                'dates': val_series.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist() if len(val_series) > 0 else [],
-                'values': val_series.values().flatten().tolist() if len(val_series) > 0 else [],
-                'forecast': val_forecast.values().flatten().tolist() if val_forecast is not None else []
-            },
-            'metrics': {
-                'mape': mape_score,
-                'rmse': rmse_score,
-                'mae': mae_score,
-                'mse': mse_score
-            },
-            'model_info': {
-                'type': model_type,
-                'parameters': model_params,
-                'device_id': device_id,
-                'train_size': len(train_series),
-                'val_size': len(val_series),
-                'forecast_periods': forecast_periods,
-                'data_frequency': 'hourly'
-            }
-        }
-        # 添加置信区间数据（如果存在）
-        if forecast_interval is not None:
-            response['forecast']['lower'] = forecast_interval['lower'].values().flatten().tolist()
-            response['forecast']['upper'] = forecast_interval['upper'].values().flatten().tolist()
+        # 已有新鲜的预计算结果时直接返回（性能分析时总是重新计算）
+        body = None if is_profiling() else forecast_scheduler.lookup(data)
+        if body is not None:
+            return Response(body, mimetype='application/json', headers={'X-Forecast-Source': 'store'})
 
-        if val_forecast_interval is not None:
-            response['validation']['forecast_lower'] = val_forecast_interval['lower'].values().flatten().tolist()
-            response['validation']['forecast_upper'] = val_forecast_interval['upper'].values().flatten().tolist()
+        with time_stage('total', model_type):
+            # 性能分析时不合并请求，保证分析的是本请求自身的计算
+            body = forecast_scheduler.compute(data, coalesce=not is_profiling())
+        return Response(body, mimetype='application/json', headers={'X-Forecast-Source': 'computed'})
 
-        return json.dumps(response)
-    
+    except AdmissionRejected as e:
+        return _rejected_response(e)
     except Exception as e:
         logger.exception(f"预测时出错: {str(e)}")
 #         log.error(f"预测时出错: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+
+@app.route('/api/forecast/store', methods=['GET'])
+def forecast_store_status():
+    """预测存储和后台预计算的状态"""
+    try:
+        return jsonify(forecast_scheduler.status())
+    except Exception as e:
+        logger.exception(f"读取预测存储状态时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/forecast/store/refresh', methods=['POST'])
+def forecast_store_refresh():
+    """数据导入后触发一轮预计算；后台预计算未启用时返回409，不在请求中拟合（查询也不会读取存储）"""
+    try:
+        if not FORECAST_SCHEDULER_ENABLED:
+            return jsonify({'status': 'disabled', 'error': '后台预计算未启用 (FORECAST_SCHEDULER_ENABLED)'}), 409
+        forecast_scheduler.trigger()
+        return jsonify({'status': 'triggered'})
+    except Exception as e:
+        logger.exception(f"预计算时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/forecast/hierarchical', methods=['POST'])
+@profiled
+def forecast_hierarchical():
+    """按 ci_type 和设备总量分层预测，并协调到每个设备
+
+    method 为 top_down（只训练总量）或 middle_out（每个 ci_type 训练一次），
+    其余参数与 /api/forecast 相同，传给所选模型。
+    """
+    try:
+        data = request.json if request.json else {}
+        model_type = data.get('model', 'arima')
+        if not model_manager.get_model(model_type):
+            return jsonify({'error': f'不支持的模型类型: {model_type}'}), 400
+        method = data.get('method', 'top_down')
+        if method not in RECONCILIATION_METHODS:
+            return jsonify({'error': f"不支持的协调方法: {method}，可选: {', '.join(RECONCILIATION_METHODS)}"}), 400
+
+        # 只读取最近 history_hours 小时的数据
+        history_hours = int(data.get('history_hours', 720))
+        _, data_end = get_data_time_range()
+        df = load_raw_data(start=data_end.floor('H') - pd.Timedelta(hours=history_hours - 1) if data_end else None)
+        # top_down 训练一次，middle_out 每个 ci_type 训练一次
+        fits = df['ci_type'].nunique() if method == 'middle_out' else 1
+        cost = estimate_cost(model_type, data, history_hours) * max(fits, 1)
+        with memory_tracker.request(model_type):
+            memory_tracker.check_estimate(model_type, data, history_hours, int(data.get('periods', 24)))
+            with admission.admit(model_type, cost), time_stage('total', f'hierarchical_{model_type}'):
+                result = hierarchical_forecaster.forecast(
+                    df, model_type=model_type, params=data,
+                    periods=int(data.get('periods', 24)),
+                    method=method,
+                    history_hours=history_hours,
+                    proportion_hours=int(data.get('proportion_hours', 168)),
+                    include_devices=bool(data.get('include_devices', True)))
+        return jsonify(result)
+
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except Exception as e:
+        logger.exception(f"分层预测时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/forecast/batch', methods=['POST'])
+@profiled
+def forecast_batch():
+    """批量指数平滑：一次调用为全部（或指定的）设备拟合并预测
+
+    设备数据按小时聚合为 (设备数, 小时数) 矩阵，所有设备的参数搜索和预测在同一组数组运算中完成。
+    mode 为 simple、holt 或 holt_winters，可用 ci_type 或 devices 限定设备范围。
+    """
+    try:
+        data = request.json if request.json else {}
+        mode = data.get('mode', 'holt_winters')
+        if mode not in SMOOTHING_MODES:
+            return jsonify({'error': f"不支持的平滑模式: {mode}，可选: {', '.join(SMOOTHING_MODES)}"}), 400
+        periods = int(data.get('periods', 24))
+        confidence_level = float(data.get('confidence_level', 0.95))
+
+        # 只读取最近 history_hours 小时的数据
+        history_hours = int(data.get('history_hours', 720))
+        _, data_end = get_data_time_range()
+        df = load_raw_data(start=data_end.floor('H') - pd.Timedelta(hours=history_hours - 1) if data_end else None)
+        if data.get('ci_type'):
+            df = df[df['ci_type'] == data['ci_type']]
+        if data.get('devices'):
+            df = df[df['ci_id'].isin([str(device) for device in data['devices']])]
+        if not (df['value'] > 0).any():
+            return jsonify({'error': '没有找到有效的数据 (value > 0)'}), 400
+
+        devices, ci_types, time_index, matrix = hourly_matrix(df, history_hours)
+        cost = estimate_cost('batch_ets', {**data, 'mode': mode}, matrix.size)
+        memory_tracker.check_estimate('batch_ets', {**data, 'mode': mode}, matrix.size, periods)
+        with memory_tracker.request('batch_ets'), admission.admit('batch_ets', cost), \
+                time_stage('total', 'batch_ets'):
+            engine = BatchExponentialSmoothing(
+                mode=mode,
+                seasonal_periods=int(data.get('seasonal_periods', 24)),
+                grid_size=int(data.get('grid_size', 5)),
+                refine_rounds=int(data.get('refine_rounds', 3)))
+            with time_stage('fit', 'batch_ets'):
+                engine.fit(matrix)
+            with time_stage('predict', 'batch_ets'):
+                mean, lower, upper = engine.forecast(periods, confidence_level)
+
+        dates = pd.date_range(time_index[-1] + pd.Timedelta(hours=1), periods=periods, freq='H')
+        return jsonify({
+            'mode': mode,
+            'periods': periods,
+            'dates': dates.strftime('%Y-%m-%d %H:%M:%S').tolist(),
+            'history': {
+                'start': time_index[0].strftime('%Y-%m-%d %H:%M:%S'),
+                'end': time_index[-1].strftime('%Y-%m-%d %H:%M:%S'),
+                'hours': len(time_index)
+            },
+            'devices': {
+                str(device): {
+                    'ci_type': None if pd.isna(ci_types[i]) else str(ci_types[i]),
+                    'values': to_json_list(mean[i]),
+                    'lower': to_json_list(lower[i]),
+                    'upper': to_json_list(upper[i]),
+                    'alpha': float(engine.alpha_[i]),
+                    'beta': float(engine.beta_[i]),
+                    'gamma': float(engine.gamma_[i]),
+                    'sigma': float(np.sqrt(engine.sigma2_[i]))
+                }
+                for i, device in enumerate(devices)
+            }
+        })
+
+    except AdmissionRejected as e:
+        return _rejected_response(e)
+    except Exception as e:
+        logger.exception(f"批量预测时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/analysis/autocorrelation', methods=['POST'])
+@profiled
+def analyze_autocorrelation():
+    """批量计算设备的ACF/PACF，检测主季节周期并给出模型参数建议
+
+    resource_id、devices 或 ci_type 限定设备范围（都不传时分析全部设备），数据按 freq 聚合后取最近
+    history_hours 小时。单个设备时默认返回ACF/PACF数组，多个设备时传 include_acf=true 才返回。
+    parameters 为所有设备的共同建议，结构与 /api/model/<id>/parameters 相同（default 为建议值）。
+    """
+    try:
+        data = request.json if request.json else {}
+        step = pd.Timedelta(pd.tseries.frequencies.to_offset(data.get('freq', '5min')))
+        history_hours = int(data.get('history_hours', 336))
+        points = int(pd.Timedelta(hours=history_hours) / step)
+        if points < 20:
+            return jsonify({'error': f'数据点数不足: history_hours/freq 只有 {points} 个点'}), 400
+
+        _, data_end = get_data_time_range()
+        start = data_end.floor('H') - pd.Timedelta(hours=history_hours - 1) if data_end else None
+        df = load_raw_data(resource_id=data.get('resource_id'), start=start)
+        if data.get('ci_type'):
+            df = df[df['ci_type'] == data['ci_type']]
+        if data.get('devices'):
+            df = df[df['ci_id'].isin([str(device) for device in data['devices']])]
+        if not (df['value'] > 0).any():
+            return jsonify({'error': '没有找到有效的数据 (value > 0)'}), 400
+
+        with time_stage('total', 'autocorrelation'):
+            devices, matrix, _ = bucket_matrix(df, points, step)
+            # 缺失超过一半的设备不参与分析，其余的缺失点按线性插值填充
+            coverage = np.isfinite(matrix).mean(axis=1)
+            keep = coverage >= 0.5
+            matrix = pd.DataFrame(matrix[keep].T).interpolate(limit_direction='both').to_numpy().T
+            if not keep.any():
+                return jsonify({'error': '所有设备的数据覆盖率都低于50%'}), 400
+            result = analyze(matrix, step,
+                             max_lag=data.get('max_lag'),
+                             pacf_lags=int(data.get('pacf_lags', 40)),
+                             min_period=int(data.get('min_period', 2)),
+                             max_period=data.get('max_period'))
+
+        include_acf = bool(data.get('include_acf', keep.sum() == 1))
+        per_device, suggestions = {}, []
+        for i, device in enumerate(devices[keep]):
+            suggested, notes = suggest(result, i, model_manager)
+            suggestions.append(suggested)
+            period = int(result['period'][i])
+            entry = {
+                'coverage': round(float(coverage[keep][i]), 4),
+                'seasonal_period': {
+                    'lag': period,
+                    'hours': period * step / pd.Timedelta(hours=1),
+                    'strength': round(float(result['strength'][i]), 4)
+                } if period else None,
+                'orders': {'p': int(result['p'][i]), 'd': int(result['d'][i]), 'q': int(result['q'][i])},
+                'suggested': suggested,
+                'notes': notes
+            }
+            if include_acf:
+                entry['acf'] = to_json_list(result['acf'][i], 4)
+                entry['pacf'] = to_json_list(result['pacf'][i], 4)
+                entry['seasonal_acf'] = to_json_list(result['seasonal_acf'][i], 4)
+            per_device[str(device)] = entry
+
+        periods = Counter(int(period) for period in result['period'] if period)
+        return jsonify({
+            'freq': pd.tseries.frequencies.to_offset(step).freqstr,
+            'points': points,
+            'threshold': float(result['threshold']),
+            'devices': per_device,
+            'skipped': [str(device) for device in devices[~keep]],
+            'periods': {str(lag): count for lag, count in periods.most_common()},
+            'parameters': parameter_configs(consensus(suggestions), model_manager)
+        })
+
+    except Exception as e:
+        logger.exception(f"自相关分析时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/anomaly/score', methods=['POST'])
+def score_anomalies():
+    """将新到达的观测值与已登记的预测区间比较，返回异常标记和分数
+
+    请求体可以是按列的 {"device_id": 设备ID或列表, "time": [...], "value": [...]}，
+    也可以是 {"observations": [{"device_id": ..., "time": ..., "value": ...}, ...]}。
+    results 中各列表与输入观测的顺序一致。设备的预测区间在对其执行带置信区间的预测时登记，
+    所有worker共享；已打分时间之前或重复提交的点标记为 replayed，不重复更新状态。
+    """
+    try:
+        data = request.json if request.json else {}
+        if 'observations' in data:
+            observations = data['observations']
+            device_ids = [item.get('device_id') for item in observations]
+            times = [item.get('time') for item in observations]
+            values = [item.get('value') for item in observations]
+        else:
+            times = data.get('time') or []
+            values = data.get('value') or []
+            device_ids = data.get('device_id')
+            if not isinstance(device_ids, list):
+                device_ids = [device_ids] * len(values)
+        if not (len(device_ids) == len(times) == len(values)):
+            return jsonify({'error': 'device_id、time 和 value 的长度必须一致'}), 400
+        if None in device_ids:
+            return jsonify({'error': '每个观测都必须提供 device_id'}), 400
+        values = [np.nan if value is None else value for value in values]
+
+        with time_stage('score', 'anomaly'):
+            result = detector.score(device_ids, times, values)
+
+        anomaly = result['anomaly']
+        no_forecast = ~result['has_forecast']
+        replayed = result['replayed']
+        outside = result['outside'] & ~anomaly
+        ANOMALY_POINTS.inc(int(anomaly.sum()), result='anomaly')
+        ANOMALY_POINTS.inc(int(outside.sum()), result='outside')
+        ANOMALY_POINTS.inc(int(no_forecast.sum()), result='no_forecast')
+        ANOMALY_POINTS.inc(int(replayed.sum()), result='replayed')
+        ANOMALY_POINTS.inc(int(len(anomaly) - anomaly.sum() - outside.sum() - no_forecast.sum() - replayed.sum()),
+                           result='normal')
+
+        return jsonify({
+            'status': 'success',
+            'results': {name: to_json_list(column) for name, column in result.items()},
+            'summary': {
+                'points': len(anomaly),
+                'scored': int((result['has_forecast'] & ~replayed).sum()),
+                'outside': int(result['outside'].sum()),
+                'anomalies': int(anomaly.sum()),
+                'no_forecast': int(no_forecast.sum()),
+                'replayed': int(replayed.sum())
+            },
+            'devices': detector.device_state(sorted(set(map(str, device_ids))))
+        })
+
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f'观测数据格式错误: {str(e)}'}), 400
+    except Exception as e:
+        logger.exception(f"异常检测时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/fleet/screen', methods=['POST'])
+@profiled
+def screen_fleet_devices():
+    """对全部设备计算稳健趋势和到达阈值的时间，按风险排序
+
+    top_k > 0 时为排名最前且预计在 horizon_hours 内到达阈值的设备在后台排队执行完整预测，
+    返回的 job_id 可通过 /api/fleet/jobs/<job_id> 查询进度和结果。
+    """
+    try:
+        data = request.json if request.json else {}
+        threshold = float(data.get('threshold', FLEET_THRESHOLD))
+        direction = data.get('direction', 'below')
+        if direction not in ('below', 'above'):
+            return jsonify({'error': 'direction 只能是 below 或 above'}), 400
+        horizon_hours = float(data.get('horizon_hours', 168))
+        limit = int(data.get('limit', 100))
+        top_k = int(data.get('top_k', 0))
+        forecast_params = data.get('forecast_params', {'model': 'arima'})
+        if top_k > 0 and not model_manager.get_model(forecast_params.get('model', 'arima')):
+            return jsonify({'error': f"不支持的模型类型: {forecast_params.get('model')}"}), 400
+
+        # 只读取最近 window_hours 小时的数据
+        window_hours = int(data.get('window_hours', 168))
+        _, data_end = get_data_time_range()
+        df = load_raw_data(start=data_end.floor('H') - pd.Timedelta(hours=window_hours - 1) if data_end else None)
+        if data.get('ci_type'):
+            df = df[df['ci_type'] == data['ci_type']]
+
+        with time_stage('screen', 'fleet'):
+            ranking = screen_fleet(
+                df, threshold=threshold, direction=direction, horizon_hours=horizon_hours,
+                window_hours=window_hours,
+                sample_pairs=int(data.get('sample_pairs', 200)))
+
+        job_id = None
+        if top_k > 0:
+            candidates = ranking.loc[ranking['at_risk'], 'ci_id'].head(top_k).tolist()
+            if candidates:
+                job_id = fleet_queue.submit(candidates, forecast_params, threshold, direction)
+
+        top = ranking.head(limit).copy()
+        top['eta'] = top['eta'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        top = top.replace([np.inf, -np.inf], np.nan).astype(object).where(top.notna(), None)
+
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'threshold': threshold,
+                'direction': direction,
+                'horizon_hours': horizon_hours,
+                'summary': {
+                    'devices': len(ranking),
+                    'with_trend': int(ranking['hours_to_threshold'].notna().sum()),
+                    'at_risk': int(ranking['at_risk'].sum()),
+                    'crossed': int((ranking['hours_to_threshold'] == 0).sum())
+                },
+                'devices': top.to_dict('records'),
+                'job_id': job_id
+            }
+        })
+
+    except Exception as e:
+        logger.exception(f"设备群筛查时出错: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/fleet/jobs/<job_id>', methods=['GET'])
+def get_fleet_job(job_id):
+    """查询筛查后排队执行的预测任务"""
+    status = fleet_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(status)
+
+
+@app.route('/api/admission', methods=['GET'])
+def admission_status():
+    """准入控制状态：执行中的成本、各模型并发数和等待队列"""
+    return jsonify(admission.status())
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """以Prometheus文本格式输出各阶段耗时、缓存命中率和正在执行的训练数"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/models', methods=['GET'])
+@etag_cached('models', model_manager.registry_version)
 def get_models():
     """获取可用模型列表"""
     models = model_manager.get_available_models()
@@ -254,6 +474,7 @@ def get_models():
 
 # 添加获取模型参数配置的接口
 @app.route('/api/model/<model_id>/parameters', methods=['GET'])
+@etag_cached('model_parameters', model_manager.registry_version)
 def get_model_parameters(model_id):
     """获取指定模型的参数配置"""
     parameters = model_manager.get_model_parameters(model_id)
@@ -275,6 +496,8 @@ def get_model_parameters(model_id):
         return jsonify({'error': '模型未找到'}), 404
 
 @app.route('/api/data/info', methods=['GET'])
+@profiled
+@etag_cached('data_info', get_data_version)
 def get_data_info():
     """获取数据信息"""
     try:
@@ -310,110 +533,52 @@ def get_data_info():
 
 
 
-@app.route('/api/data/preview2', methods=['GET'])
-def preview_data2():
-    """预览数据 - 按设备统计数据概况"""
+@app.route('/api/data/series', methods=['GET'])
+@profiled
+@etag_cached('data_series', get_data_version)
+def get_data_series():
+    """按请求的频率和时间范围返回设备的 count/mean/min/max
+
+    从能满足 freq 的最粗一级汇总（5分钟/小时/天）读取；未指定 freq 时按 max_points 自动选择粒度。
+    """
     try:
-        # 查找data目录下的所有CSV文件
-        data_dir = os.getenv('DATA_DIR', '/app/data')
-        if not os.path.exists(data_dir):
-            # 如果容器内路径不存在，尝试本地开发路径
-            local_data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
-            if os.path.exists(local_data_dir):
-                data_dir = local_data_dir
-            else:
-                raise FileNotFoundError(f"数据目录不存在: {data_dir} 和 {local_data_dir}")
-
-        csv_files = glob.glob(os.path.join(data_dir, '*.csv'))
-
-        if not csv_files:
-            raise FileNotFoundError(f"data目录中没有找到CSV文件: {data_dir}")
-
-        # 读取所有CSV文件
-        all_data = []
-        for file_path in csv_files:
-            try:
-                df = pd.read_csv(file_path)
-                all_data.append(df)
-            except Exception as e:
-                print(f"警告: 无法读取文件 {file_path}: {e}")
-
-        if not all_data:
-            raise FileNotFoundError("没有成功读取任何CSV文件")
-
-        # 合并所有数据
-        df = pd.concat(all_data, ignore_index=True)
-
-        # 转换时间列
-        df['datetime'] = pd.to_datetime(df['time'])
-
-        # 按设备分组进行统计
-        device_stats = []
-
-        # 对每个设备进行分组统计
-        for ci_id, group in df.groupby('ci_id'):
-            # 获取设备类型（取第一个非空值）
-            ci_type = group['ci_type'].iloc[0] if not group['ci_type'].empty else 'unknown'
-
-            # 获取数据代码（取第一个非空值）
-            code = group['code'].iloc[0] if not group['code'].empty else 'unknown'
-
-            # 计算时间范围
-            data_start_time = group['datetime'].min().strftime('%Y-%m-%d %H:%M:%S')
-            data_end_time = group['datetime'].max().strftime('%Y-%m-%d %H:%M:%S')
-
-            # 统计正常值和异常值
-            normal_count = len(group[group['value'] != -2])
-            abnormal_count = len(group[group['value'] == -2])
-            
-            # 计算平均值和标准差（仅基于有效数据）
-            valid_data = group[group['value'] > 0]['value']
-            if len(valid_data) > 0:
-                mean_value = float(valid_data.mean())
-                std_value = float(valid_data.std()) if len(valid_data) > 1 else 0.0
-            else:
-                mean_value = -1
-                std_value = -1
-
-            # 构建设备统计信息
-            device_stat = {
-                'ci_id': ci_id,
-                'ci_type': ci_type,
-                'data_start_time': data_start_time,
-                'data_end_time': data_end_time,
-                'code': code,
-                'normal_count': normal_count,
-                'abnormal_count': abnormal_count,
-                'mean': mean_value,
-                'std': std_value
+        rollups = get_rollups()
+        device_id = request.args.get('resource_id') or rollups.best_device()
+        freq = request.args.get('freq') or None
+        start = request.args.get('start') or None
+        end = request.args.get('end') or None
+        max_points = int(request.args.get('max_points', 2000))
+
+        frame, level = rollups.device_series(device_id, freq, start, end, max_points)
+        return jsonify({
+            "status": "success",
+            "data": {
+                'device_id': device_id,
+                'freq': freq,
+                'rollup': level,
+                'dates': frame.index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
+                'count': frame['count'].astype(int).tolist(),
+                'mean': to_json_list(frame['mean']),
+                'min': to_json_list(frame['min']),
+                'max': to_json_list(frame['max'])
             }
+        })
 
-            device_stats.append(device_stat)
-
-        # 按正常数据量降序排序（数据质量好的设备排在前面）
-        device_stats.sort(key=lambda x: x['normal_count'], reverse=True)
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 500
 
-        # 计算总体统计信息
-        total_records = len(df)
-        total_devices = len(device_stats)
-        total_normal = sum(stat['normal_count'] for stat in device_stats)
-        total_abnormal = sum(stat['abnormal_count'] for stat in device_stats)
 
-        # 构建响应数据结构
-        response = {
-            'summary': {
-                'total_devices': total_devices,
-                'total_records': total_records,
-                'total_normal_count': total_normal,
-                'total_abnormal_count': total_abnormal,
-                'data_quality_ratio': round(total_normal / total_records * 100, 2) if total_records > 0 else 0
-            },
-            'records': device_stats,
-            'data_range': {
-                'start': df['datetime'].min().strftime('%Y-%m-%d %H:%M:%S'),
-                'end': df['datetime'].max().strftime('%Y-%m-%d %H:%M:%S')
-            }
-        }
+@app.route('/api/data/preview2', methods=['GET'])
+@profiled
+@etag_cached('data_preview2', get_data_version)
+def preview_data2():
+    """预览数据 - 按设备统计数据概况"""
+    try:
+        # 按设备统计数据概况（有共享数据快照时直接在内存映射数组上统计，不构建完整的DataFrame）
+        response = summarize_data()
 
         # 返回成功的JSON响应，包含状态和预览数据
         return jsonify({
@@ -429,6 +594,13 @@ def preview_data2():
             "message": str(e)
         }), 500
 
+@app.route('/api/profiles/<name>', methods=['GET'])
+def download_profile(name):
+    """下载保存的性能分析文件"""
+    if not is_trusted_caller():
+        return jsonify({'error': '无权使用性能分析'}), 403
+    return send_from_directory(PROFILE_DIR, name, as_attachment=True)
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查接口"""
@@ -444,9 +616,22 @@ if __name__ == '__main__':
     print("API文档:")
     print("  GET  /api/health        - 健康检查")
     print("  GET  /api/models        - 获取可用模型")
+    print("  GET  /api/model/<model_id>/parameters - 获取模型参数配置")
     print("  POST /api/forecast      - 完整的训练和预测流程")
+    print("  POST /api/forecast/hierarchical - 按ci_type分层的聚合预测")
+    print("  POST /api/forecast/batch - 批量指数平滑（一次预测全部设备）")
+    print("  GET  /api/forecast/store - 预测存储和后台预计算状态")
+    print("  POST /api/forecast/store/refresh - 数据导入后触发一轮预计算")
+    print("  GET  /api/admission     - 准入控制状态（执行成本、并发数和等待队列）")
+    print("  POST /api/analysis/autocorrelation - 批量ACF/PACF、季节周期检测和模型参数建议")
     print("  GET  /api/data/info     - 获取数据信息")
-    print("  GET  /api/data/preview  - 预览数据")
+    print("  GET  /api/data/preview2 - 按设备统计数据概况")
+    print("  GET  /api/data/series   - 按频率和时间范围读取设备汇总数据")
+    print("  GET  /api/metrics       - 运行指标(Prometheus格式)")
+    print("  POST /api/anomaly/score - 新观测值的异常检测")
+    print("  POST /api/fleet/screen  - 设备群趋势筛查与到达阈值时间排序")
+    print("  GET  /api/fleet/jobs/<job_id> - 筛查后排队的完整预测任务状态")
+    print("  GET  /api/profiles/<name> - 下载性能分析文件")
     print("\n数据文件: data/tb_metric_raw_free_space_ratio_202509161435.csv")
     print("专门用于存储空间使用率的ARIMA时间序列预测")
     
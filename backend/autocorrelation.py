@@ -0,0 +1,282 @@
+"""批量自相关分析与模型参数建议
+
+对 (设备数, 时间) 矩阵一次计算所有设备的：
+- ACF：每行去均值后补零做实数FFT，功率谱逆变换即为各滞后的自协方差，O(n log n)；
+- PACF：由ACF按 Durbin–Levinson 递推，在全部设备上同时进行，O(滞后数^2)；
+- 主季节周期：去线性趋势后ACF在 [min_period, max_period] 内突出度（峰值减去之前的最低点）
+  最高的局部极大值，持续性强的序列ACF缓慢衰减时的小波动不会被当作周期；若其约数位置的峰值接近
+  （不低于 SEASONAL_HARMONIC_RATIO 倍）则取较短的周期；与小时、天、周相差不超过
+  SEASONAL_SNAP_TOLERANCE 时对齐到该日历周期（噪声会使峰值位置偏移几个点）；
+- ARIMA 阶数：差分阶数 d 由向量化的ADF检验确定（不能拒绝单位根时差分，最多两次），
+  差分后PACF/ACF 从滞后1开始连续显著（且绝对值不低于 ORDER_MIN_CORR）的滞后数分别作为 p/q 的建议；
+  季节强度决定 P/D/Q。
+
+季节周期换算为各模型训练数据的粒度（ARIMA/AutoARIMA 为5分钟，批量指数平滑为1小时），
+超出模型参数范围时不建议季节项，改为建议使用日历协变量。建议值按 get_parameter_config
+的结构返回（default 替换为建议值），可直接作为前端的参数默认值。
+"""
+import os
+from collections import Counter
+import numpy as np
+import pandas as pd
+from scipy import fft
+
+# 显著性的分位数（约95%）；样本量大时几乎所有滞后都显著，p/q 只计入绝对值不低于 ORDER_MIN_CORR 的滞后
+ACF_Z = float(os.getenv('ACF_Z', 1.96))
+ORDER_MIN_CORR = float(os.getenv('ORDER_MIN_CORR', 0.1))
+# 季节峰值的最小ACF和最小突出度
+SEASONAL_MIN_ACF = float(os.getenv('SEASONAL_MIN_ACF', 0.2))
+SEASONAL_MIN_PROMINENCE = float(os.getenv('SEASONAL_MIN_PROMINENCE', 0.1))
+# 季节强度（去趋势ACF在周期处的值）超过该值时建议季节差分
+SEASONAL_DIFF_ACF = float(os.getenv('SEASONAL_DIFF_ACF', 0.6))
+# 约数位置的峰值不低于最高峰值的该比例时取较短的周期
+SEASONAL_HARMONIC_RATIO = float(os.getenv('SEASONAL_HARMONIC_RATIO', 0.8))
+# 检测到的周期与日历周期的相对差不超过该值时对齐
+SEASONAL_SNAP_TOLERANCE = float(os.getenv('SEASONAL_SNAP_TOLERANCE', 0.1))
+CALENDAR_PERIODS = (pd.Timedelta(hours=1), pd.Timedelta(days=1), pd.Timedelta(weeks=1))
+
+# ADF检验（含常数项）5%水平的临界值和增广滞后数
+ADF_CRITICAL = -2.86
+ADF_LAGS = 4
+
+# 各模型训练数据的粒度
+MODEL_STEPS = {
+    'arima': pd.Timedelta(minutes=5),
+    'auto_arima': pd.Timedelta(minutes=5),
+    'batch_ets': pd.Timedelta(hours=1)
+}
+# 各模型表示季节周期的参数
+SEASONAL_PARAMETERS = {'arima': 'seasonal_periods', 'auto_arima': 'season_length', 'batch_ets': 'seasonal_periods'}
+
+
+def acf_fft(matrix, max_lag):
+    """每行的自相关函数（有偏估计），返回 (行数, max_lag + 1)"""
+    values = np.asarray(matrix, dtype=np.float64)
+    n = values.shape[1]
+    centered = values - values.mean(axis=1, keepdims=True)
+    size = fft.next_fast_len(2 * n - 1, real=True)
+    spectrum = fft.rfft(centered, n=size, axis=1)
+    autocov = fft.irfft(spectrum * np.conj(spectrum), n=size, axis=1)[:, :max_lag + 1]
+    variance = autocov[:, :1]
+    return np.divide(autocov, variance, out=np.zeros_like(autocov), where=variance > 0)
+
+
+def pacf_durbin_levinson(acf, max_lag):
+    """由ACF按 Durbin–Levinson 递推每行的偏自相关函数，返回 (行数, max_lag + 1)"""
+    rows = len(acf)
+    pacf = np.zeros((rows, max_lag + 1))
+    pacf[:, 0] = 1.0
+    phi = np.zeros((rows, max_lag + 1))
+    variance = np.ones(rows)
+    for k in range(1, max_lag + 1):
+        numerator = acf[:, k] - np.sum(phi[:, 1:k] * acf[:, k - 1:0:-1], axis=1)
+        phi_kk = np.divide(numerator, variance, out=np.zeros(rows), where=variance > 1e-12)
+        phi[:, 1:k] = phi[:, 1:k] - phi_kk[:, np.newaxis] * phi[:, k - 1:0:-1]
+        phi[:, k] = phi_kk
+        variance = variance * (1 - phi_kk ** 2)
+        pacf[:, k] = phi_kk
+    return pacf
+
+
+def _detrend(matrix):
+    """去掉每行的线性趋势"""
+    t = np.arange(matrix.shape[1], dtype=np.float64)
+    t -= t.mean()
+    centered = matrix - matrix.mean(axis=1, keepdims=True)
+    slope = centered @ t / (t @ t)
+    return centered - slope[:, np.newaxis] * t
+
+
+def adf_statistic(matrix, lags=ADF_LAGS, chunk_rows=256):
+    """每行的ADF检验统计量（含常数项、lags 个增广差分滞后），按行分块批量求解最小二乘"""
+    values = np.asarray(matrix, dtype=np.float64)
+    stats = np.empty(len(values))
+    for start in range(0, len(values), chunk_rows):
+        y = values[start:start + chunk_rows]
+        diff = np.diff(y, axis=1)
+        target = diff[:, lags:]
+        columns = [np.ones_like(target), y[:, lags:-1]]
+        columns += [diff[:, lags - i:-i] for i in range(1, lags + 1)]
+        design = np.stack(columns, axis=2)
+        xtx = np.einsum('rnk,rnl->rkl', design, design)
+        xty = np.einsum('rnk,rn->rk', design, target)
+        inverse = np.linalg.pinv(xtx)
+        beta = np.einsum('rkl,rl->rk', inverse, xty)
+        residual = target - np.einsum('rnk,rk->rn', design, beta)
+        sigma2 = (residual ** 2).sum(axis=1) / max(target.shape[1] - design.shape[2], 1)
+        stderr = np.sqrt(np.maximum(sigma2 * inverse[:, 1, 1], 1e-300))
+        stats[start:start + chunk_rows] = beta[:, 1] / stderr
+    return stats
+
+
+def _leading_significant(values, threshold, limit):
+    """从滞后1开始连续显著的滞后数，不超过 limit"""
+    significant = np.abs(values[:, 1:limit + 1]) > threshold
+    return np.where(significant.all(axis=1), limit, np.argmin(significant, axis=1))
+
+
+def seasonal_periods(acf, min_period, max_period, threshold):
+    """每行的主季节周期和强度，没有显著周期时为 (0, 0.0)"""
+    periods = np.zeros(len(acf), dtype=int)
+    strengths = np.zeros(len(acf))
+    max_period = min(max_period, acf.shape[1] - 2)
+    if max_period < min_period:
+        return periods, strengths
+    lags = np.arange(min_period, max_period + 1)
+    center = acf[:, lags]
+    # 突出度：峰值减去滞后1到该滞后之间ACF的最低点
+    prominence = center - np.minimum.accumulate(acf[:, 1:max_period + 1], axis=1)[:, min_period - 1:]
+    peaks = ((center > acf[:, lags - 1]) & (center >= acf[:, lags + 1]) & (center > threshold)
+             & (prominence >= SEASONAL_MIN_PROMINENCE))
+    scores = np.where(peaks, prominence, -np.inf)
+    for row in np.flatnonzero(peaks.any(axis=1)):
+        best = lags[np.argmax(scores[row])]
+        # 较短周期的整数倍位置同样出现峰值，取较短的周期（例如日周期的第2、3个峰）
+        for divisor in range(min(int(best // min_period), 12), 1, -1):
+            candidate = int(round(best / divisor))
+            low = max(candidate - 1, min_period)
+            window = scores[row, low - min_period:candidate + 2 - min_period]
+            if window.size and window.max() >= SEASONAL_HARMONIC_RATIO * scores[row, best - min_period]:
+                best = low + int(np.argmax(window))
+                break
+        periods[row] = best
+        strengths[row] = acf[row, best]
+    return periods, strengths
+
+
+def snap_calendar(periods, strengths, acf, step):
+    """把接近小时、天、周的周期对齐到日历周期，原地修改并返回 (周期, 强度)"""
+    for period in CALENDAR_PERIODS:
+        target = period / pd.Timedelta(step)
+        if target < 2 or target != int(target) or target >= acf.shape[1]:
+            continue
+        target = int(target)
+        close = (periods > 0) & (np.abs(periods - target) <= SEASONAL_SNAP_TOLERANCE * target)
+        periods[close] = target
+        strengths[close] = acf[close, target]
+    return periods, strengths
+
+
+def analyze(matrix, step, max_lag=None, pacf_lags=40, min_period=2, max_period=None, max_order=5):
+    """分析 (设备数, 时间) 矩阵的每一行，返回每行的统计和建议阶数"""
+    values = np.asarray(matrix, dtype=np.float64)
+    n = values.shape[1]
+    max_period = int(max_period or n // 3)
+    max_lag = int(min(max_lag or max(max_period + 1, pacf_lags), n - 2))
+    pacf_lags = min(int(pacf_lags), max_lag)
+    threshold = ACF_Z / np.sqrt(n)
+
+    # 不能拒绝单位根时差分（一次差分后仍不能拒绝时再差分一次）
+    diff1 = np.diff(values, axis=1)
+    diff1_acf = acf_fft(diff1, max_lag)
+    d = np.where(adf_statistic(values) > ADF_CRITICAL,
+                 np.where(adf_statistic(diff1) > ADF_CRITICAL, 2, 1), 0)
+
+    # d 阶差分后的ACF/PACF，用于 p/q
+    acf = np.where((d == 0)[:, np.newaxis], acf_fft(values, max_lag), diff1_acf)
+    if (d == 2).any():
+        acf[d == 2] = acf_fft(np.diff(diff1[d == 2], axis=1), max_lag)
+    pacf = pacf_durbin_levinson(acf, pacf_lags)
+    p = _leading_significant(pacf, max(threshold, ORDER_MIN_CORR), max_order)
+    q = _leading_significant(acf, max(threshold, ORDER_MIN_CORR), max_order)
+
+    # 季节周期在去趋势的水平序列上检测（差分会削弱周期较长的平滑季节性）
+    seasonal_acf = acf_fft(_detrend(values), max_lag)
+    periods, strengths = seasonal_periods(seasonal_acf, max(int(min_period), 2), max_period,
+                                          max(threshold, SEASONAL_MIN_ACF))
+    periods, strengths = snap_calendar(periods, strengths, seasonal_acf, step)
+    return {
+        'acf': acf, 'pacf': pacf, 'seasonal_acf': seasonal_acf, 'threshold': threshold,
+        'p': p, 'd': d, 'q': q, 'period': periods, 'strength': strengths, 'step': pd.Timedelta(step)
+    }
+
+
+def _clamp(config, value):
+    low, high = getattr(config, 'min', None), getattr(config, 'max', None)
+    if low is not None:
+        value = max(value, low)
+    if high is not None:
+        value = min(value, high)
+    return value
+
+
+def _model_period(period, step, model_type):
+    """把分析粒度下的周期换算为模型训练数据的点数，不能整除时返回0"""
+    if not period:
+        return 0
+    points = period * step / MODEL_STEPS[model_type]
+    return int(round(points)) if points >= 1 and abs(points - round(points)) < 0.05 * points else 0
+
+
+def suggest(result, index, model_manager):
+    """第 index 行的各模型参数建议：{模型: {参数: 建议值}} 和说明"""
+    p, d, q = int(result['p'][index]), int(result['d'][index]), int(result['q'][index])
+    period, strength = int(result['period'][index]), float(result['strength'][index])
+    step = result['step']
+    # 季节强度高时季节差分加季节MA（航空模型的形式），较弱时只用季节AR
+    seasonal = (0, 1, 1) if strength >= SEASONAL_DIFF_ACF else (1, 0, 0)
+    suggestions, notes = {}, []
+
+    for model_type in MODEL_STEPS:
+        model_obj = model_manager.get_model(model_type)
+        if model_obj is None:
+            continue
+        config = model_obj.get_parameter_config()
+        points = _model_period(period, step, model_type)
+        key = SEASONAL_PARAMETERS[model_type]
+        fits = points and points >= getattr(config[key], 'min', 1) and points <= getattr(config[key], 'max', points)
+        if period and not fits:
+            notes.append(f"{model_type}: 周期 {period * step} 换算为 {points or '非整数'} 个点，超出 {key} 的范围"
+                         f"{'，建议使用日历协变量表达' if 'use_covariates' in config else ''}")
+
+        values = {}
+        if model_type == 'arima':
+            values.update(p=p, d=d, q=q)
+            P, D, Q = seasonal if fits else (0, 0, 0)
+            values.update(seasonal_order_P=P, seasonal_order_D=D, seasonal_order_Q=Q)
+            if fits:
+                values['seasonal_periods'] = points
+        elif model_type == 'auto_arima':
+            values['season_length'] = points if fits else 1
+        elif model_type == 'batch_ets':
+            values['mode'] = 'holt_winters' if fits else ('holt' if d else 'simple')
+            if fits:
+                values['seasonal_periods'] = points
+        if period and not fits and 'use_covariates' in config:
+            values['use_covariates'] = True
+        suggestions[model_type] = {name: _clamp(config[name], value) if config[name].type == 'number' else value
+                                   for name, value in values.items() if name in config}
+    return suggestions, notes
+
+
+def consensus(per_device):
+    """多个设备建议的共同值：数值取中位数，其他取众数"""
+    merged = {}
+    for suggestions in per_device:
+        for model_type, values in suggestions.items():
+            for name, value in values.items():
+                merged.setdefault(model_type, {}).setdefault(name, []).append(value)
+    result = {}
+    for model_type, values in merged.items():
+        result[model_type] = {}
+        for name, items in values.items():
+            if all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in items):
+                result[model_type][name] = int(np.median(items))
+            else:
+                result[model_type][name] = Counter(items).most_common(1)[0][0]
+    return result
+
+
+def parameter_configs(suggestions, model_manager):
+    """按 get_parameter_config 的结构返回参数配置，default 替换为建议值"""
+    configs = {}
+    for model_type, values in suggestions.items():
+        config = model_manager.get_model(model_type).get_parameter_config()
+        configs[model_type] = {}
+        for name, item in config.items():
+            entry = item.to_dict()
+            if name in values:
+                entry['default'] = values[name]
+                entry['suggested'] = True
+            configs[model_type][name] = entry
+    return configs
@@ -0,0 +1,257 @@
+"""性能基准测试
+
+在不同规模（设备数 × 每设备数据点数）的合成数据上测量数据加载、数据准备、
+数据预览以及 ModelManager 中每个已注册模型的训练/预测耗时和内存峰值，
+并比较 float32 与 float64 序列模式的汇总内存和预测精度。
+结果保存为JSON，并可与保存的基线对比，超过阈值时以非零状态退出。
+完全离线运行，只使用CPU。
+
+用法示例:
+    python benchmark.py --sizes 5x2016,50x8640 --output bench.json
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json --threshold 1.3
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# 基准测试不使用共享快照，每次都测量真实的CSV加载开销
+os.environ.pop('DATA_SNAPSHOT_DIR', None)
+
+from models.model_manager import ModelManager
+from metric_series import load_metric_data, prepare_arima_data, summarize_data
+from data_store import read_csv_data, clear_caches
+from rollups import RollupSet, ROLLUP_FIELDS
+from utils import DataGenerator, ModelEvaluator
+
+DEFAULT_SIZES = '5x2016,20x8640'
+# 直接使用模型管理器，不导入Flask应用（避免启动后台预测调度和共享存储）
+model_manager = ModelManager()
+
+
+def parse_sizes(text):
+    """解析形如 '5x2016,20x8640' 的规模列表"""
+    sizes = []
+    for item in text.split(','):
+        devices, points = item.lower().split('x')
+        sizes.append((int(devices), int(points)))
+    return sizes
+
+
+def generate_dataset(data_dir, devices, points, seed=42):
+    """生成 tb_metric_raw 格式的合成数据（5分钟粒度，含缺失和-2连接失败记录）"""
+    return DataGenerator.generate_fleet_data(
+        os.path.join(data_dir, 'tb_metric_raw_benchmark.csv'),
+        n_devices=devices, points_per_device=points, seed=seed)
+
+
+def measure(func, repeat, setup=None):
+    """多次运行取耗时中位数和最小值，再单独运行一次统计内存峰值
+
+    setup 在每次运行前调用且不计入耗时，例如清空数据缓存使每次都测量冷加载。
+    """
+    durations = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, {
+        'seconds': float(np.median(durations)),
+        'min_seconds': float(np.min(durations)),
+        'peak_mb': round(peak / 1024 / 1024, 3)
+    }
+
+
+def run_size(devices, points, args):
+    """在一个数据规模上运行全部基准项"""
+    size = f'{devices}x{points}'
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        rows = generate_dataset(data_dir, devices, points, args.seed)
+        os.environ['DATA_DIR'] = data_dir
+        print(f"\n== 数据规模 {size} ({rows} 行) ==")
+
+        def record(case, metrics, **extra):
+            entry = {'case': case, 'size': size, 'rows': rows, **metrics, **extra}
+            results.append(entry)
+            print(f"  {case:<32} {metrics['seconds']:>9.4f}s  峰值 {metrics['peak_mb']:>9.2f} MB")
+
+        # 每次重复前清空文件索引、快照和汇总缓存，否则除第一次外测到的都是缓存命中
+        cold = lambda: clear_caches(remove_index_files=True)
+        (series, _), metrics = measure(load_metric_data, args.repeat, cold)
+        record('load_metric_data', metrics)
+
+        (train, val), metrics = measure(lambda: prepare_arima_data(series), args.repeat)
+        record('prepare_arima_data', metrics)
+
+        _, metrics = measure(summarize_data, args.repeat, cold)
+        record('preview_data2', metrics)
+
+        # 训练集截取末尾部分，避免大规模下模型训练时间失控
+        train = train[-args.max_train_points:]
+        for name, model_obj in model_manager.models.items():
+            if args.models and name not in args.models:
+                continue
+            try:
+                model, metrics = measure(lambda: model_obj.fit(model_obj.create_model(), train), args.repeat)
+                record(f'model:{name}:fit', metrics, train_points=len(train))
+                _, metrics = measure(lambda: model_obj.predict(model, args.periods), args.repeat)
+                record(f'model:{name}:predict', metrics, periods=args.periods)
+            except Exception as e:
+                print(f"  model:{name} 运行失败: {e}")
+                results.append({'case': f'model:{name}:fit', 'size': size, 'rows': rows, 'error': str(e)})
+
+        if not args.skip_dtype_compare:
+            compare_dtypes(read_csv_data(), train, val, args, record, results)
+    return results
+
+
+def rollup_megabytes(rollups):
+    """汇总数组占用的内存（MB）"""
+    total = sum(np.asarray(getattr(rollup, field)).nbytes
+                for rollup in rollups.levels.values() for field in ROLLUP_FIELDS)
+    return round(total / 1024 / 1024, 3)
+
+
+def compare_dtypes(df, train, val, args, record, results):
+    """比较 float32 与 float64 模式：汇总数据的常驻内存，以及每个模型的预测差异和验证集指标
+
+    两种模式使用相同的训练数据，只改变序列的数值类型，float32 的结果中记录与 float64 预测的最大绝对/相对差。
+    """
+    dtypes = (np.dtype(np.float64), np.dtype(np.float32))
+    for dtype in dtypes:
+        rollups, metrics = measure(lambda: RollupSet.build(df, 'benchmark', dtype), 1)
+        record(f'dtype:rollups:{dtype.name}', metrics, resident_mb=rollup_megabytes(rollups))
+
+    periods = min(args.periods, len(val))
+    if periods == 0:
+        return
+    actual = val[:periods].values().flatten().astype(np.float64)
+    for name, model_obj in model_manager.models.items():
+        if args.models and name not in args.models:
+            continue
+        reference = None
+        for dtype in dtypes:
+            series = train.astype(dtype)
+            try:
+                (forecast, _), metrics = measure(lambda: model_obj.cast_result(
+                    model_obj.predict(model_obj.fit(model_obj.create_model(), series), periods), dtype), 1)
+            except Exception as e:
+                print(f"  dtype:{name}:{dtype.name} 运行失败: {e}")
+                results.append({'case': f'dtype:{name}:{dtype.name}', 'error': str(e)})
+                break
+            values = forecast.values().flatten().astype(np.float64)
+            scores = ModelEvaluator.metrics_to_dict(ModelEvaluator.batch_metrics(actual, values))
+            extra = {'series_mb': round(series.values(copy=False).nbytes / 1024 / 1024, 4),
+                     'mape': scores.get('mape'), 'rmse': scores.get('rmse')}
+            if reference is None:
+                reference = values
+            else:
+                diff = np.abs(values - reference)
+                extra['max_abs_diff'] = float(np.max(diff))
+                extra['max_rel_diff'] = float(np.max(diff / np.maximum(np.abs(reference), 1e-12)))
+            record(f'dtype:{name}:{dtype.name}', metrics, **extra)
+
+
+def environment_info():
+    """记录运行环境，便于比较不同机器上的结果"""
+    info = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__
+    }
+    try:
+        import darts
+        info['darts'] = darts.__version__
+    except (ImportError, AttributeError):
+        pass
+    return info
+
+
+def compare_with_baseline(results, baseline, threshold, memory_threshold):
+    """与基线对比，返回超过阈值的退化项列表"""
+    baseline_index = {(r['case'], r['size']): r for r in baseline.get('results', []) if 'error' not in r}
+    regressions = []
+    print(f"\n== 与基线对比 (耗时阈值 x{threshold}, 内存阈值 x{memory_threshold}) ==")
+    for result in results:
+        base = baseline_index.get((result['case'], result['size']))
+        if base is None or 'error' in result:
+            continue
+        time_ratio = result['seconds'] / base['seconds'] if base['seconds'] > 0 else 1.0
+        memory_ratio = result['peak_mb'] / base['peak_mb'] if base['peak_mb'] > 0 else 1.0
+        status = 'ok'
+        if time_ratio > threshold or memory_ratio > memory_threshold:
+            status = 'REGRESSION'
+            regressions.append({**result, 'time_ratio': time_ratio, 'memory_ratio': memory_ratio})
+        print(f"  {result['case']:<32} {result['size']:<12} 耗时 x{time_ratio:.2f}  内存 x{memory_ratio:.2f}  {status}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='存储空间使用率预测系统性能基准测试')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='数据规模列表，格式为 设备数x每设备点数，逗号分隔')
+    parser.add_argument('--models', nargs='*', help='只测试指定的模型（默认全部已注册模型）')
+    parser.add_argument('--repeat', type=int, default=3, help='每项重复次数（取中位数）')
+    parser.add_argument('--periods', type=int, default=24, help='预测步数')
+    parser.add_argument('--max-train-points', type=int, default=2000, help='模型训练使用的最大数据点数')
+    parser.add_argument('--seed', type=int, default=42, help='合成数据随机种子')
+    parser.add_argument('--skip-dtype-compare', action='store_true', help='不比较 float32 与 float64 模式')
+    parser.add_argument('--output', default='benchmark_results.json', help='结果输出文件')
+    parser.add_argument('--baseline', help='对比的基线文件')
+    parser.add_argument('--save-baseline', help='将本次结果另存为基线文件')
+    parser.add_argument('--threshold', type=float, default=1.25, help='耗时退化阈值（相对基线的倍数）')
+    parser.add_argument('--memory-threshold', type=float, default=1.25, help='内存峰值退化阈值（相对基线的倍数）')
+    args = parser.parse_args(argv)
+
+    results = []
+    for devices, points in parse_sizes(args.sizes):
+        results.extend(run_size(devices, points, args))
+
+    report = {'environment': environment_info(), 'config': vars(args), 'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存: {args.output}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存: {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.threshold, args.memory_threshold)
+        if regressions:
+            print(f"\n发现 {len(regressions)} 项性能退化")
+            return 1
+        print("\n未发现性能退化")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
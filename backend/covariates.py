@@ -0,0 +1,134 @@
+"""日历和节假日协变量
+
+协变量只取决于时间（与设备无关），因此按频率生成一次并缓存在进程内存中：
+第一次请求时覆盖请求范围所在的整年，之后的请求只需在缓存的数组上按时间二分查找切片；
+请求超出缓存范围时按整年扩展后重新生成。切片结果再按 (频率, 起止时间) 做LRU缓存，
+相同时间范围的请求（例如同一数据版本下的不同设备）直接复用同一个 TimeSeries。
+
+可用的协变量：
+- hour: 一天内的小时，sin/cos 编码
+- dayofweek: 星期几，sin/cos 编码
+- weekend: 是否周末
+- holiday: 是否法定节假日（需要 holidays 包，国家由 COVARIATE_HOLIDAY_COUNTRY 指定）
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from darts import TimeSeries
+from loguru import logger
+from metrics import record_cache
+from precision import SERIES_DTYPE
+
+try:
+    import holidays
+except ImportError:  # holidays 为 darts 的依赖，通常已安装
+    holidays = None
+
+# 默认生成的协变量，逗号分隔
+FORECAST_COVARIATES = os.getenv('FORECAST_COVARIATES', 'hour,dayofweek,weekend,holiday')
+# 节假日所属国家或地区代码
+COVARIATE_HOLIDAY_COUNTRY = os.getenv('COVARIATE_HOLIDAY_COUNTRY', 'CN')
+# 缓存的切片数
+COVARIATE_CACHE_SIZE = int(os.getenv('COVARIATE_CACHE_SIZE', 64))
+
+COVARIATE_NAMES = ('hour', 'dayofweek', 'weekend', 'holiday')
+
+
+def _cyclic(values, period, name):
+    angle = 2 * np.pi * np.asarray(values, dtype=np.float64) / period
+    return {f'{name}_sin': np.sin(angle), f'{name}_cos': np.cos(angle)}
+
+
+def calendar_features(times, names, country=COVARIATE_HOLIDAY_COUNTRY):
+    """为时间轴生成协变量，返回 {列名: 数组}"""
+    columns = {}
+    for name in names:
+        if name == 'hour':
+            columns.update(_cyclic(times.hour + times.minute / 60, 24, 'hour'))
+        elif name == 'dayofweek':
+            columns.update(_cyclic(times.dayofweek, 7, 'dayofweek'))
+        elif name == 'weekend':
+            columns['weekend'] = (times.dayofweek >= 5).astype(np.float64)
+        elif name == 'holiday':
+            if holidays is None:
+                logger.warning("未安装 holidays 包，跳过节假日协变量")
+                continue
+            calendar = holidays.country_holidays(country, years=range(times.year.min(), times.year.max() + 1))
+            days = times.normalize()
+            unique_days = days.unique()
+            flags = np.array([day in calendar for day in unique_days], dtype=np.float64)
+            columns['holiday'] = flags[unique_days.get_indexer(days)]
+        else:
+            raise ValueError(f"不支持的协变量: {name}，可选: {', '.join(COVARIATE_NAMES)}")
+    return columns
+
+
+class CovariateService:
+    """按频率缓存协变量，为每个请求切出需要的时间范围"""
+
+    def __init__(self, names=None, country=COVARIATE_HOLIDAY_COUNTRY, cache_size=COVARIATE_CACHE_SIZE):
+        names = FORECAST_COVARIATES if names is None else names
+        if isinstance(names, str):
+            names = [name.strip() for name in names.split(',') if name.strip()]
+        self.names = tuple(names)
+        self.country = country
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        # (频率, 相位) -> (时间轴, 列名, 数值矩阵)
+        self._tables = {}
+        self._slices = OrderedDict()
+
+    def _table(self, freq, start, end):
+        """返回覆盖 [start, end] 的协变量表，必要时按整年扩展并重新生成
+
+        固定步长的频率按 start 的相位对齐（例如从 00:03 开始的5分钟序列），保证切片的时间点与序列一致。
+        """
+        offset = pd.tseries.frequencies.to_offset(freq)
+        step = pd.Timedelta(offset) if isinstance(offset, pd.offsets.Tick) else None
+        phase = start.value % step.value if step is not None else 0
+        table = self._tables.get((freq, phase))
+        if table is not None and table[0][0] <= start and table[0][-1] >= end:
+            return table
+        if table is not None:
+            start, end = min(start, table[0][0]), max(end, table[0][-1])
+        first = pd.Timestamp(year=start.year, month=1, day=1)
+        if step is not None:
+            first = start - (start - first) // step * step
+        times = pd.date_range(first, pd.Timestamp(year=end.year + 1, month=1, day=1), freq=offset, inclusive='left')
+        columns = calendar_features(times, self.names, self.country)
+        table = (times, list(columns), np.column_stack(list(columns.values())).astype(SERIES_DTYPE))
+        self._tables[(freq, phase)] = table
+        logger.info(f"协变量已生成: 频率 {freq}, {times[0]} ~ {times[-1]}, {len(table[1])} 列")
+        return table
+
+    def get(self, freq, start, end):
+        """返回 [start, end] 范围内、指定频率的协变量 TimeSeries"""
+        freq = pd.tseries.frequencies.to_offset(freq).freqstr
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        key = (freq, start, end)
+        with self._lock:
+            cached = self._slices.get(key)
+            record_cache('covariates', cached is not None)
+            if cached is not None:
+                self._slices.move_to_end(key)
+                return cached
+
+            times, columns, values = self._table(freq, start, end)
+            lo = times.searchsorted(start, side='left')
+            hi = times.searchsorted(end, side='right')
+            series = TimeSeries.from_times_and_values(times[lo:hi], values[lo:hi], columns=columns, freq=freq)
+            self._slices[key] = series
+            while len(self._slices) > self.cache_size:
+                self._slices.popitem(last=False)
+            return series
+
+    def for_series(self, series, horizon):
+        """覆盖训练序列及其后 horizon 步预测范围的协变量"""
+        end = series.end_time() + series.freq * horizon
+        return self.get(series.freq, series.start_time(), end)
+
+
+# 全局协变量服务，所有请求共享缓存
+covariate_service = CovariateService()
@@ -0,0 +1,548 @@
+import os
+import io
+import glob
+import json
+import tempfile
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from loguru import logger
+import threading
+from metrics import record_cache, DATA_BYTES_READ
+from rollups import RollupSet
+from precision import SERIES_DTYPE
+
+# 快照文件格式版本，格式变化时递增，旧快照会被忽略
+SNAPSHOT_FORMAT_VERSION = 2
+
+# CSV文件分块索引：每块的行数和索引保存目录
+INDEX_BLOCK_ROWS = int(os.getenv('DATA_INDEX_BLOCK_ROWS', 50000))
+DATA_INDEX_DIR = os.getenv('DATA_INDEX_DIR', os.path.join(tempfile.gettempdir(), 'darts_data_index'))
+# 索引格式版本，格式变化时递增
+INDEX_FORMAT_VERSION = 1
+
+
+def get_data_dir():
+    """获取数据目录，支持容器内部路径和本地开发路径"""
+    data_dir = os.getenv('DATA_DIR', '/app/data')
+    if not os.path.exists(data_dir):
+        # 如果容器内路径不存在，尝试本地开发路径
+        local_data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+        if os.path.exists(local_data_dir):
+            data_dir = local_data_dir
+        else:
+            raise FileNotFoundError(f"数据目录不存在: {data_dir} 和 {local_data_dir}")
+    return data_dir
+
+
+def list_data_files(data_dir=None):
+    """列出数据目录下的所有CSV文件（按文件名排序，保证结果稳定）"""
+    data_dir = data_dir or get_data_dir()
+    csv_files = sorted(glob.glob(os.path.join(data_dir, '*.csv')))
+    if not csv_files:
+        raise FileNotFoundError(f"data目录中没有找到CSV文件: {data_dir}")
+    return csv_files
+
+
+def get_data_version(data_dir=None):
+    """根据文件集合、修改时间和大小计算数据版本号，数据文件变化时版本号随之变化"""
+    digest = hashlib.sha1()
+    for file_path in list_data_files(data_dir):
+        stat = os.stat(file_path)
+        digest.update(f"{os.path.basename(file_path)}:{stat.st_mtime_ns}:{stat.st_size};".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def _time_bound(value, default):
+    """把时间范围参数转换为纳秒时间戳，未指定时返回默认值"""
+    return pd.Timestamp(value).value if value is not None else default
+
+
+def _scan_row_offsets(file_path, chunk_bytes=8 * 1024 * 1024):
+    """流式扫描文件中的换行符，返回 (表头结束位置, 每 INDEX_BLOCK_ROWS 行的起始偏移, 行数, 文件大小)"""
+    header_end = None
+    block_starts = []
+    newline_count = 0
+    rows = 0
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        position = 0
+        while position < size:
+            chunk = f.read(min(chunk_bytes, size - position))
+            if not chunk:
+                break
+            newlines = position + np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            if header_end is None and len(newlines):
+                header_end = int(newlines[0]) + 1
+            # 第 i 个换行符（从0开始，第0个为表头结尾）之后是第 i 行数据的起点，文件末尾之后不算
+            row_starts = newlines + 1
+            row_index = newline_count + np.arange(len(newlines))
+            has_row = row_starts < size
+            rows += int(np.count_nonzero(has_row))
+            block_starts.extend(row_starts[has_row & (row_index % INDEX_BLOCK_ROWS == 0)].tolist())
+            newline_count += len(newlines)
+            position += len(chunk)
+    return (header_end if header_end is not None else size), block_starts, rows, size
+
+
+def build_file_index(file_path):
+    """扫描一个CSV文件，按 INDEX_BLOCK_ROWS 行分块记录每块的字节偏移和最小/最大时间
+
+    类似Parquet的row group统计信息，按时间范围读取时只需读取与范围重叠的块。
+    字节偏移和时间统计都按块流式计算，内存占用与文件大小无关。
+    文件中存在无法按行定位的内容（如字段内换行、空行）时整个文件作为一块。
+    """
+    header_end, block_starts, rows, size = _scan_row_offsets(file_path)
+
+    block_min, block_max = [], []
+    parsed_rows = 0
+    for chunk in pd.read_csv(file_path, usecols=['time'], chunksize=INDEX_BLOCK_ROWS):
+        times = pd.to_datetime(chunk['time']).values.astype('datetime64[ns]')
+        valid = times[~np.isnat(times)].astype(np.int64)
+        block_min.append(int(valid.min()) if len(valid) else np.iinfo(np.int64).max)
+        block_max.append(int(valid.max()) if len(valid) else np.iinfo(np.int64).min)
+        parsed_rows += len(chunk)
+
+    if parsed_rows != rows or parsed_rows == 0 or len(block_starts) != len(block_min):
+        block_starts = [header_end]
+        block_min = [min(block_min, default=np.iinfo(np.int64).max)]
+        block_max = [max(block_max, default=np.iinfo(np.int64).min)]
+
+    stat = os.stat(file_path)
+    return {
+        'format': INDEX_FORMAT_VERSION,
+        'path': os.path.abspath(file_path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'rows': int(parsed_rows),
+        'header_end': header_end,
+        'offsets': block_starts + [size],
+        'min': block_min,
+        'max': block_max
+    }
+
+
+# 进程内缓存的文件索引
+_file_indexes = {}
+
+
+def _index_file_path(path):
+    """索引目录中保存该数据文件索引的路径"""
+    return os.path.join(DATA_INDEX_DIR, hashlib.sha1(path.encode('utf-8')).hexdigest()[:16] + '.json')
+
+
+def get_file_index(file_path):
+    """获取文件的分块索引：优先使用内存和索引目录中的缓存，文件变化后重新扫描"""
+    stat = os.stat(file_path)
+    path = os.path.abspath(file_path)
+
+    def is_current(index):
+        return index is not None and index.get('format') == INDEX_FORMAT_VERSION and \
+            index['mtime_ns'] == stat.st_mtime_ns and index['size'] == stat.st_size
+
+    index = _file_indexes.get(path)
+    if is_current(index):
+        record_cache('file_index', True)
+        return index
+
+    index_file = _index_file_path(path)
+    try:
+        with open(index_file, encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = None
+
+    hit = is_current(index)
+    record_cache('file_index', hit)
+    if not hit:
+        index = build_file_index(file_path)
+        try:
+            os.makedirs(DATA_INDEX_DIR, exist_ok=True)
+            tmp_file = f"{index_file}.tmp{os.getpid()}"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(index, f)
+            os.replace(tmp_file, index_file)
+        except OSError as e:
+            logger.warning(f"无法保存文件索引 {index_file}: {e}")
+    _file_indexes[path] = index
+    return index
+
+
+def read_csv_range(file_path, start=None, end=None):
+    """只读取文件中与 [start, end] 时间范围重叠的块，文件与范围不重叠时返回None"""
+    index = get_file_index(file_path)
+    start_ns = _time_bound(start, np.iinfo(np.int64).min)
+    end_ns = _time_bound(end, np.iinfo(np.int64).max)
+    block_min = np.asarray(index['min'], dtype=np.int64)
+    block_max = np.asarray(index['max'], dtype=np.int64)
+    overlap = np.flatnonzero((block_max >= start_ns) & (block_min <= end_ns))
+    if len(overlap) == 0:
+        return None
+
+    # 相邻的块合并为一次连续读取
+    offsets = index['offsets']
+    runs = np.split(overlap, np.flatnonzero(np.diff(overlap) > 1) + 1)
+    with open(file_path, 'rb') as f:
+        header = f.read(index['header_end'])
+        pieces = [header]
+        for run in runs:
+            f.seek(offsets[run[0]])
+            pieces.append(f.read(offsets[run[-1] + 1] - offsets[run[0]]))
+    DATA_BYTES_READ.inc(sum(len(piece) for piece in pieces), mode='range')
+    return pd.read_csv(io.BytesIO(b''.join(pieces)), dtype={'value': SERIES_DTYPE})
+
+
+def read_csv_data(data_dir=None, start=None, end=None):
+    """读取并合并数据目录下的所有CSV文件，增加datetime列
+
+    指定 start/end 时按文件分块索引跳过与时间范围不重叠的文件和块，只读取重叠部分，
+    结果只包含范围内的记录。
+    """
+    ranged = start is not None or end is not None
+    all_data = []
+    for file_path in list_data_files(data_dir):
+        try:
+            if ranged:
+                df = read_csv_range(file_path, start, end)
+                if df is None:
+                    continue
+            else:
+                df = pd.read_csv(file_path, dtype={'value': SERIES_DTYPE})
+                DATA_BYTES_READ.inc(os.path.getsize(file_path), mode='full')
+            all_data.append(df)
+        except Exception as e:
+            logger.warning(f"无法读取文件 {file_path}: {e}")
+
+    if not all_data:
+        if ranged:
+            return pd.DataFrame({'ci_id': [], 'ci_type': [], 'code': [], 'time': [],
+                                 'value': np.zeros(0, dtype=SERIES_DTYPE),
+                                 'datetime': pd.to_datetime([])})
+        raise FileNotFoundError("没有成功读取任何CSV文件")
+
+    # 合并所有数据
+    df = pd.concat(all_data, ignore_index=True)
+
+    # 转换时间列
+    df['datetime'] = pd.to_datetime(df['time'])
+    if ranged:
+        df = df[df['datetime'].between(pd.Timestamp(start) if start is not None else df['datetime'].min(),
+                                       pd.Timestamp(end) if end is not None else df['datetime'].max())]
+        df = df.reset_index(drop=True)
+    return df
+
+
+def get_data_time_range():
+    """整个数据集的 (最早, 最晚) 时间，来自快照或文件分块索引，不读取数据本身"""
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.time_range()
+    lows, highs = [], []
+    for file_path in list_data_files():
+        index = get_file_index(file_path)
+        if index['rows']:
+            lows.append(min(index['min']))
+            highs.append(max(index['max']))
+    if not lows:
+        return None, None
+    return pd.Timestamp(min(lows)), pd.Timestamp(max(highs))
+
+
+def _to_json_scalar(value):
+    """将numpy标量转换为可JSON序列化的Python对象"""
+    return value.item() if hasattr(value, 'item') else value
+
+
+class DataSnapshot:
+    """按设备整理好的只读数据快照
+
+    所有设备的数据按 (ci_id, 时间) 排序后拼接成两个连续数组（时间戳和数值），
+    以 .npy 文件保存并通过内存映射只读加载。多个worker进程映射同一组文件时共享
+    同一份物理内存页，增加worker数量不会成倍增加常驻内存。数值数组使用 SERIES_DTYPE 保存。
+    """
+
+    def __init__(self, path, version, times, values, devices, rollups=None):
+        self.path = path
+        self.rollups = rollups
+        self.version = version
+        self.times = times
+        self.values = values
+        self.devices = devices
+        self._device_index = {device['ci_id']: device for device in devices}
+
+    @classmethod
+    def publish(cls, df, snapshot_dir, version):
+        """将数据发布为快照，先写入版本目录再原子地切换CURRENT指针"""
+        df = df.sort_values(['ci_id', 'datetime'], kind='mergesort')
+        times = df['datetime'].values.astype('datetime64[ns]').astype(np.int64)
+        values = df['value'].to_numpy(dtype=SERIES_DTYPE)
+
+        # 计算每个设备在连续数组中的偏移量和长度
+        devices = []
+        ci_ids = df['ci_id'].to_numpy()
+        if len(ci_ids) > 0:
+            boundaries = np.flatnonzero(ci_ids[1:] != ci_ids[:-1]) + 1
+            starts = np.concatenate(([0], boundaries))
+            ends = np.concatenate((boundaries, [len(ci_ids)]))
+            ci_types = df['ci_type'].to_numpy()
+            codes = df['code'].to_numpy()
+            for start, end in zip(starts, ends):
+                devices.append({
+                    'ci_id': _to_json_scalar(ci_ids[start]),
+                    'ci_type': _to_json_scalar(ci_types[start]),
+                    'code': _to_json_scalar(codes[start]),
+                    'offset': int(start),
+                    'length': int(end - start)
+                })
+
+        version_dir = os.path.join(snapshot_dir, version)
+        tmp_dir = f"{version_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'times.npy'), times)
+        np.save(os.path.join(tmp_dir, 'values.npy'), values)
+        # 多分辨率汇总随快照一起发布，worker以内存映射方式共享
+        RollupSet.build(df, version, SERIES_DTYPE).save(os.path.join(tmp_dir, 'rollups'))
+        with open(os.path.join(tmp_dir, 'index.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'format': SNAPSHOT_FORMAT_VERSION,
+                'version': version,
+                'dtype': SERIES_DTYPE.name,
+                'devices': devices
+            }, f, ensure_ascii=False)
+
+        shutil.rmtree(version_dir, ignore_errors=True)
+        os.replace(tmp_dir, version_dir)
+
+        pointer_tmp = os.path.join(snapshot_dir, f"CURRENT.tmp{os.getpid()}")
+        with open(pointer_tmp, 'w', encoding='utf-8') as f:
+            f.write(version)
+        os.replace(pointer_tmp, os.path.join(snapshot_dir, 'CURRENT'))
+
+        # 清理旧版本（已映射旧文件的进程不受影响）
+        for name in os.listdir(snapshot_dir):
+            old_path = os.path.join(snapshot_dir, name)
+            if name != version and os.path.isdir(old_path) and '.tmp' not in name:
+                shutil.rmtree(old_path, ignore_errors=True)
+
+        logger.info(f"数据快照已发布: {version_dir} ({len(devices)} 个设备, {len(values)} 条记录)")
+        return cls.attach(snapshot_dir)
+
+    @classmethod
+    def attach(cls, snapshot_dir):
+        """以只读内存映射方式加载当前快照，快照不存在时返回None"""
+        pointer = os.path.join(snapshot_dir, 'CURRENT')
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer, encoding='utf-8') as f:
+            version = f.read().strip()
+        version_dir = os.path.join(snapshot_dir, version)
+        with open(os.path.join(version_dir, 'index.json'), encoding='utf-8') as f:
+            index = json.load(f)
+        # 数值类型与当前配置不同的快照视为不可用，需要重新发布
+        if index.get('format') != SNAPSHOT_FORMAT_VERSION or index.get('dtype', 'float64') != SERIES_DTYPE.name:
+            return None
+        times = np.load(os.path.join(version_dir, 'times.npy'), mmap_mode='r')
+        values = np.load(os.path.join(version_dir, 'values.npy'), mmap_mode='r')
+        rollups = RollupSet.load(os.path.join(version_dir, 'rollups'))
+        return cls(version_dir, index['version'], times, values, index['devices'], rollups)
+
+    def device_arrays(self, ci_id):
+        """返回指定设备的(时间戳, 数值)只读视图，不发生拷贝"""
+        device = self._device_index.get(ci_id)
+        if device is None:
+            return None, None
+        start = device['offset']
+        end = start + device['length']
+        return self.times[start:end], self.values[start:end]
+
+    def time_range(self):
+        """快照中的 (最早, 最晚) 时间，每个设备内按时间排序，只需比较各设备的首尾"""
+        if not self.devices:
+            return None, None
+        offsets = np.array([device['offset'] for device in self.devices], dtype=np.int64)
+        lengths = np.array([device['length'] for device in self.devices], dtype=np.int64)
+        return (pd.Timestamp(int(np.min(self.times[offsets]))),
+                pd.Timestamp(int(np.max(self.times[offsets + lengths - 1]))))
+
+    def device_stats(self):
+        """逐个设备直接在内存映射数组上统计概况，不构建完整的DataFrame
+
+        返回 [{ci_id, ci_type, code, start, end, records, abnormal, valid, mean, std}]，
+        abnormal 为 -2（连接失败）记录数，valid/mean/std 只基于 value > 0 的有效数据，时间为纳秒时间戳。
+        """
+        stats = []
+        for device in self.devices:
+            begin = device['offset']
+            end = begin + device['length']
+            values = self.values[begin:end]
+            valid = values[values > 0].astype(np.float64)
+            stats.append({
+                'ci_id': device['ci_id'],
+                'ci_type': device['ci_type'],
+                'code': device['code'],
+                'start': int(self.times[begin]),
+                'end': int(self.times[end - 1]),
+                'records': int(device['length']),
+                'abnormal': int(np.count_nonzero(values == -2)),
+                'valid': len(valid),
+                'mean': float(valid.mean()) if len(valid) else None,
+                'std': float(valid.std(ddof=1)) if len(valid) > 1 else 0.0
+            })
+        return stats
+
+    def _device_bounds(self, device, start_ns, end_ns):
+        """用二分查找确定设备在时间范围内的记录位置"""
+        begin = device['offset']
+        times = self.times[begin:begin + device['length']]
+        return (begin + int(np.searchsorted(times, start_ns, side='left')),
+                begin + int(np.searchsorted(times, end_ns, side='right')))
+
+    def to_frame(self, resource_id=None, start=None, end=None):
+        """将快照(或其中一个设备)还原为与CSV读取结果相同列结构的DataFrame
+
+        指定 start/end 时在每个设备内二分查找时间范围，只拷贝范围内的记录。
+        """
+        if resource_id is not None:
+            devices = [self._device_index[resource_id]] if resource_id in self._device_index else []
+        else:
+            devices = self.devices
+
+        if start is not None or end is not None:
+            start_ns = _time_bound(start, np.iinfo(np.int64).min)
+            end_ns = _time_bound(end, np.iinfo(np.int64).max)
+            bounds = [self._device_bounds(device, start_ns, end_ns) for device in devices]
+            lengths = np.array([hi - lo for lo, hi in bounds], dtype=np.int64)
+            positions = np.concatenate([np.arange(lo, hi) for lo, hi in bounds]) if bounds else \
+                np.zeros(0, dtype=np.int64)
+            times = self.times[positions]
+            values = self.values[positions]
+        else:
+            lengths = np.array([device['length'] for device in devices], dtype=np.int64)
+            if resource_id is not None and devices:
+                begin = devices[0]['offset']
+                times = self.times[begin:begin + devices[0]['length']]
+                values = self.values[begin:begin + devices[0]['length']]
+            else:
+                times = self.times
+                values = self.values
+
+        def repeat(key):
+            column = np.empty(len(devices), dtype=object)
+            column[:] = [device[key] for device in devices]
+            return np.repeat(column, lengths)
+
+        return pd.DataFrame({
+            'ci_id': repeat('ci_id'),
+            'ci_type': repeat('ci_type'),
+            'code': repeat('code'),
+            'datetime': pd.to_datetime(np.asarray(times)),
+            'value': np.array(values, dtype=SERIES_DTYPE)
+        })
+
+
+# 当前进程已挂载的快照
+_snapshot = None
+
+
+def get_snapshot():
+    """获取当前进程挂载的快照；未配置或快照与数据版本不一致时返回None"""
+    global _snapshot
+    snapshot_dir = os.getenv('DATA_SNAPSHOT_DIR')
+    if not snapshot_dir:
+        return None
+
+    try:
+        version = get_data_version()
+    except FileNotFoundError:
+        return None
+
+    if _snapshot is None or _snapshot.version != version:
+        snapshot = DataSnapshot.attach(snapshot_dir)
+        if snapshot is None or snapshot.version != version:
+            logger.warning(f"数据快照不可用或已过期，回退为直接读取CSV: {snapshot_dir}")
+            return None
+        _snapshot = snapshot
+    return _snapshot
+
+
+def publish_snapshot(snapshot_dir=None):
+    """读取全部CSV并发布共享快照（由主进程在fork worker之前调用）"""
+    snapshot_dir = snapshot_dir or os.getenv('DATA_SNAPSHOT_DIR')
+    if not snapshot_dir:
+        raise ValueError("未配置快照目录 DATA_SNAPSHOT_DIR")
+    os.makedirs(snapshot_dir, exist_ok=True)
+    version = get_data_version()
+    df = read_csv_data()
+    return DataSnapshot.publish(df, snapshot_dir, version)
+
+
+def load_raw_data(resource_id=None, start=None, end=None):
+    """加载原始数据，优先使用共享快照，否则直接读取CSV
+
+    指定 start/end 时只读取该时间范围（含两端）内的记录。
+    """
+    snapshot = get_snapshot()
+    record_cache('data_snapshot', snapshot is not None)
+    if snapshot is not None:
+        return snapshot.to_frame(resource_id, start, end)
+
+    df = read_csv_data(start=start, end=end)
+    if resource_id:
+        df = df[df['ci_id'] == resource_id]
+    return df
+
+
+# 未使用快照时当前进程缓存的汇总数据
+_rollups = None
+_rollups_lock = threading.Lock()
+
+
+def get_rollups(resource_id=None, start=None, end=None):
+    """获取多分辨率汇总：优先使用快照中发布的汇总或进程内已缓存的当前版本汇总
+
+    两者都没有时，指定 start/end 的请求只按文件分块索引读取覆盖该范围的完整天（以及指定的设备），
+    就地计算一份不缓存的汇总，不再为一次按范围的预测读取全部历史；未指定范围时读取全部数据计算一次并缓存。
+    """
+    global _rollups
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.rollups is not None:
+        record_cache('rollups', True)
+        return snapshot.rollups
+
+    version = get_data_version()
+    with _rollups_lock:
+        hit = _rollups is not None and _rollups.version == version
+        record_cache('rollups', hit)
+        if hit:
+            return _rollups
+        if start is None and end is None:
+            _rollups = RollupSet.build(read_csv_data(), version, SERIES_DTYPE)
+            logger.info(f"多分辨率汇总已计算: 数据版本 {version}")
+            return _rollups
+
+    # 按天对齐，使范围内每个粒度的时间桶都完整
+    df = load_raw_data(resource_id,
+                       pd.Timestamp(start).floor('D') if start is not None else None,
+                       pd.Timestamp(end).floor('D') + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns')
+                       if end is not None else None)
+    return RollupSet.build(df, version, SERIES_DTYPE)
+
+
+def clear_caches(remove_index_files=False):
+    """清空当前进程缓存的文件索引、快照和汇总，remove_index_files 时同时删除索引目录中当前数据文件的索引
+
+    供基准测试在每次测量前使用，使数据加载的每次重复都包含完整的读取和汇总计算。
+    """
+    global _snapshot, _rollups
+    with _rollups_lock:
+        _rollups = None
+    _snapshot = None
+    _file_indexes.clear()
+    if remove_index_files:
+        for file_path in list_data_files():
+            try:
+                os.remove(_index_file_path(os.path.abspath(file_path)))
+            except FileNotFoundError:
+                pass
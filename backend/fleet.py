@@ -0,0 +1,225 @@
+"""设备群快速筛查
+
+在对单个设备运行ARIMA、Prophet等重模型之前，先对全部设备一次性计算稳健趋势和到达阈值的
+时间，按风险排序，只为风险最高的设备排队执行完整预测。
+
+趋势使用 Theil–Sen 估计：每个设备的数据按小时聚合到最近 window_hours 个时间桶中，
+在所有设备共用的一组随机桶对上计算斜率并取中位数，全部设备在一个 (设备数 × 桶对数)
+的NumPy数组上一次算完。
+"""
+import os
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from forecast_store import FORECAST_STORE_PATH, connect_store
+
+# free_space_ratio 为剩余空间比例，默认低于该值视为风险
+FLEET_THRESHOLD = float(os.getenv('FLEET_THRESHOLD', 10.0))
+# 后台执行重模型预测的线程数
+FLEET_FORECAST_WORKERS = int(os.getenv('FLEET_FORECAST_WORKERS', 2))
+# 最多保留的排队任务数，超过后丢弃最早的任务记录
+FLEET_MAX_JOBS = int(os.getenv('FLEET_MAX_JOBS', 100))
+
+BUCKET = pd.Timedelta(hours=1)
+
+
+def bucket_matrix(df, window_hours=168, bucket=BUCKET):
+    """把原始数据聚合为 (设备数, window_hours) 的时间桶均值矩阵
+
+    每个设备以自己最后一条数据所在的桶为最后一列，没有数据的桶为NaN。
+    返回 (设备ID数组, 均值矩阵, 每个设备最后一个桶的起始时间)。
+    """
+    valid = df[df['value'] > 0]
+    codes, devices = pd.factorize(valid['ci_id'])
+    bucket_ns = bucket.value
+    buckets = valid['datetime'].values.astype('datetime64[ns]').astype(np.int64) // bucket_ns
+
+    last_bucket = np.full(len(devices), np.iinfo(np.int64).min, dtype=np.int64)
+    np.maximum.at(last_bucket, codes, buckets)
+    column = buckets - last_bucket[codes] + window_hours - 1
+    keep = column >= 0
+
+    flat = codes[keep] * window_hours + column[keep]
+    size = len(devices) * window_hours
+    sums = np.bincount(flat, weights=valid['value'].values[keep], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore'):
+        matrix = (sums / counts).reshape(len(devices), window_hours)
+    last_time = pd.to_datetime(last_bucket * bucket_ns)
+    return np.asarray(devices), matrix, last_time
+
+
+def theil_sen(matrix, sample_pairs=200, min_points=3, seed=0):
+    """按列位置（小时）对每一行做 Theil–Sen 回归
+
+    列数较少时使用全部列对，否则随机抽取 sample_pairs 个列对，所有行共用。
+    返回 (斜率, 最后一列处的拟合值, 与斜率同号的列对比例, 有效点数)。
+    """
+    n_rows, n_cols = matrix.shape
+    if n_cols * (n_cols - 1) // 2 <= sample_pairs:
+        left, right = np.triu_indices(n_cols, k=1)
+    else:
+        rng = np.random.default_rng(seed)
+        left, right = rng.integers(0, n_cols, (2, sample_pairs))
+        distinct = left != right
+        left, right = np.minimum(left, right)[distinct], np.maximum(left, right)[distinct]
+
+    with np.errstate(invalid='ignore'):
+        slopes = (matrix[:, right] - matrix[:, left]) / (right - left)
+        points = np.isfinite(matrix).sum(axis=1)
+        enough = (points >= min_points) & np.isfinite(slopes).any(axis=1)
+
+        slope = np.full(n_rows, np.nan)
+        level = np.full(n_rows, np.nan)
+        agreement = np.full(n_rows, np.nan)
+        if enough.any():
+            slope[enough] = np.nanmedian(slopes[enough], axis=1)
+            positions = np.arange(n_cols)
+            intercept = np.nanmedian(matrix[enough] - slope[enough, np.newaxis] * positions, axis=1)
+            level[enough] = intercept + slope[enough] * (n_cols - 1)
+            same_sign = np.sign(slopes[enough]) == np.sign(slope[enough, np.newaxis])
+            agreement[enough] = same_sign.sum(axis=1) / np.isfinite(slopes[enough]).sum(axis=1)
+    return slope, level, agreement, points
+
+
+def hours_to_threshold(level, slope, threshold, direction='below'):
+    """按线性趋势估计到达阈值的小时数，已越过阈值为0，趋势背离阈值为inf"""
+    sign = -1.0 if direction == 'below' else 1.0
+    gap = (threshold - level) * sign
+    rate = slope * sign
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hours = np.where(gap <= 0, 0.0, np.where(rate > 0, gap / rate, np.inf))
+    return np.where(np.isfinite(level) & np.isfinite(slope), hours, np.nan)
+
+
+def screen_fleet(df, threshold=FLEET_THRESHOLD, direction='below', horizon_hours=168,
+                 window_hours=168, sample_pairs=200, min_points=3):
+    """筛查全部设备，返回按风险排序的DataFrame
+
+    df 只需包含最近 window_hours 小时的数据（调用方按数据的最晚时间下推读取范围），
+    窗口内没有数据的设备不参与排序。到达阈值越早的设备越靠前；不会到达阈值的设备按趋势朝阈值方向的速度排序；
+    数据不足的设备排在最后。at_risk 表示预计在 horizon_hours 内到达阈值。
+    """
+    devices, matrix, last_time = bucket_matrix(df, window_hours)
+    slope, level, agreement, points = theil_sen(matrix, sample_pairs, min_points)
+    hours = hours_to_threshold(level, slope, threshold, direction)
+
+    latest = matrix[np.arange(len(devices)), -1] if len(devices) else np.zeros(0)
+    ci_types = df.drop_duplicates('ci_id').set_index('ci_id')['ci_type'].reindex(devices).values \
+        if 'ci_type' in df.columns else np.full(len(devices), None)
+
+    result = pd.DataFrame({
+        'ci_id': devices,
+        'ci_type': ci_types,
+        'latest_value': latest,
+        'trend_level': level,
+        'slope_per_hour': slope,
+        'slope_per_day': slope * 24,
+        'hours_to_threshold': hours,
+        'eta': last_time + pd.to_timedelta(np.where(np.isfinite(hours), hours, np.nan), unit='h'),
+        'trend_agreement': agreement,
+        'points': points,
+        'at_risk': np.isfinite(hours) & (hours <= horizon_hours)
+    })
+    toward = -slope if direction == 'below' else slope
+    result['_missing'] = np.isnan(hours)
+    result['_toward'] = -np.nan_to_num(toward, nan=-np.inf)
+    result = result.sort_values(['_missing', 'hours_to_threshold', '_toward'], kind='stable')
+    return result.drop(columns=['_missing', '_toward']).reset_index(drop=True)
+
+
+class ForecastQueue:
+    """在后台线程中为选中的设备执行完整预测
+
+    forecast_fn(params) 返回序列化后的预测结果JSON，与 ForecastPipeline.forecast 相同。
+    任务和每个设备的状态保存在预测结果存储的SQLite文件中，任一worker都能查询其他worker提交的任务；
+    超过 FLEET_MAX_JOBS 后丢弃最早的任务。预测在提交任务的worker中执行。
+    """
+
+    def __init__(self, forecast_fn, workers=FLEET_FORECAST_WORKERS, path=FORECAST_STORE_PATH):
+        self.forecast_fn = forecast_fn
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fleet-forecast')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with connect_store(path) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS fleet_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    threshold REAL,
+                    direction TEXT,
+                    created_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS fleet_job_devices (
+                    job_id TEXT,
+                    device_id TEXT,
+                    status TEXT,
+                    result TEXT,
+                    PRIMARY KEY (job_id, device_id)
+                );
+            ''')
+
+    def submit(self, device_ids, params, threshold=None, direction='below'):
+        """为每个设备排队一次预测，返回任务ID"""
+        job_id = uuid.uuid4().hex[:12]
+        job = {'threshold': threshold, 'direction': direction}
+        with connect_store(self.path) as conn:
+            conn.execute('INSERT INTO fleet_jobs VALUES (?, ?, ?, ?)', (job_id, threshold, direction, time.time()))
+            conn.executemany('INSERT INTO fleet_job_devices VALUES (?, ?, ?, ?)',
+                             [(job_id, device_id, 'queued', '{}') for device_id in device_ids])
+            expired = [row[0] for row in conn.execute(
+                'SELECT job_id FROM fleet_jobs ORDER BY created_at DESC LIMIT -1 OFFSET ?', (FLEET_MAX_JOBS,))]
+            for expired_id in expired:
+                conn.execute('DELETE FROM fleet_job_devices WHERE job_id = ?', (expired_id,))
+                conn.execute('DELETE FROM fleet_jobs WHERE job_id = ?', (expired_id,))
+        for device_id in device_ids:
+            self._executor.submit(self._run, job_id, job, device_id, {**params, 'resource_id': device_id})
+        return job_id
+
+    def _update(self, job_id, device_id, status, result=None):
+        with connect_store(self.path) as conn:
+            conn.execute('UPDATE fleet_job_devices SET status = ?, result = ? WHERE job_id = ? AND device_id = ?',
+                         (status, json.dumps(result or {}), job_id, device_id))
+
+    def _run(self, job_id, job, device_id, params):
+        self._update(job_id, device_id, 'running')
+        try:
+            response = json.loads(self.forecast_fn(params))
+            self._update(job_id, device_id, 'done', self._summarize(response, job['threshold'], job['direction']))
+        except Exception as e:
+            self._update(job_id, device_id, 'error', {'error': str(e)})
+
+    @staticmethod
+    def _summarize(response, threshold, direction):
+        """从预测结果中提取预测终值和首次越过阈值的时间"""
+        forecast = response.get('forecast', {})
+        dates = forecast.get('dates', [])
+        values = np.asarray(forecast.get('values', []), dtype=float)
+        summary = {
+            'model': response.get('model_info', {}).get('type'),
+            'forecast_end': dates[-1] if dates else None,
+            'forecast_end_value': float(values[-1]) if len(values) else None,
+            'metrics': response.get('metrics')
+        }
+        if threshold is not None:
+            for name, key in (('forecast_crossing', 'values'), ('bound_crossing', 'lower' if direction == 'below' else 'upper')):
+                series = np.asarray(forecast.get(key, []), dtype=float)
+                crossed = series <= threshold if direction == 'below' else series >= threshold
+                summary[name] = dates[int(np.argmax(crossed))] if crossed.any() else None
+        return summary
+
+    def status(self, job_id):
+        """返回任务中每个设备的状态，任务不存在时返回None"""
+        with connect_store(self.path) as conn:
+            job = conn.execute('SELECT threshold, direction FROM fleet_jobs WHERE job_id = ?', (job_id,)).fetchone()
+            rows = conn.execute('SELECT device_id, status, result FROM fleet_job_devices WHERE job_id = ? '
+                                'ORDER BY rowid', (job_id,)).fetchall()
+        if job is None:
+            return None
+        devices = {device_id: {'status': status, **json.loads(result)} for device_id, status, result in rows}
+        counts = pd.Series([state['status'] for state in devices.values()]).value_counts().to_dict()
+        return {'job_id': job_id, 'threshold': job[0], 'direction': job[1],
+                'summary': counts, 'devices': devices}
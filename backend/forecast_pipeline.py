@@ -0,0 +1,273 @@
+import json
+import threading
+from contextlib import nullcontext
+from concurrent.futures import Future
+from data_store import get_data_version
+from utils import ModelEvaluator
+from anomaly import detector
+from covariates import covariate_service
+from admission import estimate_cost
+from memory import memory_tracker
+from training_window import select_training_window, TRAINING_WINDOW_DEFAULT
+from precision import to_json_list
+from metrics import registry, time_stage, record_cache, INFLIGHT_FITS, INFLIGHT_REQUESTS
+
+
+class RequestCoalescer:
+    """合并相同的并发请求
+
+    同一个key同时只执行一次，执行期间到达的相同请求直接等待并共享该次的结果
+    （包括异常）。执行结束后key立即移除，之后的请求会重新执行。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    @property
+    def inflight_count(self):
+        """当前正在执行的不同请求数"""
+        with self._lock:
+            return len(self._inflight)
+
+    def run(self, key, func):
+        """执行func或等待正在执行的相同请求，返回(结果, 是否为合并等待)"""
+        with self._lock:
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._inflight[key] = future
+
+        if not is_leader:
+            return future.result(), True
+
+        try:
+            result = func()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+class ForecastPipeline:
+    """预测流水线
+
+    每次请求的数据、模型实例和结果都只保存在局部变量中，不依赖任何可变的
+    全局状态，因此可以被多个线程并发调用。相同参数、相同设备且基于相同数据
+    版本的并发请求会被合并为一次训练。
+    """
+
+    def __init__(self, model_manager, load_data, prepare_data, admission=None):
+        self.model_manager = model_manager
+        self.admission = admission
+        self.load_data = load_data
+        self.prepare_data = prepare_data
+        self.coalescer = RequestCoalescer()
+        registry.add_collector(lambda: INFLIGHT_REQUESTS.set(self.coalescer.inflight_count))
+
+    def normalize_params(self, params):
+        """补全模型参数的默认值，只传部分参数的请求与传全部默认参数的请求视为相同"""
+        model_type = params.get('model', 'arima')
+        normalized = {'model': model_type, 'periods': 24}
+        model_obj = self.model_manager.get_model(model_type)
+        if model_obj is not None:
+            normalized.update({name: config.default for name, config in model_obj.get_parameter_config().items()})
+        normalized.update({key: value for key, value in params.items() if value is not None})
+        return normalized
+
+    def request_key(self, params):
+        """根据模型、全部参数（补全默认值后）、设备和数据版本生成请求的唯一标识"""
+        params = self.normalize_params(params)
+        return json.dumps({
+            'model': params['model'],
+            'resource_id': params.get('resource_id'),
+            'data_version': get_data_version(),
+            'params': params
+        }, sort_keys=True, default=str)
+
+    def forecast(self, params, coalesce=True):
+        """执行预测并返回序列化后的JSON，相同的并发请求只训练和序列化一次
+
+        coalesce=False 时在当前线程独立执行（例如性能分析需要在本线程内完成全部计算）。
+        """
+        if not coalesce:
+            return self.execute(params)
+
+        body, coalesced = self.coalescer.run(self.request_key(params), lambda: self.execute(params))
+        record_cache('forecast_coalescer', coalesced)
+        return body
+
+    def execute(self, params):
+        """在请求的内存上限内训练、预测并序列化"""
+        with memory_tracker.request(params.get('model', 'arima')):
+            return self.serialize(self.run(params), params)
+
+    def serialize(self, response, params):
+        """将响应序列化为JSON"""
+        with time_stage('serialize', params.get('model', 'arima')):
+            return json.dumps(response)
+
+    def run(self, params):
+        """完整的训练和预测流程"""
+        model_type = params.get('model', 'arima')
+        forecast_periods = int(params.get('periods', 24))
+        train_ratio = float(params.get('train_ratio', 0.8))
+
+        # 获取时间范围参数
+        data_start_date = params.get('data_start_date')
+        data_end_date = params.get('data_end_date')
+
+        # 获取资源ID参数
+        resource_id = params.get('resource_id')
+
+        # 加载数据，支持根据资源ID过滤，时间范围下推到数据读取，只读取范围内的数据
+        with time_stage('load', model_type):
+            series_data, device_id = self.load_data(resource_id, start=data_start_date, end=data_end_date)
+
+        # 准备训练数据
+        with time_stage('prepare', model_type):
+            train_series, val_series = self.prepare_data(
+                series_data,
+                train_ratio=train_ratio,
+                data_start_date=data_start_date,
+                data_end_date=data_end_date
+            )
+
+        # 根据模型类型创建并训练模型
+        model_obj = self.model_manager.get_model(model_type)
+
+        # 训练窗口：从最后一个变点开始，并按模型季节周期限制最大点数（响应中的历史数据仍为完整训练集）
+        history_series = train_series
+        with time_stage('window', model_type):
+            train_series, training_window = select_training_window(
+                train_series, params.get('training_window', TRAINING_WINDOW_DEFAULT),
+                model_obj.seasonal_period(params))
+
+        # 日历和节假日协变量：与设备无关，从共享缓存中切出训练和预测范围
+        covariates = {}
+        if bool(params.get('use_covariates', False)) and model_obj.supports_covariates:
+            with time_stage('covariates', model_type):
+                covariates['future_covariates'] = covariate_service.for_series(
+                    train_series, len(val_series) + forecast_periods)
+
+        # 预计内存超过单个请求的上限时直接拒绝
+        memory_tracker.check_estimate(model_type, params, len(train_series), len(val_series) + forecast_periods)
+
+        # 按估计成本准入后再训练，超出并发限制时排队或拒绝
+        cost = estimate_cost(model_type, params, len(train_series))
+        with self.admit(model_type, cost) as waited:
+            forecast, forecast_interval, val_forecast, val_forecast_interval, metrics = self.fit_predict(
+                model_type, model_obj, params, train_series, val_series, forecast_periods, covariates, device_id)
+
+        # 准备响应数据
+        with time_stage('format', model_type):
+            response = self.build_response(
+                model_type, params, device_id, forecast_periods, history_series, val_series,
+                forecast, forecast_interval, val_forecast, val_forecast_interval, metrics)
+            response['model_info']['training_window'] = training_window
+            response['model_info']['covariates'] = \
+                covariates['future_covariates'].components.tolist() if covariates else []
+            response['model_info']['admission'] = {'cost': cost, 'wait_seconds': round(waited, 3)}
+            response['model_info']['memory'] = memory_tracker.summary()
+            return response
+
+    def admit(self, model_type, cost):
+        """未配置准入控制时直接执行"""
+        if self.admission is None:
+            return nullcontext(0.0)
+        return self.admission.admit(model_type, cost)
+
+    def fit_predict(self, model_type, model_obj, params, train_series, val_series, forecast_periods,
+                    covariates, device_id):
+        """训练模型、预测并在验证集上评估，返回 (预测, 区间, 验证预测, 验证区间, 指标)"""
+        model = model_obj.create_model(**params)
+        with time_stage('fit', model_type), INFLIGHT_FITS.track_inprogress(model=model_type):
+            model = model_obj.fit(model, train_series, **covariates)
+
+        # 预测
+        with time_stage('predict', model_type):
+            forecast_result = model_obj.predict(model, forecast_periods, **covariates)
+        # 处理预测结果（可能包含置信区间），数值类型与训练序列一致
+        forecast, forecast_interval = model_obj.cast_result(forecast_result, train_series.dtype)
+
+        # 有区间时登记供新观测值的异常检测使用：区间需从数据末尾（验证集之后）开始，
+        # 因此验证预测延长 forecast_periods 步，验证集之后的部分即为数据末尾之后的预测
+        register = forecast_interval is not None and device_id is not None
+        anchored, anchored_interval = forecast, forecast_interval
+
+        # 在验证集上评估（如果有足够的验证数据）
+        val_forecast = None
+        val_forecast_interval = None
+        metrics = {'mape': None, 'rmse': None, 'mae': None, 'mse': None}
+        evaluate = len(val_series) >= forecast_periods
+        if evaluate or (register and len(val_series) > 0):
+            with time_stage('validate', model_type):
+                horizon = len(val_series) + (forecast_periods if register else 0)
+                extended, extended_interval = model_obj.cast_result(
+                    model_obj.predict(model, horizon, **covariates), train_series.dtype)
+                if register and extended_interval is not None:
+                    anchored = extended[len(val_series):]
+                    anchored_interval = {key: band[len(val_series):] for key, band in extended_interval.items()}
+
+                if evaluate:
+                    val_forecast = extended[:len(val_series)]
+                    val_forecast_interval = {key: band[:len(val_series)] for key, band in extended_interval.items()} \
+                        if extended_interval is not None else None
+                    # 一次计算全部指标（含sMAPE、MASE和区间覆盖率）
+                    metrics = ModelEvaluator.calculate_metrics(
+                        val_series, val_forecast, interval=val_forecast_interval, insample=train_series) or metrics
+
+        if register and anchored_interval is not None:
+            detector.register_forecast(
+                device_id, anchored.time_index, anchored.values().flatten(),
+                anchored_interval['lower'].values().flatten(), anchored_interval['upper'].values().flatten())
+
+        return forecast, forecast_interval, val_forecast, val_forecast_interval, metrics
+
+    def build_response(self, model_type, params, device_id, forecast_periods, train_series, val_series,
+                       forecast, forecast_interval, val_forecast, val_forecast_interval, metrics):
+        """将预测结果转换为前端使用的响应结构"""
+        # 获取模型参数描述
+        model_params = str(params)  # 简化处理，实际应根据模型类型生成具体描述
+
+        response = {
+            'historical': {
+                'dates': train_series.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
+                'values': to_json_list(train_series.values().flatten())
+            },
+            'forecast': {
+                'dates': forecast.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
+                'values': to_json_list(forecast.values().flatten())
+            },
+            'validation': {
+                'dates': val_series.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist() if len(val_series) > 0 else [],
+                'values': to_json_list(val_series.values().flatten()) if len(val_series) > 0 else [],
+                'forecast': to_json_list(val_forecast.values().flatten()) if val_forecast is not None else []
+            },
+            'metrics': metrics,
+            'model_info': {
+                'type': model_type,
+                'parameters': model_params,
+                'device_id': device_id,
+                'train_size': len(train_series),
+                'val_size': len(val_series),
+                'forecast_periods': forecast_periods,
+                'data_frequency': 'hourly',
+                'dtype': train_series.dtype.name
+            }
+        }
+        # 添加置信区间数据（如果存在）
+        if forecast_interval is not None:
+            response['forecast']['lower'] = to_json_list(forecast_interval['lower'].values().flatten())
+            response['forecast']['upper'] = to_json_list(forecast_interval['upper'].values().flatten())
+
+        if val_forecast_interval is not None:
+            response['validation']['forecast_lower'] = to_json_list(val_forecast_interval['lower'].values().flatten())
+            response['validation']['forecast_upper'] = to_json_list(val_forecast_interval['upper'].values().flatten())
+
+        return response
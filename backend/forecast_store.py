@@ -0,0 +1,352 @@
+"""预测结果存储与后台预计算
+
+ForecastStore 把序列化后的预测结果保存在本地SQLite文件中，键为预测流水线的请求标识
+（模型、补全默认值后的参数、设备和数据版本），同时记录每组请求参数的访问次数。
+数据文件变化后数据版本随之变化，旧结果自然失效；结果超过 FORECAST_STORE_MAX_AGE 秒也视为过期。
+
+ForecastScheduler 在后台线程中定期（或检测到数据版本变化后立即）刷新预测：
+候选为配置的 设备 × 模型 以及访问最多的请求参数，没有结果或已过期的优先，其次按访问次数排序。
+多个worker进程共享同一个SQLite文件，只有取得主调度锁的一个进程启动刷新线程，
+手动刷新时通过文件锁保证同一时刻只有一个进程执行刷新。
+只有启用后台预计算时，/api/forecast 才记录访问次数、读取和写入存储，命中新鲜结果时直接返回存储的响应体。
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from loguru import logger
+from data_store import get_data_version
+from metrics import record_cache, time_stage, FORECAST_PRECOMPUTE
+
+try:
+    import fcntl
+except ImportError:  # Windows 下不做跨进程互斥
+    fcntl = None
+
+# 存储文件路径
+FORECAST_STORE_PATH = os.getenv('FORECAST_STORE_PATH', os.path.join(tempfile.gettempdir(), 'darts_forecast_store.sqlite'))
+# 结果的最长有效时间（秒）
+FORECAST_STORE_MAX_AGE = float(os.getenv('FORECAST_STORE_MAX_AGE', 3600))
+# 是否启动后台预计算
+FORECAST_SCHEDULER_ENABLED = os.getenv('FORECAST_SCHEDULER_ENABLED', '0') == '1'
+# 刷新周期（秒）和检查数据版本的周期（秒）
+FORECAST_REFRESH_INTERVAL = float(os.getenv('FORECAST_REFRESH_INTERVAL', 300))
+FORECAST_VERSION_POLL = float(os.getenv('FORECAST_VERSION_POLL', 30))
+# 每轮最多刷新的预测数
+FORECAST_REFRESH_BATCH = int(os.getenv('FORECAST_REFRESH_BATCH', 10))
+# 结果年龄超过有效时间的该比例时提前刷新
+FORECAST_REFRESH_AHEAD = float(os.getenv('FORECAST_REFRESH_AHEAD', 0.5))
+# 固定预计算的设备和模型（逗号分隔），以及按访问次数加入的请求参数组数
+FORECAST_PRECOMPUTE_DEVICES = os.getenv('FORECAST_PRECOMPUTE_DEVICES', '')
+FORECAST_PRECOMPUTE_MODELS = os.getenv('FORECAST_PRECOMPUTE_MODELS', 'arima')
+FORECAST_PRECOMPUTE_TOP = int(os.getenv('FORECAST_PRECOMPUTE_TOP', 20))
+
+
+@contextmanager
+def connect_store(path, immediate=False):
+    """打开存储文件的独立连接（可在任意线程和进程中使用），正常结束时提交
+
+    immediate=True 时立即获取写锁，读出的状态在提交前不会被其他进程修改。
+    """
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        conn.execute('PRAGMA synchronous=NORMAL')
+        with conn:
+            if immediate:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+    finally:
+        conn.close()
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _split(text):
+    return [item.strip() for item in text.split(',') if item.strip()]
+
+
+def _shared_body(body):
+    """去掉只属于本次请求的字段（内存统计、准入等待时间），其余响应体供之后的请求共享"""
+    response = json.loads(body)
+    model_info = response.get('model_info')
+    if isinstance(model_info, dict):
+        model_info.pop('memory', None)
+        if isinstance(model_info.get('admission'), dict):
+            model_info['admission'].pop('wait_seconds', None)
+    return json.dumps(response)
+
+
+class ForecastStore:
+    """SQLite中的预测结果和请求访问次数"""
+
+    def __init__(self, path=FORECAST_STORE_PATH, max_age=FORECAST_STORE_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS forecasts (
+                    key TEXT PRIMARY KEY,
+                    request TEXT NOT NULL,
+                    resource_id TEXT,
+                    model TEXT,
+                    data_version TEXT,
+                    created_at REAL,
+                    seconds REAL,
+                    body TEXT
+                );
+                CREATE INDEX IF NOT EXISTS forecasts_request ON forecasts(request);
+                CREATE INDEX IF NOT EXISTS forecasts_device ON forecasts(resource_id, model);
+                CREATE TABLE IF NOT EXISTS traffic (
+                    request TEXT PRIMARY KEY,
+                    resource_id TEXT,
+                    model TEXT,
+                    params TEXT,
+                    hits INTEGER,
+                    last_request REAL
+                );
+            ''')
+
+    def _connect(self):
+        """每次操作使用独立连接（可在任意线程中调用），正常结束时提交"""
+        return connect_store(self.path)
+
+    @staticmethod
+    def request_id(params):
+        """与数据版本无关的请求参数标识，用于统计访问次数"""
+        return _digest(json.dumps(params, sort_keys=True, default=str))
+
+    def get(self, key):
+        """返回新鲜的响应体，不存在或已过期时返回None"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT body, created_at FROM forecasts WHERE key = ?', (_digest(key),)).fetchone()
+        if row is None or time.time() - row[1] > self.max_age:
+            return None
+        return row[0]
+
+    def ages(self, keys):
+        """返回每个请求标识对应结果的年龄（秒），没有结果时为None"""
+        digests = {_digest(key): key for key in keys}
+        now = time.time()
+        ages = dict.fromkeys(keys)
+        with self._connect() as conn:
+            for start in range(0, len(digests), 500):
+                chunk = list(digests)[start:start + 500]
+                rows = conn.execute(f"SELECT key, created_at FROM forecasts WHERE key IN ({','.join('?' * len(chunk))})",
+                                    chunk).fetchall()
+                for digest, created_at in rows:
+                    ages[digests[digest]] = now - created_at
+        return ages
+
+    def put(self, key, params, data_version, body, seconds):
+        """保存一次预测结果，同一请求参数的旧版本结果被替换"""
+        request = self.request_id(params)
+        with self._connect() as conn:
+            conn.execute('DELETE FROM forecasts WHERE request = ? AND key != ?', (request, _digest(key)))
+            conn.execute('INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (_digest(key), request, params.get('resource_id'), params.get('model'),
+                          data_version, time.time(), seconds, body))
+
+    def record_request(self, params):
+        """访问次数加一"""
+        with self._connect() as conn:
+            conn.execute('''
+                INSERT INTO traffic VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT(request) DO UPDATE SET hits = hits + 1, last_request = excluded.last_request
+            ''', (self.request_id(params), params.get('resource_id'), params.get('model'),
+                  json.dumps(params, sort_keys=True, default=str), time.time()))
+
+    def popular(self, limit):
+        """访问最多的请求参数，返回 [(参数, 访问次数)]"""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT params, hits FROM traffic ORDER BY hits DESC, last_request DESC LIMIT ?',
+                                (limit,)).fetchall()
+        return [(json.loads(params), hits) for params, hits in rows]
+
+    def prune(self, data_version):
+        """删除其他数据版本的结果"""
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM forecasts WHERE data_version != ?', (data_version,)).rowcount
+
+    def stats(self):
+        with self._connect() as conn:
+            entries, oldest = conn.execute('SELECT COUNT(*), MIN(created_at) FROM forecasts').fetchone()
+            requests, hits = conn.execute('SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM traffic').fetchone()
+        return {
+            'entries': entries,
+            'oldest_age_seconds': time.time() - oldest if oldest else None,
+            'tracked_requests': requests,
+            'total_hits': hits,
+            'max_age_seconds': self.max_age
+        }
+
+
+class ForecastScheduler:
+    """后台预计算预测结果，并为 /api/forecast 提供存储结果的读取和写入"""
+
+    def __init__(self, pipeline, store, interval=FORECAST_REFRESH_INTERVAL, batch=FORECAST_REFRESH_BATCH,
+                 devices=FORECAST_PRECOMPUTE_DEVICES, models=FORECAST_PRECOMPUTE_MODELS, top=FORECAST_PRECOMPUTE_TOP,
+                 enabled=FORECAST_SCHEDULER_ENABLED):
+        self.pipeline = pipeline
+        self.store = store
+        self.enabled = enabled
+        self.interval = interval
+        self.batch = batch
+        self.devices = _split(devices) if isinstance(devices, str) else list(devices)
+        self.models = _split(models) if isinstance(models, str) else list(models)
+        self.top = top
+        self._wake = threading.Event()
+        self._thread = None
+        self._leader_lock = None
+        self._trigger_file = f'{store.path}.trigger'
+        self._data_version = None
+        self.last_run = None
+
+    def lookup(self, params):
+        """记录访问并返回新鲜的存储结果，没有时返回None；未启用后台预计算时不访问存储"""
+        if not self.enabled:
+            return None
+        normalized = self.pipeline.normalize_params(params)
+        self.store.record_request(normalized)
+        body = self.store.get(self.pipeline.request_key(params))
+        record_cache('forecast_store', body is not None)
+        return body
+
+    def compute(self, params, coalesce=True, persist=None):
+        """执行预测并返回序列化后的响应体
+
+        persist 为None时只在启用后台预计算时写入存储（预计算本身总是写入）。
+        """
+        key = self.pipeline.request_key(params)
+        start = time.perf_counter()
+        body = self.pipeline.forecast(params, coalesce=coalesce)
+        if self.enabled if persist is None else persist:
+            self.store.put(key, self.pipeline.normalize_params(params), get_data_version(), _shared_body(body),
+                           time.perf_counter() - start)
+        return body
+
+    def jobs(self):
+        """需要刷新的请求参数，按优先级排序：没有结果或已过期的在前，其次访问次数多、结果旧的在前"""
+        candidates = {}
+        for params, hits in self.store.popular(self.top):
+            candidates[self.pipeline.request_key(params)] = (params, hits)
+        for device in self.devices:
+            for model in self.models:
+                params = self.pipeline.normalize_params({'model': model, 'resource_id': device})
+                key = self.pipeline.request_key(params)
+                candidates.setdefault(key, (params, 0))
+
+        ages = self.store.ages(list(candidates))
+        ahead = self.store.max_age * FORECAST_REFRESH_AHEAD
+        due = []
+        for key, (params, hits) in candidates.items():
+            age = ages[key]
+            stale = age is None or age > self.store.max_age
+            if stale or age > ahead:
+                due.append((not stale, -hits, -(age or 0), params))
+        due.sort(key=lambda item: item[:3])
+        return [params for *_, params in due]
+
+    def run_once(self):
+        """执行一轮刷新，返回刷新的预测数；其他进程正在刷新时跳过"""
+        lock_file = open(f'{self.store.path}.lock', 'w')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return 0
+            self.store.prune(get_data_version())
+            refreshed = 0
+            with time_stage('precompute', 'scheduler'):
+                for params in self.jobs()[:self.batch]:
+                    try:
+                        self.compute(params, persist=True)
+                        FORECAST_PRECOMPUTE.inc(result='ok')
+                        refreshed += 1
+                    except Exception as e:
+                        FORECAST_PRECOMPUTE.inc(result='error')
+                        logger.warning(f"预计算失败 {params.get('model')}/{params.get('resource_id')}: {e}")
+            self.last_run = time.time()
+            if refreshed:
+                logger.info(f"预计算完成: 刷新 {refreshed} 个预测")
+            return refreshed
+        finally:
+            lock_file.close()
+
+    def trigger(self):
+        """立即执行一轮刷新（例如数据导入之后）
+
+        刷新线程在其他进程中时更新触发文件，由该进程在下一次检查数据版本时执行。
+        """
+        with open(self._trigger_file, 'w'):
+            pass
+        self._wake.set()
+
+    def _trigger_mtime(self):
+        try:
+            return os.stat(self._trigger_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _loop(self):
+        next_run = 0.0
+        trigger_mtime = self._trigger_mtime()
+        while True:
+            self._wake.wait(timeout=max(min(FORECAST_VERSION_POLL, next_run - time.time()), 0.1))
+            self._wake.clear()
+            try:
+                mtime = self._trigger_mtime()
+                triggered = mtime != trigger_mtime
+                trigger_mtime = mtime
+                version = get_data_version()
+                if triggered or version != self._data_version or time.time() >= next_run:
+                    self._data_version = version
+                    self.run_once()
+                    next_run = time.time() + self.interval
+            except Exception as e:
+                logger.exception(f"后台预计算出错: {e}")
+                next_run = time.time() + self.interval
+
+    def _acquire_leader(self):
+        """获取主调度锁并在进程存活期间保持，多个worker中只有一个进程启动刷新线程"""
+        if fcntl is None:
+            return True
+        lock_file = open(f'{self.store.path}.leader', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._leader_lock = lock_file
+        return True
+
+    def start(self):
+        """启动后台刷新线程；已有其他进程在执行后台刷新时不启动
+
+        持有锁的进程退出后锁自动释放，gunicorn 重启的新worker会重新获取。
+        """
+        if self._thread is None:
+            if not self._acquire_leader():
+                logger.info("后台预计算已由其他进程执行，本进程不启动刷新线程")
+                return
+            self._thread = threading.Thread(target=self._loop, name='forecast-scheduler', daemon=True)
+            self._thread.start()
+            logger.info(f"后台预计算已启动: 周期 {self.interval}s, 固定设备 {len(self.devices)} 个")
+
+    def status(self):
+        return {
+            'enabled': self.enabled,
+            'running': self._thread is not None,
+            'interval_seconds': self.interval,
+            'last_run': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.last_run)) if self.last_run else None,
+            'pending': len(self.jobs()),
+            'store': self.store.stats()
+        }
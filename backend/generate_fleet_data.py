@@ -0,0 +1,39 @@
+"""生成 tb_metric_raw 格式的大规模设备群合成数据，用于压测和扩展性测试
+
+用法示例:
+    python generate_fleet_data.py ../data/tb_metric_raw_fleet.csv --devices 10000 --points 8640
+    python generate_fleet_data.py fleet.parquet --devices 50000 --points 2016 --seed 7
+"""
+import argparse
+from utils import DataGenerator
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='生成设备群合成数据（CSV 或 Parquet）')
+    parser.add_argument('path', help='输出文件路径，扩展名为 .parquet 时写入Parquet')
+    parser.add_argument('--devices', type=int, default=1000, help='设备数量')
+    parser.add_argument('--points', type=int, default=2016, help='每个设备的数据点数')
+    parser.add_argument('--start-date', default='2025-01-01', help='起始时间')
+    parser.add_argument('--freq', default='5T', help='采样频率')
+    parser.add_argument('--chunk-rows', type=int, default=1_000_000, help='每块最多生成的行数')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--gap-ratio', type=float, default=0.005, help='缺失记录比例')
+    parser.add_argument('--failure-ratio', type=float, default=0.01, help='-2 连接失败记录比例')
+    args = parser.parse_args(argv)
+
+    rows = DataGenerator.generate_fleet_data(
+        args.path,
+        n_devices=args.devices,
+        points_per_device=args.points,
+        start_date=args.start_date,
+        freq=args.freq,
+        chunk_rows=args.chunk_rows,
+        seed=args.seed,
+        gap_ratio=args.gap_ratio,
+        failure_ratio=args.failure_ratio
+    )
+    print(f"已生成 {rows} 行数据: {args.path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""生产环境多进程服务配置
+
+启动方式: gunicorn -c gunicorn.conf.py app:app
+
+主进程在fork worker之前读取一次全部CSV数据，并以内存映射文件的形式发布
+共享只读快照（DATA_SNAPSHOT_DIR），每个worker只挂载该快照而不再各自加载
+一份数据。发送HUP信号重载时会重新发布快照。
+"""
+import os
+import multiprocessing
+
+from loguru import logger
+
+bind = f"0.0.0.0:{os.getenv('BACKEND_PORT', '5001')}"
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.getenv('WEB_THREADS', '4'))
+# 模型训练可能耗时较长，适当放宽超时时间
+timeout = int(os.getenv('WEB_TIMEOUT', '300'))
+graceful_timeout = 30
+accesslog = '-'
+
+# 快照目录默认放在 /dev/shm（内存文件系统），不存在时退回系统临时目录
+_default_snapshot_dir = '/dev/shm/darts_snapshot' if os.path.isdir('/dev/shm') else '/tmp/darts_snapshot'
+os.environ.setdefault('DATA_SNAPSHOT_DIR', _default_snapshot_dir)
+
+
+def _publish():
+    from data_store import publish_snapshot
+    try:
+        publish_snapshot(os.environ['DATA_SNAPSHOT_DIR'])
+    except Exception as e:
+        # 快照发布失败不影响服务启动，worker会回退为直接读取CSV
+        logger.exception(f"发布数据快照失败: {str(e)}")
+
+
+def _reset_admission():
+    """清空上次运行遗留的跨进程准入登记"""
+    from admission import ADMISSION_STATE_DIR, SharedSlots, fcntl
+    if ADMISSION_STATE_DIR and fcntl is not None:
+        SharedSlots(ADMISSION_STATE_DIR).reset()
+
+
+def _reset_metrics():
+    """删除上次运行遗留的各进程指标文件"""
+    from metrics import registry
+    registry.reset_multiproc_dir()
+
+
+def on_starting(server):
+    """主进程启动时发布数据快照"""
+    _reset_metrics()
+    _publish()
+    _reset_admission()
+
+
+def on_reload(server):
+    """重载时重新发布数据快照"""
+    _publish()
@@ -0,0 +1,171 @@
+"""按 ci_type 分层的聚合预测与协调
+
+把设备的小时数据汇总为 ci_type 层和全部设备总量两级聚合序列，只在聚合层训练模型，
+再按历史占比把聚合预测分摊到每个设备：
+
+- top_down: 只训练总量一个模型，按设备占总量的历史比例分摊到各设备，
+  ci_type 层为所属设备之和；
+- middle_out: 每个 ci_type 训练一个模型，按设备在类型内的历史比例分摊到设备，
+  总量为各类型之和。各类型分位数区间的和不是总量的区间，总量区间按各类型误差相互独立、
+  由上下半宽的平方和开方得到（响应中 interval 标明计算方式）。
+
+模型训练次数从设备数降为 1 或 ci_type 数，同时仍给出每个设备的预测值，
+且各层预测满足加总一致。
+"""
+import numpy as np
+import pandas as pd
+from darts import TimeSeries
+from metrics import time_stage
+from precision import SERIES_DTYPE, to_json_list
+
+RECONCILIATION_METHODS = ('top_down', 'middle_out')
+
+
+def hourly_matrix(df, history_hours=720):
+    """把原始数据聚合为所有设备共用时间轴的 (设备数, 小时数) 矩阵
+
+    只保留最近 history_hours 小时，设备内的缺失小时按时间线性插值，首尾缺失用最近的值填充。
+    返回 (设备ID数组, 设备类型数组, 小时时间轴, 矩阵)。
+    """
+    valid = df[df['value'] > 0]
+    codes, devices = pd.factorize(valid['ci_id'])
+    hours = valid['datetime'].values.astype('datetime64[h]').astype(np.int64)
+    end = hours.max()
+    start = max(hours.min(), end - history_hours + 1)
+    keep = hours >= start
+    width = int(end - start + 1)
+
+    flat = codes[keep] * width + (hours[keep] - start)
+    size = len(devices) * width
+    sums = np.bincount(flat, weights=valid['value'].values[keep], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore'):
+        matrix = (sums / counts).reshape(len(devices), width)
+
+    # 窗口内没有任何数据的设备不参与分层
+    present = np.isfinite(matrix).any(axis=1)
+    matrix = pd.DataFrame(matrix[present].T).interpolate(limit_direction='both').values.T
+    ci_types = valid.drop_duplicates('ci_id').set_index('ci_id')['ci_type'].reindex(devices).values
+    time_index = pd.to_datetime(np.arange(start, end + 1).astype('datetime64[h]'))
+    return np.asarray(devices)[present], ci_types[present], time_index, matrix
+
+
+class HierarchicalForecaster:
+    """在聚合层训练模型并协调到设备"""
+
+    def __init__(self, model_manager):
+        self.model_manager = model_manager
+
+    def _fit_predict(self, model_type, params, time_index, values, periods):
+        """在一条聚合序列上训练并预测，返回 (预测值, 下界, 上界, 预测时间轴)"""
+        model_obj = self.model_manager.get_model(model_type)
+        series = TimeSeries.from_times_and_values(time_index, values.reshape(-1, 1).astype(SERIES_DTYPE), freq='H')
+        model = model_obj.create_model(**params)
+        with time_stage('hierarchical_fit', model_type):
+            model = model_obj.fit(model, series)
+        with time_stage('hierarchical_predict', model_type):
+            forecast, interval = model_obj.cast_result(model_obj.predict(model, periods), series.dtype)
+
+        lower = upper = None
+        if interval is not None:
+            lower = interval['lower'].values().flatten()
+            upper = interval['upper'].values().flatten()
+        return forecast.values().flatten(), lower, upper, forecast.time_index
+
+    @staticmethod
+    def _proportions(matrix, groups, window):
+        """设备在所属分组（总量或类型）最近 window 小时内总和中的占比"""
+        recent = matrix[:, -window:].sum(axis=1)
+        group_total = pd.Series(recent).groupby(groups).transform('sum').values
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(group_total > 0, recent / group_total, 0.0)
+
+    def forecast(self, df, model_type='arima', params=None, periods=24, method='top_down',
+                 history_hours=720, proportion_hours=168, include_devices=True):
+        """构建分层聚合序列、在聚合层预测并协调到设备"""
+        if method not in RECONCILIATION_METHODS:
+            raise ValueError(f"不支持的协调方法: {method}，可选: {', '.join(RECONCILIATION_METHODS)}")
+        params = dict(params or {})
+
+        with time_stage('hierarchical_aggregate', model_type):
+            devices, ci_types, time_index, matrix = hourly_matrix(df, history_hours)
+            if len(devices) == 0:
+                raise ValueError("没有找到有效的数据 (value > 0)")
+            type_codes, type_names = pd.factorize(pd.Series(ci_types).fillna('unknown'))
+            type_history = np.vstack([matrix[type_codes == k].sum(axis=0) for k in range(len(type_names))])
+            total_history = matrix.sum(axis=0)
+
+        # 只在聚合层训练：top_down 训练 1 个模型，middle_out 每个类型 1 个
+        bands = ('values', 'lower', 'upper')
+        if method == 'top_down':
+            *total_values, dates = self._fit_predict(model_type, params, time_index, total_history, periods)
+            total = dict(zip(bands, total_values))
+            share = self._proportions(matrix, np.zeros(len(devices), dtype=int), proportion_hours)
+            device_bands = {band: np.outer(share, total[band]) if total[band] is not None else None
+                            for band in bands}
+            type_bands = {band: np.vstack([device_bands[band][type_codes == k].sum(axis=0)
+                                           for k in range(len(type_names))])
+                          if device_bands[band] is not None else None for band in bands}
+            fits = 1
+        else:
+            type_results = [self._fit_predict(model_type, params, time_index, type_history[k], periods)
+                            for k in range(len(type_names))]
+            dates = type_results[0][3]
+            type_bands = {}
+            for position, band in enumerate(bands):
+                rows = [result[position] for result in type_results]
+                type_bands[band] = np.vstack(rows) if all(row is not None for row in rows) else None
+            share = self._proportions(matrix, type_codes, proportion_hours)
+            device_bands = {band: share[:, np.newaxis] * type_bands[band][type_codes]
+                            if type_bands[band] is not None else None for band in bands}
+            total = {'values': type_bands['values'].sum(axis=0), 'lower': None, 'upper': None}
+            if type_bands['lower'] is not None and type_bands['upper'] is not None:
+                # 分位数不可相加：假设各类型的预测误差相互独立，按方差相加合成总量的区间
+                total['lower'] = total['values'] - np.sqrt(
+                    ((type_bands['values'] - type_bands['lower']) ** 2).sum(axis=0))
+                total['upper'] = total['values'] + np.sqrt(
+                    ((type_bands['upper'] - type_bands['values']) ** 2).sum(axis=0))
+            fits = len(type_names)
+
+        def level(values_by_band, history, count, index=None):
+            item = {'devices': int(count)}
+            for band in bands:
+                values = values_by_band[band]
+                if values is not None:
+                    values = values if index is None else values[index]
+                    item[band] = to_json_list(values)
+                    item[f'mean_{band}'] = to_json_list(values / count)
+            item['history_mean'] = float(history.mean() / count)
+            return item
+
+        type_counts = np.bincount(type_codes, minlength=len(type_names))
+        response = {
+            'method': method,
+            'model': model_type,
+            'periods': periods,
+            'fits': fits,
+            'dates': pd.DatetimeIndex(dates).strftime('%Y-%m-%d %H:%M:%S').tolist(),
+            'history': {
+                'start': time_index[0].strftime('%Y-%m-%d %H:%M:%S'),
+                'end': time_index[-1].strftime('%Y-%m-%d %H:%M:%S'),
+                'hours': len(time_index)
+            },
+            # 区间的计算方式：scaled 为聚合预测区间按比例缩放，independent_sum 为按独立误差的方差相加
+            'interval': None if total['lower'] is None else
+                        ('scaled' if method == 'top_down' else 'independent_sum'),
+            'levels': {
+                'total': level(total, total_history, len(devices)),
+                'ci_type': {str(name): level(type_bands, type_history[k], type_counts[k], k)
+                            for k, name in enumerate(type_names)}
+            }
+        }
+        if include_devices:
+            response['devices'] = {
+                str(device): {
+                    'ci_type': str(type_names[type_codes[i]]),
+                    'proportion': float(share[i]),
+                    **{band: to_json_list(device_bands[band][i]) for band in bands if device_bands[band] is not None}
+                }
+                for i, device in enumerate(devices)
+            }
+        return response
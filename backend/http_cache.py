@@ -0,0 +1,101 @@
+"""基于版本号的HTTP条件请求缓存
+
+被装饰的GET接口按 版本号 + 请求路径和参数 生成ETag：
+- 请求头 If-None-Match 与当前ETag相同时直接返回304，不执行接口；
+- 版本号未变化时直接返回缓存的响应体；
+- 否则执行接口并缓存成功的响应。
+
+版本号由调用方提供，例如数据文件版本 get_data_version 或模型注册表的哈希，
+因此数据文件或模型变化后缓存自动失效。缓存保存在进程内存中，按LRU淘汰。
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response, Response
+from metrics import record_cache
+from profiling import is_profiling
+from loguru import logger
+
+# 每个进程最多缓存的响应数
+HTTP_CACHE_SIZE = int(os.getenv('HTTP_CACHE_SIZE', 128))
+
+
+class ResponseCache:
+    """按 (接口, 请求路径) 缓存响应体，每条记录带生成时的版本号"""
+
+    def __init__(self, max_entries=HTTP_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, version, body, content_type):
+        with self._lock:
+            self._entries[key] = (version, body, content_type)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def make_etag(version, key):
+    """由版本号和请求路径生成ETag"""
+    return hashlib.sha1(f'{version}|{key}'.encode('utf-8')).hexdigest()[:20]
+
+
+def etag_cached(name, version_fn):
+    """为GET接口添加ETag、304响应和响应体缓存
+
+    name 用于区分缓存并作为缓存指标的标签，version_fn() 返回当前版本号。
+    性能分析请求不走缓存，以便分析接口本身的计算；version_fn() 出错（例如数据目录不存在）时
+    同样直接执行接口，由接口自身的错误处理返回JSON错误。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if is_profiling():
+                return view(*args, **kwargs)
+
+            try:
+                version = version_fn()
+            except Exception as e:
+                logger.warning(f"获取 {name} 缓存版本号失败，跳过缓存: {e}")
+                return view(*args, **kwargs)
+            key = f'{name}:{request.full_path}'
+            etag = make_etag(version, key)
+
+            if request.if_none_match.contains(etag):
+                record_cache(f'http_{name}', True)
+                response = Response(status=304)
+            else:
+                cached = response_cache.get(key, version)
+                record_cache(f'http_{name}', cached is not None)
+                if cached is not None:
+                    response = Response(cached[0], content_type=cached[1])
+                else:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    response_cache.put(key, version, response.get_data(), response.content_type)
+
+            response.set_etag(etag)
+            # 浏览器每次都带上If-None-Match重新验证
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
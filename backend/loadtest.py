@@ -0,0 +1,254 @@
+"""HTTP压测工具
+
+按可配置的请求比例、并发数和持续时间压测本地后端，统计每个接口的吞吐量、
+p50/p95/p99 延迟和错误率，报告保存为JSON，可与之前的报告对比。
+只依赖标准库和NumPy，不需要任何外部服务；可选自动生成合成数据并启动本地后端。
+
+用法示例:
+    # 压测已启动的后端
+    python loadtest.py --url http://localhost:5001 --mix forecast=1,info=4,preview2=4 -c 8 -d 60
+    # 自动生成数据、启动后端并压测，与上一次报告对比
+    python loadtest.py --start-backend --generate 200x2016 -c 16 -d 30 --compare reports/last.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from datetime import datetime
+import numpy as np
+
+# 可压测的接口：名称 -> (方法, 路径)
+ENDPOINTS = {
+    'forecast': ('POST', '/api/forecast'),
+    'info': ('GET', '/api/data/info'),
+    'preview2': ('GET', '/api/data/preview2'),
+    'models': ('GET', '/api/models'),
+    'health': ('GET', '/api/health')
+}
+
+DEFAULT_FORECAST_BODY = {'model': 'arima', 'periods': 24, 'p': 1, 'd': 1, 'q': 1}
+
+
+def parse_mix(text):
+    """解析形如 'forecast=1,info=4' 的请求比例"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"未知的接口: {name}，可选: {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def send_request(base_url, name, forecast_body, timeout):
+    """发送一次请求，返回(HTTP状态码, 是否成功)"""
+    method, path = ENDPOINTS[name]
+    data = None
+    headers = {}
+    if method == 'POST':
+        data = json.dumps(forecast_body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(base_url + path, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+            return resp.status, 200 <= resp.status < 400
+    except urllib.error.HTTPError as e:
+        return e.code, False
+    except Exception:
+        return 0, False
+
+
+def run_load(base_url, mix, concurrency, duration, warmup, forecast_body, timeout, seed):
+    """并发发送请求直到持续时间结束，返回每个请求的记录"""
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    records = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+    measure_from = start + warmup
+    deadline = measure_from + duration
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        local = []
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            name = rng.choices(names, weights)[0]
+            status, ok = send_request(base_url, name, forecast_body, timeout)
+            end = time.perf_counter()
+            if now >= measure_from:
+                local.append((name, end - now, status, ok))
+        with lock:
+            records.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records
+
+
+def summarize(records, duration):
+    """按接口汇总吞吐量、延迟分位数和错误率"""
+    def stats(items):
+        latencies = np.array([item[1] for item in items]) * 1000
+        errors = sum(1 for item in items if not item[3])
+        return {
+            'requests': len(items),
+            'throughput_rps': round(len(items) / duration, 3),
+            'error_rate': round(errors / len(items), 4) if items else 0.0,
+            'latency_ms': {
+                'mean': round(float(latencies.mean()), 2),
+                'p50': round(float(np.percentile(latencies, 50)), 2),
+                'p95': round(float(np.percentile(latencies, 95)), 2),
+                'p99': round(float(np.percentile(latencies, 99)), 2),
+                'max': round(float(latencies.max()), 2)
+            } if len(items) else {},
+            'status_codes': {str(code): sum(1 for item in items if item[2] == code)
+                             for code in sorted({item[2] for item in items})}
+        }
+
+    endpoints = {}
+    for name in sorted({record[0] for record in records}):
+        endpoints[name] = stats([record for record in records if record[0] == name])
+    return {'overall': stats(records) if records else {}, 'endpoints': endpoints}
+
+
+def print_summary(summary):
+    print(f"\n{'接口':<12} {'请求数':>8} {'吞吐(rps)':>10} {'p50(ms)':>10} {'p95(ms)':>10} {'p99(ms)':>10} {'错误率':>8}")
+    rows = list(summary['endpoints'].items()) + [('overall', summary['overall'])]
+    for name, item in rows:
+        if not item:
+            continue
+        latency = item['latency_ms']
+        print(f"{name:<12} {item['requests']:>8} {item['throughput_rps']:>10.2f} {latency['p50']:>10.1f} "
+              f"{latency['p95']:>10.1f} {latency['p99']:>10.1f} {item['error_rate']:>8.2%}")
+
+
+def compare_reports(summary, previous):
+    """与之前的报告逐接口对比吞吐量和p95延迟"""
+    print("\n== 与之前的报告对比 ==")
+    for name, item in summary['endpoints'].items():
+        old = previous.get('summary', {}).get('endpoints', {}).get(name)
+        if not old or not item.get('latency_ms') or not old.get('latency_ms'):
+            continue
+        throughput_ratio = item['throughput_rps'] / old['throughput_rps'] if old['throughput_rps'] else float('inf')
+        p95_ratio = item['latency_ms']['p95'] / old['latency_ms']['p95'] if old['latency_ms']['p95'] else float('inf')
+        print(f"  {name:<12} 吞吐 x{throughput_ratio:.2f}  p95 x{p95_ratio:.2f}  "
+              f"错误率 {old['error_rate']:.2%} -> {item['error_rate']:.2%}")
+
+
+def wait_for_backend(base_url, timeout=60):
+    """等待后端健康检查通过"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status, ok = send_request(base_url, 'health', None, 2)
+        if ok:
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def start_backend(port, data_dir):
+    """在子进程中以多线程模式启动本地后端"""
+    env = dict(os.environ, DATA_DIR=data_dir)
+    code = f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True, debug=False)"
+    return subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='存储空间使用率预测系统HTTP压测')
+    parser.add_argument('--url', default='http://127.0.0.1:5001', help='后端地址')
+    parser.add_argument('--mix', default='forecast=1,info=4,preview2=4', help='请求比例，格式为 接口=权重，逗号分隔')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='并发数')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='统计时长(秒)')
+    parser.add_argument('--warmup', type=float, default=3, help='预热时长(秒)，不计入统计')
+    parser.add_argument('--timeout', type=float, default=120, help='单个请求超时(秒)')
+    parser.add_argument('--forecast-body', default=json.dumps(DEFAULT_FORECAST_BODY), help='预测请求的JSON参数')
+    parser.add_argument('--seed', type=int, default=42, help='请求选择的随机种子')
+    parser.add_argument('--start-backend', action='store_true', help='自动启动本地后端')
+    parser.add_argument('--port', type=int, default=5099, help='自动启动后端时使用的端口')
+    parser.add_argument('--data-dir', help='自动启动后端时使用的数据目录')
+    parser.add_argument('--generate', help='自动启动后端时先生成合成数据，格式为 设备数x每设备点数')
+    parser.add_argument('--output', help='报告输出文件（默认 loadtest_reports/loadtest_<时间>.json）')
+    parser.add_argument('--compare', help='对比的历史报告')
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    forecast_body = json.loads(args.forecast_body)
+    base_url = args.url.rstrip('/')
+    backend = None
+    tmp_dir = None
+
+    try:
+        if args.start_backend:
+            data_dir = args.data_dir
+            if args.generate:
+                from utils import DataGenerator
+                tmp_dir = tempfile.TemporaryDirectory()
+                data_dir = tmp_dir.name
+                devices, points = (int(x) for x in args.generate.lower().split('x'))
+                DataGenerator.generate_fleet_data(os.path.join(data_dir, 'tb_metric_raw_loadtest.csv'),
+                                                  n_devices=devices, points_per_device=points)
+            if not data_dir:
+                parser.error('--start-backend 需要 --data-dir 或 --generate')
+            base_url = f'http://127.0.0.1:{args.port}'
+            backend = start_backend(args.port, data_dir)
+
+        if not wait_for_backend(base_url):
+            print(f"后端不可用: {base_url}")
+            return 1
+
+        print(f"压测 {base_url}: 比例 {mix}, 并发 {args.concurrency}, 时长 {args.duration}s (预热 {args.warmup}s)")
+        records = run_load(base_url, mix, args.concurrency, args.duration, args.warmup,
+                           forecast_body, args.timeout, args.seed)
+        summary = summarize(records, args.duration)
+        print_summary(summary)
+
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'config': {
+                'url': base_url,
+                'mix': mix,
+                'concurrency': args.concurrency,
+                'duration': args.duration,
+                'warmup': args.warmup,
+                'forecast_body': forecast_body,
+                'generate': args.generate
+            },
+            'summary': summary
+        }
+        output = args.output or os.path.join(
+            'loadtest_reports', f"loadtest_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n报告已保存: {output}")
+
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                compare_reports(summary, json.load(f))
+        return 0
+    finally:
+        if backend is not None:
+            backend.terminate()
+            backend.wait(timeout=10)
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
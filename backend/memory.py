@@ -0,0 +1,274 @@
+"""按阶段的内存统计和每个请求的内存上限
+
+每个 time_stage 阶段记录进入阶段后内存的峰值增量，按 (阶段, 模型) 记入 forecast_stage_memory_bytes
+直方图；每个预测请求的峰值记入 forecast_request_memory_bytes。默认按进程RSS采样，几乎没有开销，
+但只能看到采样时刻的值，且释放的内存不一定归还操作系统；FORECAST_MEMORY_TRACKING=1 时改用
+tracemalloc 精确统计每次分配（包括 NumPy 数组），ARIMA 训练会慢约一倍，适合排查问题时开启。
+
+每个请求的内存上限（FORECAST_MEMORY_LIMIT_MB）分两步保证：
+- 训练前按模型、序列长度、预测步数和 num_samples 估计所需内存，超过上限直接返回413，不开始计算；
+- 执行过程中后台线程每 FORECAST_MEMORY_POLL 秒采样一次，阶段执行期间发现超过上限即标记该请求，
+  请求在阶段内部的检查点（分批采样的每一批、批量平滑的每个分块，见 metrics.checkpoint）
+  和 time_stage 阶段边界抛出 MemoryLimitExceeded 中止。不会在任意位置注入异常，锁和 finally 块照常执行；
+  单次原生调用（如 statsmodels 的卡尔曼滤波）内部无法中断，由训练前的估计限制。
+
+RSS 和 tracemalloc 的计数都是进程级的，无法精确区分同一进程中并发计算各自的分配：
+- 只有一个线程在执行统计阶段时，请求进入以来的内存增长全部归因于该请求，超过上限即中止；
+- 多个线程同时执行统计阶段时，改为比较进程内存相对空闲基线（没有任何阶段执行时的内存）的增长
+  与合计上限（上限 × 正在计算的线程数），超过时中止预计内存最大的请求。
+普通HTTP请求（健康检查、指标等）不进入统计阶段，不影响归因；并发时记录的阶段峰值是上界。
+"""
+import os
+import sys
+import time
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from admission import AdmissionRejected
+from models.base_model import SAMPLE_BATCH_SIZE
+from models.batch_exponential_smoothing import SMOOTHING_MODES, BATCH_ES_CHUNK_ROWS
+from metrics import (registry, add_stage_tracker, add_checkpoint, STAGE_MEMORY, REQUEST_MEMORY, MEMORY_LIMIT_ABORTS,
+                     PROCESS_MEMORY)
+
+# 是否用 tracemalloc 精确统计内存分配（否则按RSS采样）
+FORECAST_MEMORY_TRACKING = os.getenv('FORECAST_MEMORY_TRACKING', '0') == '1'
+# 每个请求的内存上限（MB），0 表示不限制
+FORECAST_MEMORY_LIMIT_MB = float(os.getenv('FORECAST_MEMORY_LIMIT_MB', 1024))
+# 执行过程中检查内存的间隔（秒）
+FORECAST_MEMORY_POLL = float(os.getenv('FORECAST_MEMORY_POLL', 0.02))
+
+MB = 1024 * 1024
+
+
+class MemoryLimitExceeded(AdmissionRejected):
+    """请求所需或已分配的内存超过上限"""
+
+    def __init__(self, message='请求内存超过上限，已中止', status=413, retry_after=None):
+        super().__init__(message, status, retry_after)
+
+
+def process_rss():
+    """当前进程的常驻内存（字节）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # 无法读取 /proc 时只能取得峰值（Linux 单位为KB，macOS 为字节）
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss * 1024 if sys.platform.startswith('linux') else maxrss
+
+
+def _state_dim(model_type, params):
+    """状态空间模型的状态维数"""
+    if model_type == 'auto_arima':
+        return 6 + 2 * int(params.get('season_length', 12))
+    p, d, q = (int(params.get(name, default) or 0) for name, default in (('p', 2), ('d', 1), ('q', 2)))
+    P, D, Q = (int(params.get(f'seasonal_order_{name}', 0) or 0) for name in 'PDQ')
+    s = int(params.get('seasonal_periods', 24)) if P or D or Q else 0
+    return d + D * s + max(p + P * s, q + Q * s + 1)
+
+
+def estimate_memory(model_type, params, length, horizon):
+    """估计一次训练加预测需要分配的内存（字节），只用于拒绝明显过大的请求"""
+    length, horizon = max(int(length), 1), max(int(horizon), 1)
+    samples = max(int(params.get('num_samples', 1) or 1), 1)
+    # 序列、DataFrame 和 TimeSeries 的中间副本
+    total = 8 * length * 16
+    if model_type in ('arima', 'auto_arima'):
+        k = _state_dim(model_type, params)
+        # 卡尔曼滤波为每个时间点保存状态和多份协方差矩阵（系数按 statsmodels 实测峰值取整）
+        total += 8 * length * (16 * k * k + 300)
+        # 没有解析区间时分批采样，每批保存各条路径的状态轨迹
+        total += 8 * horizon * min(samples, SAMPLE_BATCH_SIZE) * (k + 2) * 3
+    elif model_type == 'batch_ets':
+        mode = params.get('mode', 'holt')
+        k = SMOOTHING_MODES.index(mode) + 1 if mode in SMOOTHING_MODES else 1
+        season = int(params.get('seasonal_periods', 24)) if mode == 'holt_winters' else 0
+        # 设备矩阵的副本，以及每个分块 (季节周期, 设备数, 候选参数数) 的状态数组
+        total += 8 * length * 4 + 8 * BATCH_ES_CHUNK_ROWS * int(params.get('grid_size', 5)) ** k * (season + 6)
+    else:
+        total += 8 * length * 200 + 8 * horizon * max(samples, 1000) * 4
+    return total
+
+
+class _Scope:
+    """一个阶段或请求的内存统计"""
+
+    def __init__(self, stage, model, baseline, limit=None):
+        self.stage = stage
+        self.model = model
+        self.baseline = baseline
+        self.peak = 0
+        self.limit = limit
+        self.thread_id = threading.get_ident()
+        self.started = time.monotonic()
+        self.exceeded = False
+        # 执行期间其他线程也在执行统计阶段，峰值是本请求的上界
+        self.shared = False
+        self.estimate = None
+        self.stages = {}
+
+
+class MemoryTracker:
+    """统计各阶段的内存分配，并在请求超过内存上限时中止请求"""
+
+    def __init__(self, tracking=FORECAST_MEMORY_TRACKING, limit_mb=FORECAST_MEMORY_LIMIT_MB,
+                 poll=FORECAST_MEMORY_POLL):
+        self.tracking = tracking
+        self.limit = int(limit_mb * MB) if limit_mb > 0 else None
+        self.poll = poll
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._scopes = []
+        # 没有任何阶段执行时的进程内存，并发时按相对它的增长判断合计上限
+        self._idle_baseline = 0
+        self._busy = threading.Event()
+        self._thread = None
+        if tracking and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _read(self):
+        """返回 (当前分配, 上次读取以来的峰值)，只在持有锁时调用"""
+        if self.tracking:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            return current, peak
+        rss = process_rss()
+        return rss, rss
+
+    def _sample(self):
+        """读取一次内存并更新所有进行中的阶段，标记超过上限的请求，返回当前分配（只在持有锁时调用）"""
+        current, peak = self._read()
+        for scope in self._scopes:
+            scope.peak = max(scope.peak, peak - scope.baseline)
+        requests = [scope for scope in self._scopes if scope.limit is not None]
+        pending = [scope for scope in requests if not scope.exceeded]
+        if pending:
+            threads = {scope.thread_id for scope in self._scopes}
+            if len(threads) == 1:
+                # 只有一个线程在计算：请求进入以来的增长都属于它
+                for scope in pending:
+                    if scope.peak > scope.limit:
+                        scope.exceeded = True
+            elif len(pending) == len(requests) and peak - self._idle_baseline > self.limit * len(threads):
+                # 并发时无法精确归因：进程内存超过合计上限，中止预计内存最大（相同时最早开始）的请求；
+                # 已有请求在中止过程中时等它释放内存，不再连带中止其他请求
+                culprit = max(pending, key=lambda scope: (scope.estimate or 0, -scope.started))
+                culprit.exceeded = True
+        return current
+
+    def _enter(self, stage, model, limit=None):
+        with self._lock:
+            current = self._sample()
+            if not self._scopes:
+                self._idle_baseline = current
+            scope = _Scope(stage, model, current, limit)
+            for other in self._scopes:
+                if other.thread_id != scope.thread_id:
+                    other.shared = True
+                    scope.shared = True
+            self._scopes.append(scope)
+            self._busy.set()
+        return scope
+
+    def _exit(self, scope):
+        with self._lock:
+            self._sample()
+            self._scopes.remove(scope)
+            if not self._scopes:
+                self._busy.clear()
+
+    def check(self):
+        """在当前请求已超过上限时中止（阶段边界和阶段内部的检查点调用）"""
+        request = getattr(self._local, 'request', None)
+        if request is not None and request.exceeded:
+            MEMORY_LIMIT_ABORTS.inc(model=request.model, reason='runtime')
+            raise MemoryLimitExceeded(self._message(request))
+
+    def _message(self, request):
+        return (f"请求内存超过上限 ({request.peak / MB:.0f}MB > {request.limit / MB:.0f}MB)，已中止，"
+                f"请缩短数据范围或减少 num_samples")
+
+    @contextmanager
+    def stage(self, stage, model=''):
+        """统计代码块的峰值内存分配，由 time_stage 调用"""
+        self.check()
+        scope = self._enter(stage, model)
+        try:
+            yield scope
+        finally:
+            self._exit(scope)
+            STAGE_MEMORY.observe(scope.peak, stage=stage, model=model)
+            request = getattr(self._local, 'request', None)
+            if request is not None:
+                request.stages[stage] = max(request.stages.get(stage, 0), scope.peak)
+        self.check()
+
+    @contextmanager
+    def request(self, model=''):
+        """一个请求的内存上限，嵌套调用时只有最外层生效"""
+        if getattr(self._local, 'request', None) is not None:
+            yield self._local.request
+            return
+        self._start()
+        scope = self._enter('request', model, self.limit)
+        self._local.request = scope
+        try:
+            yield scope
+        finally:
+            self._local.request = None
+            self._exit(scope)
+            REQUEST_MEMORY.observe(scope.peak, model=model)
+
+    def check_estimate(self, model_type, params, length, horizon):
+        """训练前估计内存，超过上限时抛出 MemoryLimitExceeded，返回估计值（字节）"""
+        estimate = estimate_memory(model_type, params, length, horizon)
+        request = getattr(self._local, 'request', None)
+        if request is not None:
+            request.estimate = estimate
+        if self.limit is not None and estimate > self.limit:
+            MEMORY_LIMIT_ABORTS.inc(model=model_type, reason='estimate')
+            raise MemoryLimitExceeded(
+                f"预计需要 {estimate / MB:.0f}MB 内存，超过上限 {self.limit / MB:.0f}MB，"
+                f"请缩短数据范围、减少 num_samples 或季节周期")
+        return estimate
+
+    def summary(self):
+        """当前请求的内存统计，用于写入响应的 model_info"""
+        request = getattr(self._local, 'request', None)
+        if request is None:
+            return None
+        return {
+            'limit_mb': round(request.limit / MB, 1) if request.limit else None,
+            'estimated_mb': round(request.estimate / MB, 1) if request.estimate is not None else None,
+            # 为 true 时执行期间有其他计算并发，阶段峰值是上界
+            'shared': request.shared,
+            'stage_peak_mb': {stage: round(peak / MB, 2) for stage, peak in request.stages.items()}
+        }
+
+    def _loop(self):
+        while True:
+            self._busy.wait()
+            time.sleep(self.poll)
+            with self._lock:
+                self._sample()
+
+    def _start(self):
+        if self._thread is None and (self.limit is not None or not self.tracking):
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name='memory-guard', daemon=True)
+                    self._thread.start()
+
+    def collect(self):
+        PROCESS_MEMORY.set(process_rss(), kind='rss')
+        if self.tracking:
+            PROCESS_MEMORY.set(tracemalloc.get_traced_memory()[0], kind='traced')
+
+
+# 全局内存统计，time_stage 的每个阶段都会记录内存分配
+memory_tracker = MemoryTracker()
+add_stage_tracker(memory_tracker.stage)
+add_checkpoint(memory_tracker.check)
+registry.add_collector(memory_tracker.collect)
@@ -0,0 +1,182 @@
+"""预测和数据预览使用的数据准备
+
+从小时汇总中取出单个设备的序列、转换为训练/验证用的Darts序列，以及按设备统计数据概况。
+不依赖Flask应用，基准测试等脚本可以直接导入而不启动后台任务。
+"""
+import pandas as pd
+from darts import TimeSeries
+from data_store import get_rollups, get_snapshot, load_raw_data
+from precision import SERIES_DTYPE
+
+
+def load_metric_data(resource_id=None, start=None, end=None):
+    """加载存储空间使用率数据
+
+    指定 start/end 时只读取覆盖该时间范围的完整小时，而不是全部历史；没有快照或已缓存的汇总时
+    按文件分块索引只读取范围内的数据。
+    """
+    # 直接读取预先计算的小时汇总（只包含 value > 0 的有效数据，去除连接失败的数据）
+    rollups = get_rollups(resource_id, start, end)
+
+    # 未指定资源ID时选择数据最完整的设备
+    best_device = resource_id or rollups.best_device()
+    if best_device is None:
+        raise ValueError("没有找到有效的数据 (value > 0)")
+
+    # 按小时聚合数据（减少数据量，提高预测效果）
+    hourly, _ = rollups.device_series(
+        best_device, 'H',
+        pd.Timestamp(start).floor('H') if start else None,
+        pd.Timestamp(end).ceil('H') if end else None)
+    if hourly.empty:
+        raise ValueError("没有找到有效的数据 (value > 0)")
+    hourly_data = hourly['mean'].astype(SERIES_DTYPE).rename('value')
+
+    return hourly_data, best_device
+
+
+def prepare_arima_data(series, train_ratio=0.8, 
+                      data_start_date=None, data_end_date=None):
+    """准备ARIMA模型的训练和验证数据，支持时间范围过滤"""
+     # 1. 首先处理无效值 (-2 表示连接失败)
+    series = series[series > 0]  # 过滤掉无效值
+
+    # 2. 重新索引到规则的5分钟频率时间序列，填充缺失值
+    series = series.asfreq('5T')  # '5T' 表示5分钟频率
+
+    # 3. 处理缺失值 - 可以选择插值或前向填充
+    series = series.interpolate(method='time')  # 时间序列插值
+    # 或者使用前向填充: series = series.fillna(method='ffill')
+    # 转换为Darts TimeSeries
+    # ts = TimeSeries.from_series(series, freq='H')  # 小时频率
+    # 如果原始数据是分钟级
+    # ts = TimeSeries.from_series(series, freq='T')  # 分钟频率
+    # 如果原始数据是秒级
+    # ts = TimeSeries.from_series(series, freq='S')  # 秒频率
+    # 保持配置的数值类型（float32 模式下序列内存减半）
+    ts = TimeSeries.from_series(series.astype(SERIES_DTYPE), freq='5T')
+    # 根据指定的时间范围过滤数据
+    if data_start_date or data_end_date:
+        if data_start_date:
+            ts = ts.drop_before(pd.Timestamp(data_start_date))
+        if data_end_date:
+            ts = ts.drop_after(pd.Timestamp(data_end_date))
+    
+    # 划分训练集和验证集
+    train_size = int(len(ts) * train_ratio)
+    ts_train = ts[:train_size]
+    ts_val = ts[train_size:]
+    
+    return ts_train, ts_val
+
+
+def summarize_data():
+    """全部设备的数据概况，有共享快照时直接在快照上统计，否则读取原始数据分组统计"""
+    snapshot = get_snapshot()
+    if snapshot is not None and snapshot.devices:
+        return summarize_snapshot(snapshot)
+    return summarize_devices(load_raw_data())
+
+
+def summarize_devices(df):
+    """按设备统计数据概况（/api/data/preview2 的响应数据）"""
+    # 按设备分组进行统计
+    device_stats = []
+
+    # 对每个设备进行分组统计
+    for ci_id, group in df.groupby('ci_id'):
+        # 获取设备类型（取第一个非空值）
+        ci_type = group['ci_type'].iloc[0] if not group['ci_type'].empty else 'unknown'
+
+        # 获取数据代码（取第一个非空值）
+        code = group['code'].iloc[0] if not group['code'].empty else 'unknown'
+
+        # 计算时间范围
+        data_start_time = _format_time(group['datetime'].min())
+        data_end_time = _format_time(group['datetime'].max())
+
+        # 统计正常值和异常值
+        normal_count = len(group[group['value'] != -2])
+        abnormal_count = len(group[group['value'] == -2])
+
+        # 计算平均值和标准差（仅基于有效数据）
+        valid_data = group[group['value'] > 0]['value']
+        if len(valid_data) > 0:
+            mean_value = float(valid_data.mean())
+            std_value = float(valid_data.std()) if len(valid_data) > 1 else 0.0
+        else:
+            mean_value = -1
+            std_value = -1
+
+        # 构建设备统计信息
+        device_stat = {
+            'ci_id': ci_id,
+            'ci_type': ci_type,
+            'data_start_time': data_start_time,
+            'data_end_time': data_end_time,
+            'code': code,
+            'normal_count': normal_count,
+            'abnormal_count': abnormal_count,
+            'mean': mean_value,
+            'std': std_value
+        }
+
+        device_stats.append(device_stat)
+
+    return _summary_response(device_stats, len(df), df['datetime'].min(), df['datetime'].max())
+
+
+def summarize_snapshot(snapshot):
+    """与 summarize_devices 相同的设备概况，直接基于共享快照的设备元数据和内存映射数组计算
+
+    不还原完整的DataFrame，每个worker不再各自拷贝一份全量数据。
+    """
+    device_stats = []
+    for stat in snapshot.device_stats():
+        device_stats.append({
+            'ci_id': stat['ci_id'],
+            'ci_type': stat['ci_type'],
+            'data_start_time': _format_time(pd.Timestamp(stat['start'])),
+            'data_end_time': _format_time(pd.Timestamp(stat['end'])),
+            'code': stat['code'],
+            'normal_count': stat['records'] - stat['abnormal'],
+            'abnormal_count': stat['abnormal'],
+            'mean': stat['mean'] if stat['valid'] else -1,
+            'std': stat['std'] if stat['valid'] else -1
+        })
+
+    start, end = snapshot.time_range()
+    return _summary_response(device_stats, len(snapshot.values), start, end)
+
+
+def _format_time(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _summary_response(device_stats, total_records, start, end):
+    """汇总设备统计信息，构建 /api/data/preview2 的响应数据结构"""
+    # 按正常数据量降序排序（数据质量好的设备排在前面）
+    device_stats.sort(key=lambda x: x['normal_count'], reverse=True)
+
+    # 计算总体统计信息
+    total_devices = len(device_stats)
+    total_normal = sum(stat['normal_count'] for stat in device_stats)
+    total_abnormal = sum(stat['abnormal_count'] for stat in device_stats)
+
+    # 构建响应数据结构
+    response = {
+        'summary': {
+            'total_devices': total_devices,
+            'total_records': total_records,
+            'total_normal_count': total_normal,
+            'total_abnormal_count': total_abnormal,
+            'data_quality_ratio': round(total_normal / total_records * 100, 2) if total_records > 0 else 0
+        },
+        'records': device_stats,
+        'data_range': {
+            'start': _format_time(start),
+            'end': _format_time(end)
+        }
+    }
+
+    return response
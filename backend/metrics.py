@@ -0,0 +1,406 @@
+import os
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager, ExitStack
+
+# 默认的耗时直方图分桶（秒），覆盖毫秒级的数据读取到分钟级的模型训练
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# 内存直方图分桶（字节），从1MB到8GB按2倍递增
+MEMORY_BUCKETS = tuple(float(2 ** i * 1024 * 1024) for i in range(14))
+# 多进程部署时每个worker定期把指标写入该目录（metrics-*.json），/api/metrics 汇总所有进程的文件后输出；
+# 默认使用共享快照目录，未配置快照目录（单进程开发服务）时只输出本进程的指标
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR', os.getenv('DATA_SNAPSHOT_DIR', ''))
+# 每个进程写入指标文件的间隔（秒）
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+
+
+def _escape(value):
+    """按Prometheus文本格式转义标签值"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metric:
+    """指标基类，按标签值分别保存数据"""
+
+    metric_type = 'untyped'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def label_values(self):
+        """返回已记录的所有标签值组合"""
+        with self._lock:
+            return list(self._values)
+
+    def snapshot(self):
+        """当前进程的全部数据，格式为 [[标签值, 数据]]，用于写入指标文件"""
+        with self._lock:
+            return [[list(labelvalues), json.loads(json.dumps(value))] for labelvalues, value in self._values.items()]
+
+    def merge(self, items):
+        """累加另一个进程的数据"""
+        with self._lock:
+            for labelvalues, value in items:
+                key = tuple(labelvalues)
+                self._values[key] = self._merge_value(self._values.get(key), value)
+
+    def _merge_value(self, current, value):
+        return value if current is None else current + value
+
+    def empty_copy(self):
+        """同名同标签、不含数据的指标，用于汇总多个进程"""
+        copy = object.__new__(type(self))
+        copy.__dict__.update(self.__dict__)
+        copy._lock = threading.Lock()
+        copy._values = {}
+        return copy
+
+    def reset(self):
+        """清空数据（fork出的子进程不继承父进程的统计）"""
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.metric_type}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.extend(self._render_sample(labelvalues, value))
+        return lines
+
+    def _render_sample(self, labelvalues, value):
+        return [f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """可增可减的瞬时值"""
+
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """在代码块执行期间将值加1"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """分桶直方图，记录观测值的分布、总和与次数"""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def _merge_value(self, current, value):
+        if current is None:
+            return {'counts': list(value['counts']), 'sum': value['sum'], 'count': value['count']}
+        current['counts'] = [a + b for a, b in zip(current['counts'], value['counts'])]
+        current['sum'] += value['sum']
+        current['count'] += value['count']
+        return current
+
+    def _render_sample(self, labelvalues, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['counts']):
+            cumulative += count
+            labels = _format_labels(self.labelnames, labelvalues, [('le', _format_value(bound))])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, labelvalues)
+        lines.append(f'{self.name}_sum{labels} {_format_value(state["sum"])}')
+        lines.append(f'{self.name}_count{labels} {state["count"]}')
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表，负责统一输出Prometheus文本格式
+
+    配置 multiproc_dir 时每个进程在后台定期（以及输出前和退出时）把本进程的数据写入 metrics-<pid>-<标识>.json，
+    输出时汇总目录中的所有文件：计数器和直方图累加全部进程（包括已退出的worker），
+    瞬时值只累加仍在运行的进程，派生指标（例如缓存命中率）在汇总之后计算。
+    其他worker的数据最多延迟 flush_interval 秒。
+    """
+
+    def __init__(self, multiproc_dir=METRICS_MULTIPROC_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self._metrics = []
+        self._collectors = []
+        self._derived = []
+        self.multiproc_dir = multiproc_dir
+        self.flush_interval = flush_interval
+        self._file = None
+        self._thread = None
+        self._flush_lock = threading.Lock()
+        if self.multiproc_dir:
+            self._start_process()
+            atexit.register(self.flush)
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self.register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=()):
+        return self.register(Gauge(name, description, labelnames))
+
+    def histogram(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """注册在输出前调用的回调，用于刷新按需计算的指标"""
+        self._collectors.append(collector)
+
+    def add_derived(self, derive):
+        """注册由其他指标计算的指标，derive(按名称索引的指标) 在汇总所有进程之后调用"""
+        self._derived.append(derive)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        metrics = self._metrics
+        if self.multiproc_dir:
+            self.flush()
+            metrics = self._merged()
+        by_name = {metric.name: metric for metric in metrics}
+        for derive in self._derived:
+            derive(by_name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _start_process(self):
+        os.makedirs(self.multiproc_dir, exist_ok=True)
+        self._file = os.path.join(self.multiproc_dir, f'metrics-{os.getpid()}-{time.time_ns()}.json')
+        self._thread = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self._thread.start()
+
+    def _after_fork(self):
+        """fork出的worker从空数据开始统计，并写入自己的文件"""
+        self._flush_lock = threading.Lock()
+        for metric in self._metrics:
+            metric.reset()
+        self._start_process()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def flush(self):
+        """把本进程的数据写入指标文件"""
+        state = {'pid': os.getpid(), 'metrics': {metric.name: metric.snapshot() for metric in self._metrics}}
+        with self._flush_lock:
+            tmp_file = f'{self._file}.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self._file)
+
+    def _merged(self):
+        """汇总目录中所有进程的指标文件"""
+        merged = [metric.empty_copy() for metric in self._metrics]
+        by_name = {metric.name: metric for metric in merged}
+        for name in os.listdir(self.multiproc_dir):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(self.multiproc_dir, name), encoding='utf-8') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _pid_alive(state['pid'])
+            for metric_name, items in state['metrics'].items():
+                metric = by_name.get(metric_name)
+                if metric is not None and (alive or metric.metric_type != 'gauge'):
+                    metric.merge(items)
+        return merged
+
+    def reset_multiproc_dir(self):
+        """删除其他进程遗留的指标文件（服务启动时由主进程调用）"""
+        if not self.multiproc_dir:
+            return
+        for name in os.listdir(self.multiproc_dir):
+            path = os.path.join(self.multiproc_dir, name)
+            if name.startswith('metrics-') and path != self._file:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+# 全局指标注册表（每个worker进程独立统计，配置 METRICS_MULTIPROC_DIR 时输出所有进程的汇总）
+registry = MetricsRegistry()
+
+STAGE_DURATION = registry.histogram(
+    'forecast_stage_duration_seconds', '预测流水线各阶段耗时(秒)', ['stage', 'model'])
+CACHE_REQUESTS = registry.counter(
+    'cache_requests_total', '缓存访问次数', ['cache', 'result'])
+CACHE_HIT_RATIO = registry.gauge(
+    'cache_hit_ratio', '缓存命中率', ['cache'])
+INFLIGHT_FITS = registry.gauge(
+    'forecast_inflight_fits', '正在执行的模型训练数', ['model'])
+INFLIGHT_REQUESTS = registry.gauge(
+    'forecast_inflight_requests', '正在执行的不同预测请求数（相同请求合并后计数）')
+DATA_BYTES_READ = registry.counter(
+    'data_bytes_read_total', '从CSV文件读取的字节数', ['mode'])
+ANOMALY_POINTS = registry.counter(
+    'anomaly_points_total', '异常检测处理的观测点数', ['result'])
+FORECAST_PRECOMPUTE = registry.counter(
+    'forecast_precompute_total', '后台预计算的预测次数', ['result'])
+ADMISSION_QUEUE_DEPTH = registry.gauge(
+    'admission_queue_depth', '等待准入的预测请求数', ['model'])
+ADMISSION_RUNNING = registry.gauge(
+    'admission_running', '已准入正在执行的预测数', ['model'])
+ADMISSION_RUNNING_COST = registry.gauge(
+    'admission_running_cost', '已准入预测的估计成本之和')
+ADMISSION_WAIT = registry.histogram(
+    'admission_wait_seconds', '预测请求等待准入的时间(秒)', ['model'])
+ADMISSION_DECISIONS = registry.counter(
+    'admission_decisions_total', '准入控制的决定次数', ['model', 'result'])
+STAGE_MEMORY = registry.histogram(
+    'forecast_stage_memory_bytes', '预测流水线各阶段的峰值内存分配(字节)', ['stage', 'model'], MEMORY_BUCKETS)
+REQUEST_MEMORY = registry.histogram(
+    'forecast_request_memory_bytes', '每个预测请求的峰值内存分配(字节)', ['model'], MEMORY_BUCKETS)
+MEMORY_LIMIT_ABORTS = registry.counter(
+    'forecast_memory_limit_total', '因超过内存上限被拒绝或中止的请求数', ['model', 'reason'])
+PROCESS_MEMORY = registry.gauge(
+    'process_memory_bytes', '进程内存(字节)，rss 为常驻内存，traced 为 tracemalloc 统计的已分配内存', ['kind'])
+
+# 每个阶段前后执行的附加统计（例如内存分配），元素为 (阶段, 模型) -> 上下文管理器
+_stage_trackers = []
+# 长时间计算中途调用的检查（例如请求内存超过上限时中止），在分批采样、分块拟合等循环中执行
+_checkpoints = []
+
+
+def record_cache(cache, hit):
+    """记录一次缓存访问"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def _update_cache_hit_ratio(metrics):
+    requests, ratio = metrics[CACHE_REQUESTS.name], metrics[CACHE_HIT_RATIO.name]
+    caches = {labelvalues[0] for labelvalues in requests.label_values()}
+    for cache in caches:
+        hits = requests.get(cache=cache, result='hit')
+        total = hits + requests.get(cache=cache, result='miss')
+        ratio.set(hits / total if total else 0.0, cache=cache)
+
+
+registry.add_derived(_update_cache_hit_ratio)
+
+
+def add_stage_tracker(tracker):
+    """注册在 time_stage 的每个阶段前后执行的统计"""
+    _stage_trackers.append(tracker)
+
+
+def add_checkpoint(check):
+    """注册在 checkpoint() 中执行的检查"""
+    _checkpoints.append(check)
+
+
+def checkpoint():
+    """在阶段内部的循环中调用，执行已注册的检查（检查可能抛出异常中止当前请求）"""
+    for check in _checkpoints:
+        check()
+
+
+@contextmanager
+def time_stage(stage, model=''):
+    """统计代码块的耗时并记入对应阶段的直方图，同时执行已注册的附加统计"""
+    with ExitStack() as stack:
+        for tracker in _stage_trackers:
+            stack.enter_context(tracker(stage, model))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            STAGE_DURATION.observe(time.perf_counter() - start, stage=stage, model=model)
+
+
+def render_metrics():
+    """以Prometheus文本格式输出所有指标"""
+    return registry.render()
@@ -1,8 +1,13 @@
 from models.base_model import BaseModel, ParameterConfig
+import numpy as np
 from darts.models import ARIMA
+from metrics import time_stage
+from training_window import TRAINING_WINDOW_MODES, TRAINING_WINDOW_DEFAULT
 
 class ARIMAModel(BaseModel):
     """ARIMA模型实现"""
+
+    supports_covariates = True
     
     def get_name(self):
         return "arima"
@@ -22,8 +27,15 @@ class ARIMAModel(BaseModel):
             'seasonal_order_Q': ParameterConfig('number', default=0, min=0, max=3, description='季节性移动平均阶数', index=8),
             'seasonal_periods': ParameterConfig('number', default=24, min=1, max=168, description='季节性周期(小时)', index=9),
             'confidence_level': ParameterConfig('number', default=0.95, min=0.8, max=0.99, step=0.01, description='置信水平', index=10),
-            'num_samples': ParameterConfig('number', default=1, min=1, max=1000, description='采样数量', index=11)
+            'num_samples': ParameterConfig('number', default=1, min=1, max=1000, description='采样数量（无解析区间时用于估计置信区间）', index=11),
+            'use_covariates': ParameterConfig('boolean', default=False, description='使用日历和节假日协变量', index=12),
+            'training_window': ParameterConfig('select', default=TRAINING_WINDOW_DEFAULT, options=list(TRAINING_WINDOW_MODES), description='训练窗口（auto: 从最后一个变点开始且不超过按季节周期确定的点数）', index=13)
         }
+
+    def seasonal_period(self, params):
+        if any(int(params.get(f'seasonal_order_{name}', 0) or 0) > 0 for name in 'PDQ'):
+            return int(params.get('seasonal_periods', 24))
+        return None
     
     def create_model(self, **params):
         p = int(params.get('p', 2))
@@ -50,21 +62,33 @@ class ARIMAModel(BaseModel):
         
         return model
     
-    def fit(self, model, train_data):
-        model.fit(train_data)
+    def fit(self, model, train_data, future_covariates=None):
+        model.fit(train_data, future_covariates=future_covariates)
         return model
     
-    def predict(self, model, periods):
-        # 使用模型实例中保存的num_samples参数
-        forecast = model.predict(periods, num_samples=getattr(model, 'num_samples', 1))
+    def predict(self, model, periods, future_covariates=None):
+        # 点预测取均值，不物化采样张量；区间单独按置信水平计算
+        forecast = model.predict(periods, future_covariates=future_covariates)
+        confidence_level = float(getattr(model, 'confidence_level', 0.95))
+        with time_stage('predict_interval', self.get_name()):
+            forecast_interval = self.predict_interval(model, forecast, periods, confidence_level,
+                                                      future_covariates)
+        return forecast, forecast_interval
+
+    def predict_interval(self, model, forecast, periods, confidence_level, future_covariates=None):
+        """优先使用statsmodels的解析区间（有协变量时传入预测期的exog），不支持时按num_samples分批采样估计"""
+        try:
+            exog = self.covariate_values(future_covariates, forecast)
+            conf_int = np.asarray(model.model.get_forecast(periods, exog=exog).conf_int(alpha=1 - confidence_level))
+            return self.interval_series(forecast, conf_int[:, 0], conf_int[:, 1])
+        except (AttributeError, ValueError):
+            pass
 
-        # 添加置信区间计算（如果模型支持）
-        if hasattr(model, 'predict_interval'):
-            # 对于支持置信区间的模型
-            forecast_interval = model.predict_interval(periods, alpha=0.05)  # 95%置信区间
-            # 日志记录置信区间数据
-            print(f"ARIMA模型置信区间: {forecast_interval}")
-            return forecast, forecast_interval
-        else:
-            # 对于不支持置信区间的模型，返回None作为区间
-            return forecast, None
\ No newline at end of file
+        num_samples = getattr(model, 'num_samples', 1)
+        if num_samples < 2:
+            return None
+        lower, upper = self.sample_interval(
+            lambda n: model.predict(periods, num_samples=n, future_covariates=future_covariates)
+            .all_values(copy=False)[:, 0, :],
+            num_samples, confidence_level)
+        return self.interval_series(forecast, lower, upper)
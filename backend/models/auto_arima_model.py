@@ -1,9 +1,13 @@
 from models.base_model import BaseModel, ParameterConfig
 from darts.models import AutoARIMA as DartsAutoARIMA
+from metrics import time_stage
+from training_window import TRAINING_WINDOW_MODES, TRAINING_WINDOW_DEFAULT
 
 class AutoARIMAModel(BaseModel):
     """AutoARIMA模型实现"""
 
+    supports_covariates = True
+
     def get_name(self):
         return "auto_arima"
 
@@ -15,9 +19,14 @@ class AutoARIMAModel(BaseModel):
             'season_length': ParameterConfig('number', default=12, min=1, max=24, description='季节性周期', index=1),
             'train_ratio': ParameterConfig('number', default=0.8, min=0.5, max=0.95, step=0.05, description='训练集比例', index=2),
             'confidence_level': ParameterConfig('number', default=0.95, min=0.8, max=0.99, step=0.01, description='置信水平', index=3),
-            'num_samples': ParameterConfig('number', default=1, min=1, max=1000, description='采样数量', index=4)
+            'num_samples': ParameterConfig('number', default=1, min=1, max=1000, description='采样数量（无解析区间时用于估计置信区间）', index=4),
+            'use_covariates': ParameterConfig('boolean', default=False, description='使用日历和节假日协变量', index=5),
+            'training_window': ParameterConfig('select', default=TRAINING_WINDOW_DEFAULT, options=list(TRAINING_WINDOW_MODES), description='训练窗口（auto: 从最后一个变点开始且不超过按季节周期确定的点数）', index=6)
         }
 
+    def seasonal_period(self, params):
+        return int(params.get('season_length', 12))
+
     def create_model(self, **params):
         # 提取AutoARIMA参数
         season_length = int(params.get('season_length', 12))
@@ -40,10 +49,35 @@ class AutoARIMAModel(BaseModel):
         return model
 
     def predict(self, model, periods, future_covariates=None):
-        # 使用模型实例中保存的num_samples参数
-        forecast = model.predict(
-            periods,
-            num_samples=getattr(model, 'num_samples', 1),
-            future_covariates=future_covariates
-        )
-        return forecast
+        # 点预测取均值，不物化采样张量；区间单独按置信水平计算
+        forecast = model.predict(periods, future_covariates=future_covariates)
+        confidence_level = float(getattr(model, 'confidence_level', 0.95))
+        with time_stage('predict_interval', self.get_name()):
+            forecast_interval = self.predict_interval(model, forecast, periods, confidence_level,
+                                                      future_covariates)
+        return forecast, forecast_interval
+
+    def predict_interval(self, model, forecast, periods, confidence_level, future_covariates=None):
+        """优先使用底层AutoARIMA的解析区间（有协变量时传入预测期的外生变量），不支持时按num_samples分批采样估计"""
+        try:
+            inner = model.model
+            exog = self.covariate_values(future_covariates, forecast)
+            if type(inner).__module__.startswith('pmdarima'):
+                _, conf_int = inner.predict(n_periods=periods, X=exog, return_conf_int=True,
+                                            alpha=1 - confidence_level)
+                return self.interval_series(forecast, conf_int[:, 0], conf_int[:, 1])
+            # statsforecast 按传入的level生成 lo-{level}/hi-{level}
+            level = round(confidence_level * 100, 6)
+            result = inner.predict(periods, X=exog, level=[level])
+            return self.interval_series(forecast, result[f'lo-{level}'], result[f'hi-{level}'])
+        except (AttributeError, TypeError, ValueError, KeyError):
+            pass
+
+        num_samples = getattr(model, 'num_samples', 1)
+        if num_samples < 2:
+            return None
+        lower, upper = self.sample_interval(
+            lambda n: model.predict(periods, num_samples=n, future_covariates=future_covariates)
+            .all_values(copy=False)[:, 0, :],
+            num_samples, confidence_level)
+        return self.interval_series(forecast, lower, upper)
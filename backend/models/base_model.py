@@ -1,4 +1,10 @@
 from abc import ABC, abstractmethod
+import numpy as np
+from darts import TimeSeries
+from metrics import checkpoint
+
+# 采样估计区间时每批的样本数，内存占用与总采样数无关
+SAMPLE_BATCH_SIZE = 100
 
 class ParameterConfig:
     """参数配置类，用于描述模型参数的配置信息"""
@@ -28,6 +34,9 @@ class ParameterConfig:
 
 class BaseModel(ABC):
     """时间序列预测模型的抽象基类"""
+
+    # fit/predict 是否接受 future_covariates 参数
+    supports_covariates = False
     
     @abstractmethod
     def get_name(self):
@@ -57,4 +66,80 @@ class BaseModel(ABC):
     @abstractmethod
     def predict(self, model, periods):
         """使用模型进行预测"""
-        pass
\ No newline at end of file
+        pass
+    
+    def seasonal_period(self, params):
+        """按参数确定的季节周期（数据点数），非季节模型返回None，用于确定最大训练窗口"""
+        return None
+
+    @staticmethod
+    def interval_quantiles(confidence_level):
+        """置信水平对应的上下分位数，例如0.95 -> (0.025, 0.975)"""
+        alpha = 1 - float(confidence_level)
+        return alpha / 2, 1 - alpha / 2
+    
+    @staticmethod
+    def interval_series(forecast, lower, upper):
+        """把上下界数组包装为与点预测时间轴相同的区间序列"""
+        return {
+            'lower': TimeSeries.from_times_and_values(forecast.time_index, np.asarray(lower).reshape(-1, 1)),
+            'upper': TimeSeries.from_times_and_values(forecast.time_index, np.asarray(upper).reshape(-1, 1))
+        }
+
+    @staticmethod
+    def covariate_values(future_covariates, forecast):
+        """与预测时间轴对齐的协变量数组，供底层模型的解析区间使用，没有协变量时返回None"""
+        if future_covariates is None:
+            return None
+        return future_covariates.slice_intersect(forecast).values(copy=False)
+
+    @staticmethod
+    def cast_result(result, dtype):
+        """把 predict 的结果统一为 (点预测, 置信区间或None)，并转换为训练序列的数值类型
+
+        statsmodels、pmdarima 等后端内部按双精度计算，float32 模式下在这里转换回 float32。
+        """
+        forecast, interval = result if isinstance(result, tuple) else (result, None)
+        if forecast.dtype != dtype:
+            forecast = forecast.astype(dtype)
+        if interval is not None:
+            interval = {key: band if band.dtype == dtype else band.astype(dtype)
+                        for key, band in interval.items()}
+        return forecast, interval
+    
+    @staticmethod
+    def sample_interval(sample_fn, num_samples, confidence_level, batch_size=SAMPLE_BATCH_SIZE):
+        """分批采样并归约为区间上下界，不保留全部样本
+
+        sample_fn(n) 返回形状为 (步长, n) 的样本。每批只保留计算分位数所需的最小/最大的
+        若干个样本（与np.quantile的线性插值结果完全一致），内存与num_samples无关。
+        """
+        lower_q, upper_q = BaseModel.interval_quantiles(confidence_level)
+        lower_pos = (num_samples - 1) * lower_q
+        upper_pos = (num_samples - 1) * (1 - upper_q)
+        lower_keep = min(int(lower_pos) + 2, num_samples)
+        upper_keep = min(int(upper_pos) + 2, num_samples)
+
+        smallest = largest = None
+        drawn = 0
+        while drawn < num_samples:
+            # 每批之间检查请求是否已超过内存上限
+            checkpoint()
+            batch = np.asarray(sample_fn(min(batch_size, num_samples - drawn)), dtype=float)
+            drawn += batch.shape[1]
+            smallest = batch if smallest is None else np.concatenate([smallest, batch], axis=1)
+            largest = batch if largest is None else np.concatenate([largest, batch], axis=1)
+            if smallest.shape[1] > lower_keep:
+                smallest = np.partition(smallest, lower_keep - 1, axis=1)[:, :lower_keep]
+            if largest.shape[1] > upper_keep:
+                largest = -np.partition(-largest, upper_keep - 1, axis=1)[:, :upper_keep]
+
+        def order_statistic(values, position):
+            index = int(position)
+            upper_index = min(index + 1, values.shape[1] - 1)
+            return values[:, index] + (position - index) * (values[:, upper_index] - values[:, index])
+
+        lower = order_statistic(np.sort(smallest, axis=1), lower_pos)
+        upper = order_statistic(-np.sort(-largest, axis=1), upper_pos)
+        return lower, upper
+
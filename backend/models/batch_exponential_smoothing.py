@@ -0,0 +1,230 @@
+"""批量指数平滑模型
+
+在 (设备数, 时间) 的二维数组上同时拟合所有设备的简单指数平滑、Holt 线性趋势和
+Holt-Winters 加法季节模型。递推按时间逐步进行，每一步在全部设备和全部候选参数组成的
+(设备数, 候选数) 数组上一次完成；参数先在粗网格上搜索一步预测误差平方和最小的组合，
+再以每个设备自己的最优点为中心逐轮缩小步长细化。一次调用即可完成数千个设备的拟合和预测，
+不需要逐设备调用 statsmodels。
+
+递推使用误差修正形式（e 为一步预测误差）：
+    level_t  = level_{t-1} + trend_{t-1} + alpha * e_t
+    trend_t  = trend_{t-1} + beta * e_t
+    season_t = season_{t-m} + gamma * e_t
+其中 beta = alpha * beta*，gamma = (1 - alpha) * gamma*，beta*、gamma* 在 [0, 1] 内搜索，
+保证参数落在常用的可容许区域内。缺失值（NaN）不更新误差，状态按模型外推。
+"""
+import os
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from darts import TimeSeries
+from models.base_model import BaseModel, ParameterConfig
+from metrics import checkpoint
+
+# 每次向量化计算的设备数，限制 (季节周期, 设备数, 候选参数数) 状态数组的内存
+BATCH_ES_CHUNK_ROWS = int(os.getenv('BATCH_ES_CHUNK_ROWS', 512))
+
+SMOOTHING_MODES = ('simple', 'holt', 'holt_winters')
+
+# 参数 (alpha, beta*, gamma*) 的搜索范围
+_LOWER = np.array([0.01, 0.0, 0.0])
+_UPPER = np.array([0.99, 1.0, 1.0])
+
+
+class BatchExponentialSmoothing:
+    """对二维数组的每一行独立拟合指数平滑模型"""
+
+    def __init__(self, mode='holt', seasonal_periods=24, grid_size=5, refine_rounds=3,
+                 chunk_rows=BATCH_ES_CHUNK_ROWS):
+        if mode not in SMOOTHING_MODES:
+            raise ValueError(f"不支持的平滑模式: {mode}，可选: {', '.join(SMOOTHING_MODES)}")
+        self.mode = mode
+        self.seasonal_periods = int(seasonal_periods) if mode == 'holt_winters' else 0
+        self.grid_size = max(int(grid_size), 1)
+        self.refine_rounds = max(int(refine_rounds), 0)
+        self.chunk_rows = max(int(chunk_rows), 1)
+        # 搜索的参数个数：simple 只有 alpha，holt 加 beta*，holt_winters 再加 gamma*
+        self.n_params = SMOOTHING_MODES.index(mode) + 1
+
+    @property
+    def min_length(self):
+        """拟合所需的最少时间点数"""
+        return 2 * self.seasonal_periods if self.seasonal_periods else 2
+
+    def _initial_states(self, y):
+        """由序列开头估计初始水平、趋势和季节项，返回 (level, trend, season[m, n])"""
+        filled = pd.DataFrame(y.T).ffill().bfill().to_numpy().T
+        n = len(filled)
+        m = self.seasonal_periods
+        if m:
+            first = filled[:, :m].mean(axis=1)
+            level = first
+            trend = (filled[:, m:2 * m].mean(axis=1) - first) / m
+            season = (filled[:, :m] - first[:, np.newaxis]).T
+        else:
+            level = filled[:, 0]
+            trend = filled[:, 1] - filled[:, 0] if self.mode == 'holt' else np.zeros(n)
+            season = np.zeros((0, n))
+        return np.nan_to_num(level), np.nan_to_num(trend), np.nan_to_num(season)
+
+    def _smoothing(self, unit):
+        """把搜索空间中的 (alpha, beta*, gamma*) 转换为平滑系数，unit 形状为 (n, 候选数, 参数个数)"""
+        alpha = unit[..., 0]
+        beta = alpha * unit[..., 1] if self.n_params > 1 else np.zeros_like(alpha)
+        gamma = (1 - alpha) * unit[..., 2] if self.n_params > 2 else np.zeros_like(alpha)
+        return alpha, beta, gamma
+
+    def _run(self, values, valid, init, unit):
+        """对每行、每组候选参数执行一遍递推，返回 (误差平方和, level, trend, season)"""
+        alpha, beta, gamma = self._smoothing(unit)
+        level0, trend0, season0 = init
+        candidates = unit.shape[1]
+        level = np.repeat(level0[:, np.newaxis], candidates, axis=1)
+        trend = np.repeat(trend0[:, np.newaxis], candidates, axis=1)
+        season = np.repeat(season0[:, :, np.newaxis], candidates, axis=2)
+        sse = np.zeros_like(level)
+        m = self.seasonal_periods
+        has_trend = self.mode != 'simple'
+
+        error = np.empty_like(level)
+        for t in range(values.shape[1]):
+            # 缺失点的误差按0处理，状态只按模型外推
+            np.subtract(values[:, t, np.newaxis], level, out=error)
+            error -= trend
+            if m:
+                error -= season[t % m]
+            error *= valid[:, t, np.newaxis]
+            if m:
+                season[t % m] += gamma * error
+            sse += error * error
+            level += trend
+            level += alpha * error
+            if has_trend:
+                trend += beta * error
+        return sse, level, trend, season
+
+    def _search(self, values, valid, init, unit):
+        """返回每行误差平方和最小的候选参数，形状为 (n, 参数个数)"""
+        sse = self._run(values, valid, init, unit)[0]
+        best = np.argmin(sse, axis=1)
+        return unit[np.arange(len(unit)), best]
+
+    def _fit_chunk(self, y):
+        valid = np.isfinite(y).astype(np.float64)
+        values = np.nan_to_num(y)
+        init = self._initial_states(y)
+        n, k = len(y), self.n_params
+        lower, upper = _LOWER[:k], _UPPER[:k]
+
+        # 粗网格：各参数取区间内等距的 grid_size 个点，所有行共用
+        step = (upper - lower) / self.grid_size
+        axes = [lower[i] + step[i] * (np.arange(self.grid_size) + 0.5) for i in range(k)]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, k)
+        best = self._search(values, valid, init, np.broadcast_to(grid, (n,) + grid.shape))
+
+        # 细化：以每行的最优点为中心、步长减半，在 3^k 个邻点中选最优（包含中心，误差不会变大）
+        offsets = np.stack(np.meshgrid(*[[-1, 0, 1]] * k, indexing='ij'), axis=-1).reshape(-1, k)
+        for _ in range(self.refine_rounds):
+            step = step / 2
+            candidates = np.clip(best[:, np.newaxis, :] + offsets * step, lower, upper)
+            best = self._search(values, valid, init, candidates)
+
+        sse, level, trend, season = self._run(values, valid, init, best[:, np.newaxis, :])
+        alpha, beta, gamma = self._smoothing(best)
+        return {
+            'alpha': alpha, 'beta': beta, 'gamma': gamma,
+            'level': level[:, 0], 'trend': trend[:, 0],
+            # 季节项按预测步对齐：第 h 步（从1开始）使用 season[(h - 1) % m]
+            'season': np.roll(season[:, :, 0].T, -(y.shape[1] % self.seasonal_periods), axis=1)
+            if self.seasonal_periods else np.zeros((n, 0)),
+            'sse': sse[:, 0],
+            'nobs': valid.sum(axis=1)
+        }
+
+    def fit(self, values):
+        """拟合二维数组 (设备数, 时间) 的每一行，一维数组视为单个设备"""
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            values = values[np.newaxis]
+        if values.shape[1] < self.min_length:
+            raise ValueError(f"数据点数不足: 需要至少 {self.min_length} 个点，实际 {values.shape[1]} 个")
+
+        chunks = []
+        for start in range(0, len(values), self.chunk_rows):
+            # 每个分块之间检查请求是否已超过内存上限
+            checkpoint()
+            chunks.append(self._fit_chunk(values[start:start + self.chunk_rows]))
+        for key in chunks[0]:
+            setattr(self, f'{key}_', np.concatenate([chunk[key] for chunk in chunks]))
+        self.sigma2_ = self.sse_ / np.maximum(self.nobs_ - self.n_params, 1)
+        return self
+
+    def forecast(self, periods, confidence_level=None):
+        """预测未来 periods 步，返回 (预测值, 下界, 上界)，形状均为 (设备数, periods)
+
+        未指定 confidence_level 时上下界为None。区间按加法误差模型的 h 步方差计算：
+        sigma^2 * (1 + sum_{j<h} (alpha + beta*j + gamma*[j % m == 0])^2)。
+        """
+        steps = np.arange(1, periods + 1)
+        mean = self.level_[:, np.newaxis] + self.trend_[:, np.newaxis] * steps
+        m = self.seasonal_periods
+        if m:
+            mean = mean + self.season_[:, (steps - 1) % m]
+        if confidence_level is None:
+            return mean, None, None
+
+        lags = np.arange(1, periods)
+        weights = self.alpha_[:, np.newaxis] + self.beta_[:, np.newaxis] * lags
+        if m:
+            weights = weights + self.gamma_[:, np.newaxis] * (lags % m == 0)
+        variance = self.sigma2_[:, np.newaxis] * np.concatenate(
+            [np.ones((len(mean), 1)), 1 + np.cumsum(weights ** 2, axis=1)], axis=1)
+        width = norm.ppf(1 - (1 - float(confidence_level)) / 2) * np.sqrt(variance)
+        return mean, mean - width, mean + width
+
+
+class BatchExponentialSmoothingModel(BaseModel):
+    """批量指数平滑模型实现，多变量序列的每个分量视为一个设备"""
+
+    def get_name(self):
+        return "batch_ets"
+
+    def get_description(self):
+        return "批量指数平滑 (Simple/Holt/Holt-Winters加法)"
+
+    def get_summary(self):
+        return '在一次数组运算中为大量设备同时拟合指数平滑模型，适合设备群的快速批量预测'
+
+    def get_parameter_config(self):
+        return {
+            'mode': ParameterConfig('select', default='holt', options=list(SMOOTHING_MODES), description='平滑模式', index=1),
+            'seasonal_periods': ParameterConfig('number', default=24, min=2, max=288, description='季节性周期(数据点数，仅Holt-Winters)', index=2),
+            'train_ratio': ParameterConfig('number', default=0.8, min=0.5, max=0.95, step=0.05, description='训练集比例', index=3),
+            'confidence_level': ParameterConfig('number', default=0.95, min=0.8, max=0.99, step=0.01, description='置信水平', index=4),
+            'grid_size': ParameterConfig('number', default=5, min=3, max=15, description='参数粗搜索每维网格点数', index=5),
+            'refine_rounds': ParameterConfig('number', default=3, min=0, max=6, description='参数细化轮数', index=6)
+        }
+
+    def create_model(self, **params):
+        model = BatchExponentialSmoothing(
+            mode=params.get('mode', 'holt'),
+            seasonal_periods=int(params.get('seasonal_periods', 24)),
+            grid_size=int(params.get('grid_size', 5)),
+            refine_rounds=int(params.get('refine_rounds', 3)))
+        model.confidence_level = float(params.get('confidence_level', 0.95))
+        return model
+
+    def fit(self, model, train_data):
+        model.fit(train_data.values(copy=False).T)
+        model.time_index = train_data.time_index
+        model.freq = train_data.freq
+        model.components = train_data.components
+        return model
+
+    def predict(self, model, periods):
+        mean, lower, upper = model.forecast(periods, model.confidence_level)
+        times = pd.date_range(model.time_index[-1] + model.freq, periods=periods, freq=model.freq)
+
+        def to_series(values):
+            return TimeSeries.from_times_and_values(times, values.T, columns=model.components)
+        return to_series(mean), {'lower': to_series(lower), 'upper': to_series(upper)}
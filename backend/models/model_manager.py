@@ -1,12 +1,16 @@
 from models.arima_model import ARIMAModel
 from models.prophet_model import ProphetModel
 from models.auto_arima_model import AutoARIMAModel
+from models.batch_exponential_smoothing import BatchExponentialSmoothingModel
+import json
+import hashlib
 
 class ModelManager:
     """模型管理器，用于注册和管理所有预测模型"""
     
     def __init__(self):
         self.models = {}
+        self._registry_version = None
         self._register_default_models()
     
     def _register_default_models(self):
@@ -14,10 +18,12 @@ class ModelManager:
         self.register_model(ARIMAModel())
         self.register_model(ProphetModel())
         self.register_model(AutoARIMAModel())
+        self.register_model(BatchExponentialSmoothingModel())
     
     def register_model(self, model):
         """注册新模型"""
         self.models[model.get_name()] = model
+        self._registry_version = None
     
     def get_model(self, model_name):
         """获取模型实例"""
@@ -30,7 +36,8 @@ class ModelManager:
             model_list.append({
                 'id': name,
                 'name': model.get_description(),
-                'description': f'专用于存储空间使用率预测的{model.get_description()}模型' if name == 'arima' 
+                'description': model.get_summary() if hasattr(model, 'get_summary')
+                              else f'专用于存储空间使用率预测的{model.get_description()}模型' if name == 'arima' 
                               else 'Facebook开发的基于加法模型的时间序列预测模型，适合有季节性效应的数据'
             })
         return model_list
@@ -41,3 +48,18 @@ class ModelManager:
         if model:
             return model.get_parameter_config()
         return None
+    
+    def registry_version(self):
+        """根据已注册模型及其参数配置计算的版本号，模型变化时随之改变"""
+        if self._registry_version is None:
+            description = {
+                name: {
+                    'description': model.get_description(),
+                    'parameters': {key: config.to_dict() if hasattr(config, 'to_dict') else config
+                                   for key, config in model.get_parameter_config().items()}
+                }
+                for name, model in self.models.items()
+            }
+            payload = json.dumps(description, sort_keys=True, default=str).encode('utf-8')
+            self._registry_version = hashlib.sha1(payload).hexdigest()[:16]
+        return self._registry_version
@@ -0,0 +1,44 @@
+"""序列数值精度配置
+
+SERIES_DTYPE=float32 时，数据从读取CSV开始就以单精度保存：共享快照、多分辨率汇总、
+按设备加载的序列以及传给模型的 TimeSeries 都使用 float32，每个缓存序列的常驻内存约减半。
+模型内部（statsmodels、pmdarima、Prophet）仍按双精度计算，预测结果再转换回 float32。
+
+单精度只有约7位有效数字，序列化为JSON时按 SERIES_JSON_DECIMALS 位小数取整，
+避免把 float32 转为 float64 后产生的无意义尾数（如 54.12345123291016）写入响应。
+"""
+import os
+import numpy as np
+
+# 序列数值类型：float64（默认）或 float32
+SERIES_DTYPE = np.dtype(os.getenv('SERIES_DTYPE', 'float64'))
+if SERIES_DTYPE not in (np.dtype(np.float32), np.dtype(np.float64)):
+    raise ValueError(f"不支持的 SERIES_DTYPE: {SERIES_DTYPE}，可选: float32, float64")
+
+# 序列化时保留的小数位数，未配置时 float32 模式保留4位，float64 模式不取整
+_decimals = os.getenv('SERIES_JSON_DECIMALS', '4' if SERIES_DTYPE == np.float32 else '')
+SERIES_JSON_DECIMALS = int(_decimals) if _decimals.strip() else None
+
+
+def as_series_dtype(values):
+    """转换为配置的序列数值类型，类型已一致时不拷贝"""
+    return np.asarray(values, dtype=SERIES_DTYPE)
+
+
+def to_json_list(values, decimals=SERIES_JSON_DECIMALS):
+    """数值数组转为JSON列表，按配置的小数位数取整；NaN/inf 转为None（JSON中没有对应的值）
+
+    布尔和整数数组原样转换。
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'biu':
+        return values.tolist()
+    values = values.astype(np.float64)
+    if decimals is not None:
+        values = np.round(values, decimals)
+    finite = np.isfinite(values)
+    if finite.all():
+        return values.tolist()
+    result = values.astype(object)
+    result[~finite] = None
+    return result.tolist()
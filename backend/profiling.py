@@ -0,0 +1,123 @@
+import os
+import io
+import json
+import uuid
+import pstats
+import cProfile
+import tempfile
+from functools import wraps
+from flask import g, jsonify, make_response, request
+from loguru import logger
+
+# 性能分析开关，关闭时被装饰的接口只多一次布尔判断
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '0').lower() in ('1', 'true', 'yes')
+# 允许使用性能分析的来源地址（逗号分隔）
+PROFILING_TRUSTED_HOSTS = {
+    host.strip() for host in os.getenv('PROFILING_TRUSTED_HOSTS', '127.0.0.1,::1').split(',') if host.strip()
+}
+# 可选的访问令牌，通过 X-Profile-Token 请求头传递，匹配时不限制来源地址
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+# 性能分析文件保存目录
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'darts_profiles'))
+# 热点摘要默认返回的函数数量
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '25'))
+
+
+def is_trusted_caller():
+    """判断当前请求方是否允许使用性能分析"""
+    if PROFILING_TOKEN and request.headers.get('X-Profile-Token') == PROFILING_TOKEN:
+        return True
+    return request.remote_addr in PROFILING_TRUSTED_HOSTS
+
+
+def is_profiling():
+    """当前请求是否正在进行性能分析"""
+    return g.get('profiling', False)
+
+
+def summarize_profile(profiler, top_n=PROFILE_TOP_N, sort='cumulative'):
+    """将cProfile结果整理为按指定列排序的热点函数列表"""
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    stats.sort_stats(sort)
+    hotspots = []
+    for func in stats.fcn_list[:top_n]:
+        primitive_calls, total_calls, tottime, cumtime, _ = stats.stats[func]
+        filename, line, name = func
+        hotspots.append({
+            'function': name,
+            'location': f'{filename}:{line}',
+            'calls': total_calls,
+            'primitive_calls': primitive_calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6)
+        })
+    return {
+        'total_time': round(stats.total_tt, 6),
+        'sort': sort,
+        'hotspots': hotspots
+    }
+
+
+def save_profile(profiler):
+    """保存完整的性能分析文件（可用 snakeviz / pstats 打开），返回文件名"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f'{uuid.uuid4().hex}.prof'
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    return name
+
+
+def _attach_profile(response, profile):
+    """把热点摘要附加到JSON响应体中，非JSON响应则放入响应头"""
+    body = response.get_data(as_text=True)
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        payload = None
+
+    if isinstance(payload, dict):
+        payload['profile'] = profile
+        response.set_data(json.dumps(payload, ensure_ascii=False))
+    else:
+        response.headers['X-Profile-Total-Time'] = str(profile['summary']['total_time'])
+    if profile.get('download_url'):
+        response.headers['X-Profile-Url'] = profile['download_url']
+    return response
+
+
+def profiled(view):
+    """为接口增加按需性能分析
+
+    请求带有 ?profile=1（或 X-Profile 请求头）时，仅对该请求运行cProfile，
+    并在响应中返回热点函数摘要；?profile=file 时同时保存完整分析文件并返回下载地址。
+    可选参数 profile_top 和 profile_sort 控制摘要的条数和排序列。
+    需要 PROFILING_ENABLED 开启，且调用方在受信任地址列表中或提供正确的令牌。
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not PROFILING_ENABLED:
+            return view(*args, **kwargs)
+
+        mode = request.args.get('profile') or request.headers.get('X-Profile')
+        if not mode or mode == '0':
+            return view(*args, **kwargs)
+
+        if not is_trusted_caller():
+            return jsonify({'error': '无权使用性能分析'}), 403
+
+        top_n = int(request.args.get('profile_top', PROFILE_TOP_N))
+        sort = request.args.get('profile_sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'calls'):
+            return jsonify({'error': f'不支持的排序方式: {sort}'}), 400
+
+        g.profiling = True
+        profiler = cProfile.Profile()
+        result = profiler.runcall(view, *args, **kwargs)
+        response = make_response(result)
+
+        profile = {'summary': summarize_profile(profiler, top_n, sort)}
+        if mode == 'file':
+            profile['download_url'] = f'/api/profiles/{save_profile(profiler)}'
+        logger.info(f"性能分析 {request.path}: 总耗时 {profile['summary']['total_time']}s")
+        return _attach_profile(response, profile)
+
+    return wrapper
@@ -0,0 +1,224 @@
+"""按设备预先计算的多分辨率汇总数据
+
+对每个设备的有效数据（value > 0）按5分钟、小时、天三个粒度预先计算 count/mean/min/max，
+数据版本不变时重复使用。请求某个频率的数据时，从能整除该频率的最粗粒度汇总中读取，
+再按需要合并到请求的频率，因此请求的开销只与输出的点数有关，而与原始数据的长度无关。
+
+每个粒度的数据按 (设备, 时间) 排序后拼接为连续数组，可以保存为 .npy 文件并以内存映射方式加载
+（与数据快照一起发布时多个worker共享同一份内存）。mean/min/max 使用 dtype 指定的数值类型保存
+（float32 时内存约为 float64 的一半），合并计算在 float64 下进行。
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+# 汇总粒度：名称 -> 时间步长，由细到粗
+ROLLUP_LEVELS = (
+    ('5min', pd.Timedelta(minutes=5)),
+    ('hourly', pd.Timedelta(hours=1)),
+    ('daily', pd.Timedelta(days=1)),
+)
+
+ROLLUP_FIELDS = ('times', 'count', 'mean', 'min', 'max')
+
+
+def _reduce_groups(codes, buckets, count, total, minimum, maximum):
+    """按 (设备编码, 时间桶) 合并已排序的记录，返回合并后的各数组"""
+    if len(codes) == 0:
+        empty = np.zeros(0)
+        return codes, buckets, empty.astype(np.int64), empty, empty, empty
+    starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (buckets[1:] != buckets[:-1])])
+    return (codes[starts], buckets[starts],
+            np.add.reduceat(count, starts),
+            np.add.reduceat(total, starts),
+            np.minimum.reduceat(minimum, starts),
+            np.maximum.reduceat(maximum, starts))
+
+
+class Rollup:
+    """一个粒度的全部设备汇总数据"""
+
+    def __init__(self, name, step, devices, offsets, times, count, mean, minimum, maximum):
+        self.name = name
+        self.step = step
+        self.devices = list(devices)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.times = times
+        self.count = count
+        self.mean = mean
+        self.min = minimum
+        self.max = maximum
+        self._device_index = {device: i for i, device in enumerate(self.devices)}
+
+    @classmethod
+    def _from_groups(cls, name, step, devices, dtype, codes, buckets, count, total, minimum, maximum):
+        offsets = np.searchsorted(codes, np.arange(len(devices) + 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        return cls(name, step, devices, offsets, buckets, count,
+                   mean.astype(dtype), minimum.astype(dtype), maximum.astype(dtype))
+
+    @classmethod
+    def from_raw(cls, df, name, step, dtype=np.float64):
+        """由原始数据（ci_id, datetime, value）计算汇总，只统计 value > 0 的记录"""
+        valid = df[df['value'] > 0]
+        codes, devices = pd.factorize(valid['ci_id'], sort=True)
+        times = valid['datetime'].values.astype('datetime64[ns]').astype(np.int64)
+        buckets = times // step.value * step.value
+        values = valid['value'].to_numpy(dtype=np.float64)
+
+        order = np.lexsort((buckets, codes))
+        codes, buckets, values = codes[order], buckets[order], values[order]
+        groups = _reduce_groups(codes, buckets, np.ones(len(values), dtype=np.int64), values, values, values)
+        return cls._from_groups(name, step, [str(device) for device in devices], dtype, *groups)
+
+    def coarsen(self, name, step):
+        """由当前粒度合并出更粗的粒度"""
+        codes = np.repeat(np.arange(len(self.devices)), np.diff(self.offsets))
+        buckets = np.asarray(self.times) // step.value * step.value
+        count = np.asarray(self.count)
+        groups = _reduce_groups(codes, buckets, count, np.asarray(self.mean, dtype=np.float64) * count,
+                                np.asarray(self.min), np.asarray(self.max))
+        return self._from_groups(name, step, self.devices, self.mean.dtype, *groups)
+
+    def device_slice(self, ci_id, start=None, end=None):
+        """返回设备在 [start, end] 时间范围内的位置区间，设备不存在时返回None"""
+        index = self._device_index.get(str(ci_id))
+        if index is None:
+            return None
+        lo, hi = int(self.offsets[index]), int(self.offsets[index + 1])
+        times = self.times[lo:hi]
+        if start is not None:
+            lo += int(np.searchsorted(times, pd.Timestamp(start).value, side='left'))
+        if end is not None:
+            hi = self.offsets[index] + int(np.searchsorted(times, pd.Timestamp(end).value, side='right'))
+        return lo, max(lo, int(hi))
+
+    def device_frame(self, ci_id, start=None, end=None):
+        """返回设备的汇总数据，索引为时间，列为 count/mean/min/max"""
+        bounds = self.device_slice(ci_id, start, end)
+        lo, hi = bounds if bounds is not None else (0, 0)
+        return pd.DataFrame({
+            'count': np.asarray(self.count[lo:hi]),
+            'mean': np.asarray(self.mean[lo:hi]),
+            'min': np.asarray(self.min[lo:hi]),
+            'max': np.asarray(self.max[lo:hi])
+        }, index=pd.DatetimeIndex(np.asarray(self.times[lo:hi]).astype('datetime64[ns]'), name='datetime'))
+
+    def device_counts(self):
+        """每个设备的有效记录总数"""
+        return np.add.reduceat(np.asarray(self.count), self.offsets[:-1]) if len(self.count) else \
+            np.zeros(len(self.devices), dtype=np.int64)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for field in ROLLUP_FIELDS:
+            np.save(os.path.join(directory, f'{field}.npy'), np.asarray(getattr(self, field)))
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+        with open(os.path.join(directory, 'devices.json'), 'w', encoding='utf-8') as f:
+            json.dump({'name': self.name, 'step': self.step.value, 'devices': self.devices}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'devices.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        arrays = {field: np.load(os.path.join(directory, f'{field}.npy'), mmap_mode=mmap_mode)
+                  for field in ROLLUP_FIELDS}
+        return cls(meta['name'], pd.Timedelta(meta['step']), meta['devices'],
+                   np.load(os.path.join(directory, 'offsets.npy')), arrays['times'],
+                   arrays['count'], arrays['mean'], arrays['min'], arrays['max'])
+
+
+class RollupSet:
+    """同一数据版本的全部粒度汇总"""
+
+    def __init__(self, version, levels):
+        self.version = version
+        self.levels = levels
+
+    @classmethod
+    def build(cls, df, version, dtype=np.float64):
+        """由原始数据计算最细粒度，再逐级合并出更粗的粒度"""
+        levels = {}
+        previous = None
+        for name, step in ROLLUP_LEVELS:
+            previous = Rollup.from_raw(df, name, step, dtype) if previous is None else previous.coarsen(name, step)
+            levels[name] = previous
+        return cls(version, levels)
+
+    def save(self, directory):
+        for name, rollup in self.levels.items():
+            rollup.save(os.path.join(directory, name))
+        with open(os.path.join(directory, 'version'), 'w', encoding='utf-8') as f:
+            f.write(self.version)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """加载保存的汇总，不存在时返回None"""
+        version_file = os.path.join(directory, 'version')
+        if not os.path.exists(version_file):
+            return None
+        with open(version_file, encoding='utf-8') as f:
+            version = f.read().strip()
+        return cls(version, {name: Rollup.load(os.path.join(directory, name), mmap_mode)
+                             for name, _ in ROLLUP_LEVELS})
+
+    def select(self, freq=None, start=None, end=None, max_points=None):
+        """选择满足请求频率的最粗粒度，返回 (汇总, 请求频率的Timedelta)
+
+        freq 为空时按 max_points 自动选择：在时间范围内点数不超过 max_points 的最细粒度，
+        都超过时使用最粗粒度。非固定长度的频率（如月）使用天粒度再合并。
+        """
+        if freq is None:
+            chosen = self.levels[ROLLUP_LEVELS[-1][0]]
+            if max_points and start is not None and end is not None:
+                span = pd.Timestamp(end) - pd.Timestamp(start)
+                for name, step in ROLLUP_LEVELS:
+                    if span / step <= max_points:
+                        chosen = self.levels[name]
+                        break
+            return chosen, chosen.step
+
+        try:
+            requested = pd.Timedelta(pd.tseries.frequencies.to_offset(freq))
+        except ValueError:
+            return self.levels[ROLLUP_LEVELS[-1][0]], None
+        chosen = self.levels[ROLLUP_LEVELS[0][0]]
+        for name, step in ROLLUP_LEVELS:
+            if requested >= step and requested.value % step.value == 0:
+                chosen = self.levels[name]
+        return chosen, requested
+
+    def best_device(self):
+        """有效记录最多的设备"""
+        rollup = self.levels[ROLLUP_LEVELS[-1][0]]
+        if not rollup.devices:
+            return None
+        return rollup.devices[int(np.argmax(rollup.device_counts()))]
+
+    def device_series(self, ci_id, freq='H', start=None, end=None, max_points=None):
+        """返回设备在请求频率下的 count/mean/min/max（只包含有数据的时间点）
+
+        返回 (DataFrame, 使用的汇总粒度名称)。
+        """
+        if freq is None and max_points and (start is None or end is None):
+            # 未指定时间范围时按设备自身的数据跨度选择粒度
+            coarsest = self.levels[ROLLUP_LEVELS[-1][0]]
+            bounds = coarsest.device_slice(ci_id)
+            if bounds is not None and bounds[1] > bounds[0]:
+                start = start if start is not None else pd.Timestamp(int(coarsest.times[bounds[0]]))
+                end = end if end is not None else pd.Timestamp(int(coarsest.times[bounds[1] - 1])) + coarsest.step
+        rollup, requested = self.select(freq, start, end, max_points)
+        frame = rollup.device_frame(ci_id, start, end)
+        if freq is None or (requested is not None and requested == rollup.step) or frame.empty:
+            return frame, rollup.name
+
+        # 合并到请求的频率（按记录数加权平均）
+        dtype = frame['mean'].dtype
+        frame['total'] = frame['mean'].astype(np.float64) * frame['count']
+        grouped = frame.resample(freq if requested is None else requested).agg(
+            {'count': 'sum', 'total': 'sum', 'min': 'min', 'max': 'max'})
+        grouped = grouped[grouped['count'] > 0]
+        grouped['mean'] = (grouped['total'] / grouped['count']).astype(dtype)
+        return grouped[['count', 'mean', 'min', 'max']], rollup.name
@@ -0,0 +1,148 @@
+"""自动选择训练窗口
+
+历史数据越长，ARIMA/AutoARIMA 的训练越慢，而较早的数据（例如扩容之前）往往处于不同的状态，
+反而降低预测精度。训练窗口按 training_window 参数从训练集末尾截取：
+- all: 使用全部训练数据（原有行为）
+- change_point: 从最后一个变点开始
+- max_window: 最多使用 max(TRAINING_WINDOW_SEASONS 个季节周期, TRAINING_WINDOW_POINTS) 个点，
+  不超过 TRAINING_WINDOW_MAX_POINTS
+- auto: 两者都满足，即取较晚的起点
+auto 和 max_window 下训练点数有上限，训练耗时不再随历史增长。
+
+变点检测先把训练序列按天取均值（消除日内季节性），用分段线性模型做二分分割：
+对每个候选分割点，比较整段和两段分别线性回归的残差平方和，
+n * log(SSE整段 / SSE两段) 超过 CHANGE_POINT_PENALTY * log(n) 时接受该分割并继续分割两侧。
+趋势本身不会被视为变点，水平突变（扩容、清理）和增长速度的变化会被检出。
+检出的变点再在前后各一天的原始数据上重新定位到具体时间点。
+"""
+import os
+import numpy as np
+import pandas as pd
+
+# 未指定时的训练窗口模式
+TRAINING_WINDOW_DEFAULT = os.getenv('TRAINING_WINDOW_DEFAULT', 'all')
+# 非季节模型的窗口点数，以及季节模型的窗口包含的季节周期数
+TRAINING_WINDOW_POINTS = int(os.getenv('TRAINING_WINDOW_POINTS', 2016))
+TRAINING_WINDOW_SEASONS = int(os.getenv('TRAINING_WINDOW_SEASONS', 10))
+# 窗口点数的上下限
+TRAINING_WINDOW_MAX_POINTS = int(os.getenv('TRAINING_WINDOW_MAX_POINTS', 8064))
+TRAINING_WINDOW_MIN_POINTS = int(os.getenv('TRAINING_WINDOW_MIN_POINTS', 288))
+# 变点检测的惩罚系数和两个变点之间的最少天数
+CHANGE_POINT_PENALTY = float(os.getenv('CHANGE_POINT_PENALTY', 8))
+CHANGE_POINT_MIN_DAYS = int(os.getenv('CHANGE_POINT_MIN_DAYS', 2))
+
+TRAINING_WINDOW_MODES = ('all', 'auto', 'change_point', 'max_window')
+
+
+def _cumsums(y):
+    """计算 [1, t, t^2, y, y^2, t*y] 的前缀和，第一列为0"""
+    t = np.arange(len(y), dtype=np.float64)
+    stacked = np.stack([np.ones_like(y), t, t * t, y, y * y, t * y])
+    return np.concatenate([np.zeros((6, 1)), np.cumsum(stacked, axis=1)], axis=1)
+
+
+def _sse(cum, a, b):
+    """[a, b) 段线性回归的残差平方和，a、b 为位置数组（可广播）"""
+    a, b = np.broadcast_arrays(np.atleast_1d(a), np.atleast_1d(b))
+    n, st, stt, sy, syy, sty = cum[:, b] - cum[:, a]
+    sxx = stt - st * st / n
+    sxy = sty - st * sy / n
+    residual = syy - sy * sy / n - np.divide(sxy * sxy, sxx, out=np.zeros_like(sxx), where=sxx > 0)
+    return np.maximum(residual, 0.0)
+
+
+def _best_split(cum, a, b, min_size, gap=0):
+    """[a, b) 内残差平方和最小的分割点，返回 (位置, 整段SSE, 两段SSE)
+
+    gap 为分割点之前不计入左段的点数（跨越变点的混合时间桶）。
+    """
+    splits = np.arange(a + min_size + gap, b - min_size + 1)
+    children = _sse(cum, a, splits - gap) + _sse(cum, splits, b)
+    best = int(np.argmin(children))
+    return int(splits[best]), float(_sse(cum, a, b)[0]), float(children[best])
+
+
+def detect_change_points(values, min_size=CHANGE_POINT_MIN_DAYS, penalty=CHANGE_POINT_PENALTY, gap=1):
+    """对等间隔序列做分段线性二分分割，返回变点位置（新分段的起点，升序）
+
+    按天聚合时变点当天的均值混合了前后两种状态，默认不计入任何一段，避免在其后再检出一个假变点。
+    """
+    y = np.asarray(values, dtype=np.float64)
+    min_size = max(int(min_size), 2)
+    cum = _cumsums(y)
+    found = []
+    segments = [(0, len(y))]
+    while segments:
+        a, b = segments.pop()
+        if b - a < 2 * min_size + gap:
+            continue
+        split, total, children = _best_split(cum, a, b, min_size, gap)
+        if total <= 0:
+            continue
+        gain = (b - a) * np.log(total / max(children, total * 1e-12))
+        if gain > penalty * np.log(b - a):
+            found.append(split)
+            segments.extend([(a, split - gap), (split, b)])
+    return sorted(found)
+
+
+def locate_change_points(series, min_days=CHANGE_POINT_MIN_DAYS, penalty=CHANGE_POINT_PENALTY):
+    """检测 TimeSeries 的变点，返回变点时间（新状态的第一个时间点）列表"""
+    values = series.pd_series()
+    daily = values.resample('D').mean().dropna()
+    change_points = []
+    for day in detect_change_points(daily.to_numpy(), min_days, penalty):
+        # 在变点前后各一天的原始数据上重新定位
+        around = values[daily.index[day - 1]:daily.index[day] + pd.Timedelta(days=1)].dropna()
+        if len(around) >= 4:
+            split, _, _ = _best_split(_cumsums(around.to_numpy(dtype=np.float64)), 0, len(around), 2)
+            change_points.append(around.index[split])
+        else:
+            change_points.append(daily.index[day])
+    return change_points
+
+
+def max_window_points(seasonal_period=None):
+    """按模型季节周期确定的最大训练点数"""
+    points = TRAINING_WINDOW_POINTS
+    if seasonal_period:
+        points = max(points, TRAINING_WINDOW_SEASONS * int(seasonal_period))
+    return min(points, TRAINING_WINDOW_MAX_POINTS)
+
+
+def select_training_window(series, mode=TRAINING_WINDOW_DEFAULT, seasonal_period=None):
+    """从训练序列末尾截取训练窗口，返回 (训练序列, 窗口信息)"""
+    if mode not in TRAINING_WINDOW_MODES:
+        raise ValueError(f"不支持的训练窗口: {mode}，可选: {', '.join(TRAINING_WINDOW_MODES)}")
+    total = len(series)
+    start = 0
+    reason = 'all'
+    change_points = []
+
+    if mode in ('auto', 'change_point'):
+        change_points = locate_change_points(series)
+        if change_points:
+            start = int(series.time_index.searchsorted(change_points[-1]))
+            reason = 'change_point'
+    if mode in ('auto', 'max_window'):
+        limit = max_window_points(seasonal_period)
+        if total - start > limit:
+            start = total - limit
+            reason = 'max_window'
+
+    # 季节模型至少需要若干个完整周期
+    min_points = max(TRAINING_WINDOW_MIN_POINTS, 3 * int(seasonal_period or 0))
+    if start and total - start < min_points:
+        start = max(total - min_points, 0)
+        reason = 'min_points'
+
+    window = series[start:] if start else series
+    return window, {
+        'mode': mode,
+        'reason': reason,
+        'start': window.start_time().strftime('%Y-%m-%d %H:%M:%S'),
+        'end': window.end_time().strftime('%Y-%m-%d %H:%M:%S'),
+        'points': len(window),
+        'total_points': total,
+        'change_points': [point.strftime('%Y-%m-%d %H:%M:%S') for point in change_points]
+    }
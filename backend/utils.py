@@ -2,9 +2,9 @@ import pandas as pd
 import numpy as np
 from darts import TimeSeries
 from darts.dataprocessing.transformers import Scaler, MissingValuesFiller
-from darts.metrics import mape, rmse, mae, mse
 from datetime import datetime, timedelta
 import logging
+from precision import to_json_list
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -91,6 +91,164 @@ class TimeSeriesPreprocessor:
             logger.error(f"创建TimeSeries对象时出错: {str(e)}")
             raise
     
+    @staticmethod
+    def infer_frequency(df, group_col='ci_id', time_col='time', sample_size=10000):
+        """从样本中推断采样频率（组内相邻时间差的众数），返回pandas频率字符串
+
+        df 需已按 (group_col, time_col) 排序，只检查前 sample_size 行。
+        """
+        sample = df.iloc[:sample_size]
+        times = sample[time_col].values.astype('datetime64[ns]').astype(np.int64)
+        codes = pd.factorize(sample[group_col])[0]
+        same_group = codes[1:] == codes[:-1]
+        diffs = np.diff(times)[same_group]
+        diffs = diffs[diffs > 0]
+        if len(diffs) == 0:
+            raise ValueError("样本数据不足，无法推断频率")
+        unique, counts = np.unique(diffs, return_counts=True)
+        return pd.tseries.frequencies.to_offset(pd.Timedelta(int(unique[np.argmax(counts)]), unit='ns')).freqstr
+
+    def clean_grouped_data(self, df, group_col='ci_id', time_col='time', value_col='value',
+                           freq=None, sample_size=10000, missing_markers=(-2,)):
+        """按设备分组一次性清理多条时间序列
+
+        与 clean_data 的处理步骤相同（去重、排序、线性插值、IQR异常值截断），
+        但所有设备在一次向量化计算中完成：时间对齐到统一频率的规则网格，
+        缺失的时间点补为空值后在组内插值，IQR边界按设备分别计算。
+        missing_markers 中的值（如 -2 连接失败）视为缺失值。
+        返回按 (group_col, time_col) 排序、只包含这三列的DataFrame。
+        """
+        try:
+            df = df[[group_col, time_col, value_col]].copy()
+            df[time_col] = pd.to_datetime(df[time_col])
+            df[value_col] = df[value_col].astype(float)
+            if missing_markers:
+                df.loc[df[value_col].isin(missing_markers), value_col] = np.nan
+
+            # 从按时间排序的样本推断频率，并把时间对齐到该频率的网格上
+            freq = freq or self.infer_frequency(
+                df.sort_values([group_col, time_col], kind='mergesort'), group_col, time_col, sample_size)
+            step = pd.Timedelta(pd.tseries.frequencies.to_offset(freq)).value
+            df[time_col] = df[time_col].dt.floor(freq)
+
+            # 组内去除重复时间点（与 clean_data 相同，按原始行顺序保留第一条），再按设备和时间排序
+            df = df.drop_duplicates(subset=[group_col, time_col], keep='first')
+            df = df.sort_values([group_col, time_col], kind='mergesort')
+
+            codes, groups = pd.factorize(df[group_col], sort=False)
+            slots = df[time_col].values.astype(np.int64)
+            group_start = pd.Series(slots).groupby(codes).min().to_numpy()
+            group_end = pd.Series(slots).groupby(codes).max().to_numpy()
+
+            # 为每个设备生成从最早到最晚时间的完整网格
+            lengths = (group_end - group_start) // step + 1
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            total = int(lengths.sum())
+            grid_codes = np.repeat(np.arange(len(groups)), lengths)
+            grid_slots = np.arange(total) - np.repeat(offsets, lengths)
+            grid_times = np.repeat(group_start, lengths) + grid_slots * step
+
+            values = np.full(total, np.nan)
+            positions = offsets[codes] + (slots - group_start[codes]) // step
+            values[positions] = df[value_col].to_numpy()
+
+            missing_count = int(np.isnan(values).sum())
+            if missing_count > 0:
+                logger.info(f"发现 {missing_count} 个缺失值，将按设备进行插值处理")
+                values = self._grouped_linear_interpolate(values, grid_codes)
+
+            # 按设备计算IQR边界并截断异常值
+            grouped = pd.Series(values).groupby(grid_codes)
+            q1 = grouped.quantile(0.25).reindex(range(len(groups))).to_numpy()[grid_codes]
+            q3 = grouped.quantile(0.75).reindex(range(len(groups))).to_numpy()[grid_codes]
+            iqr = q3 - q1
+            lower_bound = q1 - 1.5 * iqr
+            upper_bound = q3 + 1.5 * iqr
+
+            outliers_count = int(((values < lower_bound) | (values > upper_bound)).sum())
+            if outliers_count > 0:
+                logger.info(f"发现 {outliers_count} 个异常值，将按设备边界进行处理")
+                values = np.where(values < lower_bound, lower_bound, values)
+                values = np.where(values > upper_bound, upper_bound, values)
+
+            return pd.DataFrame({
+                group_col: np.asarray(groups, dtype=object)[grid_codes],
+                time_col: pd.to_datetime(grid_times),
+                value_col: values
+            })
+
+        except Exception as e:
+            logger.error(f"分组数据清理过程中出错: {str(e)}")
+            raise
+
+    @staticmethod
+    def _grouped_linear_interpolate(values, codes):
+        """组内按位置线性插值，行为与 Series.interpolate(method='linear') 一致：
+
+        开头的缺失值保持为空，末尾的缺失值用最后一个有效值填充，插值不跨越设备边界。
+        """
+        positions = np.arange(len(values), dtype=float)
+        valid = ~np.isnan(values)
+        frame = pd.DataFrame({
+            'pos': np.where(valid, positions, np.nan),
+            'val': values
+        })
+        grouped = frame.groupby(codes)
+        prev = grouped.ffill()
+        nxt = grouped.bfill()
+
+        span = nxt['pos'].to_numpy() - prev['pos'].to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(span > 0, (positions - prev['pos'].to_numpy()) / span, 0.0)
+        interpolated = prev['val'].to_numpy() + (nxt['val'].to_numpy() - prev['val'].to_numpy()) * weight
+        # 末尾没有后续有效值时沿用前一个有效值
+        interpolated = np.where(np.isnan(nxt['pos'].to_numpy()), prev['val'].to_numpy(), interpolated)
+        return np.where(valid, values, interpolated)
+
+    def create_grouped_time_series(self, df, group_col='ci_id', time_col='time', value_col='value',
+                                   freq=None, sample_size=10000, min_length=1, clean=True):
+        """将多设备数据转换为每个设备一条的Darts TimeSeries列表，用于批量训练
+
+        clean=True 时先调用 clean_grouped_data 进行向量化清理；
+        与 TimeSeries.from_group_dataframe 一致，设备ID保存在每条序列的静态协变量中。
+        开头仍为空值的点会被去除，长度不足 min_length 的设备被跳过。
+        """
+        try:
+            if clean:
+                df = self.clean_grouped_data(df, group_col, time_col, value_col, freq, sample_size)
+                freq = freq or self.infer_frequency(df, group_col, time_col, sample_size)
+            elif freq is None:
+                df = df.sort_values([group_col, time_col], kind='mergesort')
+                freq = self.infer_frequency(df, group_col, time_col, sample_size)
+
+            codes, groups = pd.factorize(df[group_col], sort=False)
+            boundaries = np.flatnonzero(np.diff(codes)) + 1
+            starts = np.concatenate(([0], boundaries))
+            ends = np.concatenate((boundaries, [len(codes)]))
+            times = pd.DatetimeIndex(df[time_col])
+            values = df[value_col].to_numpy(dtype=float)
+
+            series_list = []
+            for group, start, end in zip(groups, starts, ends):
+                group_values = values[start:end]
+                first_valid = np.argmax(~np.isnan(group_values)) if (~np.isnan(group_values)).any() else len(group_values)
+                if end - start - first_valid < min_length:
+                    continue
+                series = TimeSeries.from_times_and_values(
+                    times[start + first_valid:end],
+                    group_values[first_valid:],
+                    freq=freq,
+                    columns=[value_col],
+                    static_covariates=pd.DataFrame({group_col: [group]})
+                )
+                series_list.append(series)
+
+            return series_list
+
+        except Exception as e:
+            logger.error(f"创建分组TimeSeries对象时出错: {str(e)}")
+            raise
+
     def scale_data(self, series):
         """标准化数据"""
         try:
@@ -115,29 +273,101 @@ class ModelEvaluator:
     """模型评估工具类"""
     
     @staticmethod
-    def calculate_metrics(actual, predicted):
-        """计算预测评估指标"""
+    def batch_metrics(actual, predicted, lower=None, upper=None, insample=None, m=1):
+        """一次NumPy计算批量评估指标
+
+        最后一维是预测步长，其余维度按NumPy广播规则对齐，例如 actual 为 (序列, 1, 步长)、
+        predicted 为 (序列, 模型, 步长) 时一次算出全部 序列×模型 的指标。
+        lower/upper 为预测区间（与predicted同形状），insample 为训练数据 (..., 训练长度)，
+        前面的维度与actual相同，用于计算MASE（m为季节周期）。
+
+        NaN/inf 统一按缺失处理：只在实际值和预测值都有效的点上计算；MAPE跳过实际值为0的点，
+        sMAPE跳过实际值和预测值都为0的点；没有任何有效点的位置结果为NaN。
+
+        返回 {指标名: 形状为广播后去掉最后一维的数组}。
+        """
+        actual, predicted = np.broadcast_arrays(np.asarray(actual, dtype=float),
+                                                np.asarray(predicted, dtype=float))
+        valid = np.isfinite(actual) & np.isfinite(predicted)
+        count = valid.sum(axis=-1)
+        error = np.where(valid, predicted - actual, 0.0)
+        abs_error = np.abs(error)
+        abs_actual = np.abs(np.where(valid, actual, 0.0))
+        abs_predicted = np.abs(np.where(valid, predicted, 0.0))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {'count': count}
+            metrics['mae'] = abs_error.sum(axis=-1) / count
+            metrics['mse'] = (error ** 2).sum(axis=-1) / count
+            metrics['rmse'] = np.sqrt(metrics['mse'])
+
+            pct_valid = valid & (abs_actual > 0)
+            metrics['mape'] = 100.0 * np.where(pct_valid, abs_error / abs_actual, 0.0).sum(axis=-1) \
+                / pct_valid.sum(axis=-1)
+
+            denominator = abs_actual + abs_predicted
+            sym_valid = valid & (denominator > 0)
+            metrics['smape'] = 200.0 * np.where(sym_valid, abs_error / denominator, 0.0).sum(axis=-1) \
+                / sym_valid.sum(axis=-1)
+
+            # 方向准确率：相邻两步的变化方向是否一致
+            actual_diff = np.diff(actual, axis=-1)
+            predicted_diff = np.diff(predicted, axis=-1)
+            diff_valid = np.isfinite(actual_diff) & np.isfinite(predicted_diff)
+            same_direction = diff_valid & (np.sign(actual_diff) == np.sign(predicted_diff))
+            metrics['direction_accuracy'] = same_direction.sum(axis=-1) / diff_valid.sum(axis=-1)
+
+            if insample is not None:
+                # MASE：用训练数据上m步季节性朴素预测的MAE作为尺度
+                insample = np.asarray(insample, dtype=float)
+                naive_error = np.abs(insample[..., m:] - insample[..., :-m])
+                naive_valid = np.isfinite(naive_error)
+                scale = np.where(naive_valid, naive_error, 0.0).sum(axis=-1) / naive_valid.sum(axis=-1)
+                scale = np.where(scale > 0, scale, np.nan)
+                metrics['mase'] = metrics['mae'] / scale
+
+            if lower is not None and upper is not None:
+                lower, upper = np.broadcast_arrays(np.asarray(lower, dtype=float),
+                                                   np.asarray(upper, dtype=float), actual)[:2]
+                cover_valid = valid & np.isfinite(lower) & np.isfinite(upper)
+                inside = cover_valid & (actual >= lower) & (actual <= upper)
+                metrics['coverage'] = inside.sum(axis=-1) / cover_valid.sum(axis=-1)
+
+        return metrics
+
+    @staticmethod
+    def metrics_to_dict(metrics, index=()):
+        """取出批量指标中的一组，转换为JSON可用的dict（NaN转为None）"""
+        result = {}
+        for name, values in metrics.items():
+            if name == 'count':
+                continue
+            value = float(np.asarray(values)[index])
+            result[name] = value if np.isfinite(value) else None
+        return result
+
+    @staticmethod
+    def calculate_metrics(actual, predicted, interval=None, insample=None, m=1):
+        """计算预测评估指标
+
+        interval 为 {'lower': TimeSeries, 'upper': TimeSeries} 时额外计算区间覆盖率，
+        insample 为训练序列时额外计算MASE。
+        """
         try:
-            metrics = {}
-            
             # 确保两个序列长度一致
             min_len = min(len(actual), len(predicted))
-            actual_trimmed = actual[:min_len]
-            predicted_trimmed = predicted[:min_len]
-            
-            # 计算各种评估指标
-            metrics['mape'] = float(mape(actual_trimmed, predicted_trimmed))
-            metrics['rmse'] = float(rmse(actual_trimmed, predicted_trimmed))
-            metrics['mae'] = float(mae(actual_trimmed, predicted_trimmed))
-            metrics['mse'] = float(mse(actual_trimmed, predicted_trimmed))
-            
-            # 计算方向准确率（预测趋势是否正确）
-            actual_diff = np.diff(actual_trimmed.values().flatten())
-            predicted_diff = np.diff(predicted_trimmed.values().flatten())
-            direction_accuracy = np.mean(np.sign(actual_diff) == np.sign(predicted_diff))
-            metrics['direction_accuracy'] = float(direction_accuracy)
-            
-            return metrics
+            actual_values = actual[:min_len].values().flatten()
+            predicted_values = predicted[:min_len].values().flatten()
+
+            lower = upper = None
+            if interval is not None:
+                lower = interval['lower'][:min_len].values().flatten()
+                upper = interval['upper'][:min_len].values().flatten()
+            insample_values = insample.values().flatten() if insample is not None else None
+
+            metrics = ModelEvaluator.batch_metrics(actual_values, predicted_values, lower=lower, upper=upper,
+                                                   insample=insample_values, m=m)
+            return ModelEvaluator.metrics_to_dict(metrics)
             
         except Exception as e:
             logger.error(f"计算评估指标时出错: {str(e)}")
@@ -156,8 +386,8 @@ class ModelEvaluator:
                         **result['metrics']
                     })
             
-            # 按MAPE排序
-            comparison.sort(key=lambda x: x['mape'])
+            # 按MAPE排序，无法计算MAPE的排在最后
+            comparison.sort(key=lambda x: (x['mape'] is None, x['mape'] or 0))
             
             return comparison
             
@@ -209,6 +439,113 @@ class DataGenerator:
             logger.error(f"生成合成数据时出错: {str(e)}")
             raise
     
+    @staticmethod
+    def iter_fleet_chunks(n_devices=1000, points_per_device=2016, start_date='2025-01-01', freq='5T',
+                          chunk_rows=1_000_000, seed=42, ci_types=('oracle', 'mysql', 'linux_fs', 'windows_disk'),
+                          code='free_space_ratio', trend_range=(-0.002, 0.0005), daily_amplitude=(0.5, 5.0),
+                          weekly_amplitude=(0.0, 3.0), noise_level=0.5, gap_ratio=0.005, failure_ratio=0.01):
+        """按块生成 tb_metric_raw 格式的设备群合成数据
+
+        每个设备的基准值、趋势斜率和季节振幅在开始时一次性生成，
+        之后按“设备块 × 时间块”逐块用NumPy向量化生成数据，每块不超过 chunk_rows 行，
+        内存占用与总行数无关。gap_ratio 比例的记录被删除以模拟采集缺失，
+        failure_ratio 比例的记录写为 -2 表示连接失败。
+        相同的参数和种子生成完全相同的数据。
+        """
+        rng = np.random.default_rng(seed)
+        ci_types = np.asarray(ci_types, dtype=object)
+        step = pd.Timedelta(pd.tseries.frequencies.to_offset(freq))
+        start = pd.Timestamp(start_date)
+        steps_per_day = max(int(pd.Timedelta(days=1) / step), 1)
+
+        # 设备级参数（每个设备一组）
+        base = rng.uniform(20, 95, n_devices)
+        slope = rng.uniform(trend_range[0], trend_range[1], n_devices)
+        daily = rng.uniform(daily_amplitude[0], daily_amplitude[1], n_devices)
+        weekly = rng.uniform(weekly_amplitude[0], weekly_amplitude[1], n_devices)
+        phase = rng.uniform(0, 2 * np.pi, n_devices)
+        # 十六进制设备ID，首位固定为字母，避免被读取为整数
+        device_ids = np.array([f'{0xf000000000000000 + i:016x}' for i in range(n_devices)], dtype=object)
+        device_types = ci_types[rng.integers(0, len(ci_types), n_devices)]
+
+        # 每块的设备数和时间点数
+        time_block = min(points_per_device, max(chunk_rows, 1))
+        device_block = max(chunk_rows // time_block, 1)
+
+        for t0 in range(0, points_per_device, time_block):
+            t1 = min(t0 + time_block, points_per_device)
+            steps = np.arange(t0, t1)
+            times = pd.date_range(start + t0 * step, periods=len(steps), freq=freq)
+            time_strings = times.strftime('%Y-%m-%d %H:%M:%S').values.astype(object)
+            daily_wave = 2 * np.pi * steps / steps_per_day
+            weekly_wave = 2 * np.pi * steps / (steps_per_day * 7)
+
+            for d0 in range(0, n_devices, device_block):
+                d1 = min(d0 + device_block, n_devices)
+                block_rng = np.random.default_rng([seed, t0, d0])
+                n = d1 - d0
+
+                values = (
+                    base[d0:d1, None]
+                    + slope[d0:d1, None] * steps
+                    + daily[d0:d1, None] * np.sin(daily_wave + phase[d0:d1, None])
+                    + weekly[d0:d1, None] * np.sin(weekly_wave)
+                    + block_rng.normal(0, noise_level, (n, len(steps)))
+                )
+                values = np.clip(values, 0.01, 100.0).round(3)
+                values[block_rng.random((n, len(steps))) < failure_ratio] = -2
+
+                keep = block_rng.random((n, len(steps))) >= gap_ratio
+                device_index = np.broadcast_to(np.arange(d0, d1)[:, None], keep.shape)[keep]
+                time_index = np.broadcast_to(np.arange(len(steps)), keep.shape)[keep]
+
+                yield pd.DataFrame({
+                    'ci_id': device_ids[device_index],
+                    'ci_type': device_types[device_index],
+                    'code': code,
+                    'time': time_strings[time_index],
+                    'value': values[keep]
+                })
+
+    @staticmethod
+    def generate_fleet_data(path, file_format=None, **kwargs):
+        """将设备群合成数据分块写入CSV或Parquet文件，返回生成的行数
+
+        file_format 为空时根据文件扩展名判断；其余参数见 iter_fleet_chunks。
+        Parquet 格式需要安装 pyarrow。
+        """
+        try:
+            file_format = file_format or ('parquet' if str(path).endswith('.parquet') else 'csv')
+            total_rows = 0
+            writer = None
+
+            if file_format == 'parquet':
+                try:
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+                except ImportError:
+                    raise ImportError("写入Parquet需要安装pyarrow: pip install pyarrow")
+
+            for i, chunk in enumerate(DataGenerator.iter_fleet_chunks(**kwargs)):
+                if file_format == 'parquet':
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(path, table.schema)
+                    writer.write_table(table)
+                else:
+                    chunk.to_csv(path, mode='w' if i == 0 else 'a', header=(i == 0), index=False)
+                total_rows += len(chunk)
+
+            if writer is not None:
+                writer.close()
+
+            logger.info(f"已生成 {total_rows} 行设备群合成数据: {path}")
+            return total_rows
+
+        except Exception as e:
+            logger.error(f"生成设备群合成数据时出错: {str(e)}")
+            raise
+
     @staticmethod
     def add_external_factors(df, factor_type='marketing'):
         """为数据添加外部因素"""
@@ -245,18 +582,18 @@ def format_response_data(series, forecast, validation=None, metrics=None, model_
         response = {
             'historical': {
                 'dates': series.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
-                'values': series.values().flatten().tolist()
+                'values': to_json_list(series.values().flatten())
             },
             'forecast': {
                 'dates': forecast.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
-                'values': forecast.values().flatten().tolist()
+                'values': to_json_list(forecast.values().flatten())
             }
         }
         
         if validation is not None:
             response['validation'] = {
                 'dates': validation.time_index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
-                'values': validation.values().flatten().tolist()
+                'values': to_json_list(validation.values().flatten())
             }
         
         if metrics is not None:
@@ -0,0 +1,439 @@
+"""多模型对比的离线批量评估
+
+在 设备 × 日期 上并行运行 ck_time_series_forecast 中的多模型对比，不打开任何窗口：
+- 每个 (设备, 日期, 模型) 作为一个任务在进程池中训练和预测，每天的数据按 train_ratio 拆分训练集和验证集；
+- 每个完成的任务（包括失败和数据不足）写入 Parquet 检查点文件，中断后重新执行同一命令时跳过已完成的任务；
+- 全部完成后按模型汇总排行榜（leaderboard.csv）和每个序列的最佳模型（series_best.csv），
+  集成结果（average、weighted_average、median）由检查点中保存的预测值计算；
+- --plots 时把排行榜和每个序列的预测对比图保存为PNG。
+
+检查点每次写入临时文件后原子替换，任何时刻中断都不会损坏已有结果；两次写入至少间隔
+--checkpoint-interval 秒（0 表示每个任务完成后都写入），Ctrl-C 或 SIGTERM 时会先写入已完成的结果。
+
+用法示例:
+    CLICKHOUSE_HOST=10.0.0.1 CLICKHOUSE_PASSWORD=*** python ck_batch_evaluate.py \\
+        --devices 000000000020571d,000000000020571e --start-date 2025-09-01 --end-date 2025-09-13 \\
+        --output-dir eval_results --workers 8 --plots
+    python ck_batch_evaluate.py --csv backend/data/tb_metric_raw.csv --dates 2025-09-13 --models ARIMA,XGBoost
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # 无界面后端，图片只保存到文件
+import matplotlib.pyplot as plt
+
+from darts import TimeSeries
+from darts.metrics import mape, rmse, mae
+from ck_time_series_forecast import (MODEL_FACTORIES, build_model, connect_clickhouse, fetch_metric_data,
+                                     prepare_time_series)
+
+warnings.filterwarnings('ignore')
+
+ENSEMBLE_METHODS = ('average', 'weighted_average', 'median')
+# 数据的采样频率，与 prepare_time_series 一致
+FREQ = '5min'
+# 序列的唯一键
+KEY_COLUMNS = ['ci_id', 'date', 'model']
+
+
+def parse_list(text):
+    """解析逗号分隔的列表"""
+    return [item.strip() for item in (text or '').split(',') if item.strip()]
+
+
+def parse_dates(args):
+    """--dates 或 --start-date/--end-date（含两端）给出的日期列表"""
+    dates = parse_list(args.dates)
+    if args.start_date:
+        end = args.end_date or args.start_date
+        dates += [day.strftime('%Y-%m-%d') for day in pd.date_range(args.start_date, end, freq='D')]
+    return sorted({pd.Timestamp(date).strftime('%Y-%m-%d') for date in dates})
+
+
+def parse_devices(args):
+    devices = parse_list(args.devices)
+    if args.devices_file:
+        with open(args.devices_file, encoding='utf-8') as f:
+            devices += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(devices))
+
+
+class ResultCheckpoint:
+    """Parquet 检查点，每行是一个 (设备, 日期, 模型) 的评估结果"""
+
+    def __init__(self, path, interval=0.0):
+        self.path = path
+        self.interval = interval
+        self.rows = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._last_write = 0.0
+        if os.path.exists(path):
+            for row in pd.read_parquet(path).to_dict('records'):
+                for column in ('actual', 'forecast'):
+                    if row.get(column) is not None:
+                        row[column] = list(row[column])
+                self.rows[tuple(row[key] for key in KEY_COLUMNS)] = row
+            print(f"读取检查点: {len(self.rows)} 条已完成的结果 ({path})")
+
+    def completed(self, retry_failed=False):
+        """已完成的任务键，retry_failed 时失败的任务不算完成"""
+        return {key for key, row in self.rows.items() if row['status'] == 'ok' or not retry_failed}
+
+    def add(self, row):
+        with self._lock:
+            self.rows[tuple(row[key] for key in KEY_COLUMNS)] = row
+            self._dirty = True
+            if time.time() - self._last_write >= self.interval:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._write()
+
+    def _write(self):
+        """写入临时文件后原子替换，中断时旧文件保持完整"""
+        tmp = f'{self.path}.tmp'
+        pd.DataFrame(list(self.rows.values())).to_parquet(tmp, index=False)
+        os.replace(tmp, self.path)
+        self._dirty = False
+        self._last_write = time.time()
+
+    def frame(self):
+        with self._lock:
+            return pd.DataFrame(list(self.rows.values()))
+
+
+def _result_row(ci_id, date, model_name, status, error=None, **values):
+    row = {
+        'ci_id': ci_id, 'date': date, 'model': model_name, 'status': status, 'error': error,
+        'mape': np.nan, 'rmse': np.nan, 'mae': np.nan, 'fit_seconds': np.nan,
+        'train_points': 0, 'val_points': 0, 'val_start': None, 'actual': None, 'forecast': None,
+        'finished_at': time.strftime('%Y-%m-%d %H:%M:%S')
+    }
+    row.update(values)
+    return row
+
+
+def _init_worker():
+    """每个worker只用一个计算线程，避免与进程池并行叠加后超额占用CPU"""
+    warnings.filterwarnings('ignore')
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+def evaluate_model(ci_id, date, model_name, train, val):
+    """训练一个模型并在验证集上评估，返回检查点的一行（在worker进程中执行）"""
+    start = time.perf_counter()
+    base = {'train_points': len(train), 'val_points': len(val), 'val_start': str(val.start_time()),
+            'actual': val.values().flatten().tolist()}
+    try:
+        model = build_model(model_name)
+        model.fit(train)
+        forecast = model.predict(len(val))
+        return _result_row(ci_id, date, model_name, 'ok', **base,
+                           mape=float(mape(val, forecast)), rmse=float(rmse(val, forecast)),
+                           mae=float(mae(val, forecast)), fit_seconds=time.perf_counter() - start,
+                           forecast=forecast.values().flatten().tolist())
+    except Exception as e:
+        return _result_row(ci_id, date, model_name, 'error', f'{type(e).__name__}: {e}'[:500], **base,
+                           fit_seconds=time.perf_counter() - start)
+
+
+def load_frames(args, devices, date):
+    """读取所有设备在评估日期（含之前 history_days-1 天）的数据，返回 {ci_id: DataFrame}"""
+    end = pd.Timestamp(date) + pd.Timedelta(days=1)
+    start = end - pd.Timedelta(days=args.history_days)
+    if args.csv:
+        df = args.csv_data
+        df = df[(df['time'] >= start) & (df['time'] < end)]
+        if devices:
+            df = df[df['ci_id'].isin(devices)]
+    else:
+        df = fetch_metric_data(args.client, args.table, devices, start, end, code=args.code)
+    return {ci_id: group[['time', 'value']] for ci_id, group in df.groupby('ci_id', sort=False)}
+
+
+def build_series(df, min_points):
+    """去掉无效值（负数）后按5分钟重采样并插值，点数不足时返回None"""
+    values = df[df['value'] >= 0].set_index('time')['value'].sort_index()
+    values = values.resample(FREQ).mean().interpolate(method='time').dropna()
+    if len(values) < min_points:
+        return None
+    return prepare_time_series(values.rename('value').rename_axis('time').reset_index())
+
+
+def _metrics(actual, forecast):
+    actual = TimeSeries.from_values(np.asarray(actual, dtype=np.float64))
+    forecast = TimeSeries.from_values(np.asarray(forecast, dtype=np.float64))
+    return float(mape(actual, forecast)), float(rmse(actual, forecast)), float(mae(actual, forecast))
+
+
+def ensemble_rows(results):
+    """由每个序列已成功模型的预测值计算集成结果（与 ensemble_forecast 相同的三种方法）"""
+    rows = []
+    for (ci_id, date), group in results[results['status'] == 'ok'].groupby(['ci_id', 'date']):
+        group = group[group['forecast'].map(len) == group['val_points']]
+        if len(group) < 2:
+            continue
+        actual = group['actual'].iloc[0]
+        forecasts = np.array(group['forecast'].tolist(), dtype=np.float64)
+        weights = 1.0 / (group['mape'].to_numpy() + 1e-6)
+        for method in ENSEMBLE_METHODS:
+            if method == 'average':
+                values = forecasts.mean(axis=0)
+            elif method == 'weighted_average':
+                values = np.average(forecasts, axis=0, weights=weights / weights.sum())
+            else:
+                values = np.median(forecasts, axis=0)
+            try:
+                model_mape, model_rmse, model_mae = _metrics(actual, values)
+            except Exception:
+                continue
+            rows.append({'ci_id': ci_id, 'date': date, 'model': f'集成-{method}', 'status': 'ok',
+                         'mape': model_mape, 'rmse': model_rmse, 'mae': model_mae,
+                         'val_start': group['val_start'].iloc[0], 'actual': actual, 'forecast': values.tolist()})
+    return pd.DataFrame(rows)
+
+
+def build_leaderboard(results):
+    """按模型汇总：成功/失败次数、MAPE均值和中位数、RMSE、MAE、最佳次数和平均训练耗时"""
+    ok = results[results['status'] == 'ok'].dropna(subset=['mape'])
+    best = ok.loc[ok.groupby(['ci_id', 'date'])['mape'].idxmin()] if len(ok) else ok
+    leaderboard = results.groupby('model').agg(
+        runs=('status', lambda status: int((status == 'ok').sum())),
+        failures=('status', lambda status: int((status != 'ok').sum()))
+    )
+    metrics = ok.groupby('model').agg(
+        mape_mean=('mape', 'mean'), mape_median=('mape', 'median'),
+        rmse_mean=('rmse', 'mean'), mae_mean=('mae', 'mean'),
+        fit_seconds_mean=('fit_seconds', 'mean')
+    )
+    leaderboard = leaderboard.join(metrics)
+    leaderboard['wins'] = best['model'].value_counts().reindex(leaderboard.index).fillna(0).astype(int)
+    leaderboard = leaderboard.sort_values(['mape_median', 'mape_mean'], na_position='last')
+    return leaderboard.reset_index(), best[['ci_id', 'date', 'model', 'mape', 'rmse', 'mae']]
+
+
+def print_leaderboard(leaderboard, series_count):
+    print("\n" + "=" * 50)
+    print(f"模型排行榜 ({series_count} 个序列，按MAPE中位数从小到大)")
+    print("=" * 50)
+    print(f"{'排名':<4} {'模型名称':<24} {'成功':<6} {'失败':<6} {'MAPE中位数':<12} {'MAPE均值':<10} {'最佳次数':<8}")
+    print("-" * 78)
+    for i, row in enumerate(leaderboard.itertuples(), 1):
+        print(f"{i:<4} {row.model:<24} {row.runs:<6} {row.failures:<6} "
+              f"{row.mape_median:<12.2f} {row.mape_mean:<10.2f} {row.wins:<8}")
+
+
+def plot_leaderboard(leaderboard, output_path):
+    data = leaderboard.dropna(subset=['mape_median'])
+    plt.figure(figsize=(12, 6))
+    bars = plt.bar(range(len(data)), data['mape_median'], alpha=0.7)
+    plt.xlabel('模型')
+    plt.ylabel('MAPE中位数 (%)')
+    plt.title('模型性能对比 (MAPE)', fontsize=14)
+    plt.xticks(range(len(data)), data['model'], rotation=45, ha='right')
+    plt.grid(True, alpha=0.3)
+    for bar in bars:
+        height = bar.get_height()
+        plt.text(bar.get_x() + bar.get_width() / 2., height, f'{height:.1f}%', ha='center', va='bottom')
+    plt.tight_layout()
+    plt.savefig(output_path, dpi=100)
+    plt.close()
+
+
+def plot_series(group, output_path):
+    """一个序列在验证集上的实际值和各模型预测值"""
+    plt.figure(figsize=(14, 6))
+    index = pd.date_range(group['val_start'].iloc[0], periods=len(group['actual'].iloc[0]), freq=FREQ)
+    plt.plot(index, group['actual'].iloc[0], label='验证数据', color='green', linewidth=2)
+    for row in group.sort_values('mape').itertuples():
+        is_ensemble = row.model.startswith('集成-')
+        plt.plot(index[:len(row.forecast)], row.forecast, label=f'{row.model} (MAPE: {row.mape:.1f}%)',
+                 linewidth=2 if is_ensemble else 1, linestyle='--' if is_ensemble else '-', alpha=0.8)
+    ci_id, date = group['ci_id'].iloc[0], group['date'].iloc[0]
+    plt.title(f'{ci_id} {date} 预测结果对比', fontsize=14)
+    plt.xlabel('时间')
+    plt.ylabel('指标值')
+    plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left')
+    plt.grid(True, alpha=0.3)
+    plt.savefig(output_path, dpi=100, bbox_inches='tight')
+    plt.close()
+
+
+def write_reports(results, output_dir, plots=False):
+    """写入排行榜、每个序列的最佳模型和可选的图片"""
+    ensembles = ensemble_rows(results)
+    if len(ensembles):
+        results = pd.concat([results, ensembles], ignore_index=True)
+    leaderboard, best = build_leaderboard(results)
+    leaderboard.to_csv(os.path.join(output_dir, 'leaderboard.csv'), index=False, float_format='%.4f')
+    best.to_csv(os.path.join(output_dir, 'series_best.csv'), index=False, float_format='%.4f')
+    print_leaderboard(leaderboard, results[['ci_id', 'date']].drop_duplicates().shape[0])
+
+    if plots:
+        plot_leaderboard(leaderboard, os.path.join(output_dir, 'leaderboard.png'))
+        plot_dir = os.path.join(output_dir, 'plots')
+        os.makedirs(plot_dir, exist_ok=True)
+        ok = results[(results['status'] == 'ok') & results['forecast'].notna()]
+        for (ci_id, date), group in ok.groupby(['ci_id', 'date']):
+            plot_series(group, os.path.join(plot_dir, f'{ci_id}_{date}.png'))
+    print(f"\n结果已保存到: {output_dir}")
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run(args):
+    models = parse_list(args.models) or list(MODEL_FACTORIES)
+    unknown = [name for name in models if name not in MODEL_FACTORIES]
+    if unknown:
+        raise SystemExit(f"不支持的模型: {', '.join(unknown)}，可选: {', '.join(MODEL_FACTORIES)}")
+    dates = parse_dates(args)
+    devices = parse_devices(args)
+    if not dates:
+        raise SystemExit("请通过 --dates 或 --start-date/--end-date 指定评估日期")
+
+    if args.csv:
+        columns = ['ci_id', 'code', 'time', 'value']
+        if args.csv.endswith('.parquet'):
+            df = pd.read_parquet(args.csv, columns=columns)
+        else:
+            df = pd.read_csv(args.csv, usecols=columns, dtype={'ci_id': str})
+        df = df[df['code'] == args.code].drop(columns='code')
+        df['ci_id'] = df['ci_id'].astype(str)
+        df['time'] = pd.to_datetime(df['time'])
+        args.csv_data = df
+        devices = devices or sorted(df['ci_id'].unique())
+    else:
+        if not devices:
+            raise SystemExit("从ClickHouse读取数据时请通过 --devices 或 --devices-file 指定设备")
+        args.client = connect_clickhouse(args.host, args.port, args.user, os.getenv('CLICKHOUSE_PASSWORD', ''),
+                                         args.database)
+        if not args.client:
+            raise SystemExit(1)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    checkpoint = ResultCheckpoint(args.checkpoint or os.path.join(args.output_dir, 'results.parquet'),
+                                  args.checkpoint_interval)
+    completed = checkpoint.completed(args.retry_failed)
+    scope = {(ci_id, date, model) for ci_id in devices for date in dates for model in models}
+    pending = scope - completed
+    print(f"评估 {len(devices)} 个设备 × {len(dates)} 天 × {len(models)} 个模型: "
+          f"共 {len(scope)} 个任务，已完成 {len(scope) - len(pending)} 个")
+
+    progress = {'done': 0, 'total': len(pending)}
+
+    def record(row):
+        checkpoint.add(row)
+        progress['done'] += 1
+        detail = f"MAPE {row['mape']:.2f}% ({row['fit_seconds']:.1f}s)" if row['status'] == 'ok' else row['status']
+        print(f"[{progress['done']}/{progress['total']}] {row['ci_id']} {row['date']} {row['model']}: {detail}")
+
+    # 提交到进程池的任务 -> (设备, 日期, 模型)，完成的结果只在主线程中记录
+    futures = {}
+
+    def collect(block=False):
+        """记录已完成的任务，block 时等待全部任务完成；取消的任务不记录，下次执行时重新运行"""
+        done = as_completed(list(futures)) if block else [future for future in futures if future.done()]
+        for future in done:
+            ci_id, date, model = futures.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                row = future.result()
+            except Exception as e:
+                # evaluate_model 之外的失败（进程池崩溃、参数无法序列化等）同样作为失败写入检查点
+                row = _result_row(ci_id, date, model, 'error', f'{type(e).__name__}: {e}'[:500])
+            record(row)
+
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    executor = ProcessPoolExecutor(args.workers, initializer=_init_worker) if args.workers > 1 else None
+    try:
+        for date in dates:
+            todo = [ci_id for ci_id in devices if any((ci_id, date, model) in pending for model in models)]
+            if not todo:
+                continue
+            frames = load_frames(args, todo, date)
+            for ci_id in todo:
+                models_todo = [model for model in models if (ci_id, date, model) in pending]
+                frame = frames.get(ci_id)
+                series = build_series(frame, args.min_points) if frame is not None else None
+                if series is None:
+                    for model in models_todo:
+                        record(_result_row(ci_id, date, model, 'no_data',
+                                           f"数据点不足 {args.min_points} 个（共 {0 if frame is None else len(frame)} 条记录）"))
+                    continue
+                train_size = int(len(series) * args.train_ratio)
+                train, val = series[:train_size], series[train_size:]
+                for model in models_todo:
+                    if executor is None:
+                        record(evaluate_model(ci_id, date, model, train, val))
+                    else:
+                        futures[executor.submit(evaluate_model, ci_id, date, model, train, val)] = (ci_id, date, model)
+            # 读取下一天的数据前先记录已完成的任务
+            collect()
+        collect(block=True)
+    except KeyboardInterrupt:
+        print("\n已中断，等待正在执行的任务结束并保存结果，重新执行同一命令即可继续")
+        # 取消尚未开始的任务，正在执行的任务完成后照常写入检查点
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+            collect()
+        raise SystemExit(130)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        checkpoint.flush()
+
+    results = checkpoint.frame()
+    in_scope = results[[key in scope for key in zip(results['ci_id'], results['date'], results['model'])]]
+    write_reports(in_scope.reset_index(drop=True), args.output_dir, args.plots)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='多模型对比的离线批量评估（可中断续跑）')
+    parser.add_argument('--devices', default='', help='设备 ci_id，逗号分隔')
+    parser.add_argument('--devices-file', default=None, help='设备列表文件，每行一个 ci_id')
+    parser.add_argument('--dates', default='', help='评估日期，逗号分隔，如 2025-09-12,2025-09-13')
+    parser.add_argument('--start-date', default=None, help='评估起始日期（含）')
+    parser.add_argument('--end-date', default=None, help='评估结束日期（含），默认与起始日期相同')
+    parser.add_argument('--models', default='', help=f"参与对比的模型，逗号分隔，默认全部: {','.join(MODEL_FACTORIES)}")
+    parser.add_argument('--code', default='tps', help='指标代码')
+    parser.add_argument('--history-days', type=int, default=1, help='每个评估日期使用的天数（含当天）')
+    parser.add_argument('--train-ratio', type=float, default=0.8, help='训练集比例，其余为验证集')
+    parser.add_argument('--min-points', type=int, default=100, help='序列的最少数据点数')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='并行进程数，1 表示在当前进程中执行')
+    parser.add_argument('--output-dir', default='eval_results', help='排行榜和图片的输出目录')
+    parser.add_argument('--checkpoint', default=None, help='检查点Parquet文件，默认 <output-dir>/results.parquet')
+    parser.add_argument('--checkpoint-interval', type=float, default=5.0,
+                        help='两次写入检查点的最小间隔（秒），0 表示每个任务完成后写入')
+    parser.add_argument('--retry-failed', action='store_true', help='重新执行检查点中失败或数据不足的任务')
+    parser.add_argument('--plots', action='store_true', help='保存排行榜和每个序列的预测对比图')
+    parser.add_argument('--csv', default=None,
+                        help='从本地 tb_metric_raw 格式的CSV/Parquet文件读取数据，不连接ClickHouse')
+    parser.add_argument('--table', default='tb_metric_raw', help='ClickHouse表名')
+    parser.add_argument('--host', default=os.getenv('CLICKHOUSE_HOST', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('CLICKHOUSE_PORT', 9000)))
+    parser.add_argument('--user', default=os.getenv('CLICKHOUSE_USER', 'default'))
+    parser.add_argument('--database', default=os.getenv('CLICKHOUSE_DATABASE', 'default'))
+    run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
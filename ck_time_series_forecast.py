@@ -76,6 +76,27 @@ def fetch_data_from_clickhouse(client, target_date, table_name):
         print(f"读取数据失败: {e}")
         return None
 
+# 批量读取多个设备的数据
+def fetch_metric_data(client, table_name, ci_ids, start_time, end_time, code='tps'):
+    """
+    从ClickHouse读取多个设备在 [start_time, end_time) 内的指标数据
+    返回包含 ci_id、time、value 字段的DataFrame
+    """
+    query = f"""
+    select ci_id, time, value from {table_name}
+    where code = %(code)s and ci_id in %(ci_ids)s and time >= %(start)s and time < %(end)s
+    order by ci_id, time asc
+    """
+    result = client.execute(query, {
+        'code': code,
+        'ci_ids': tuple(ci_ids),
+        'start': pd.Timestamp(start_time).to_pydatetime(),
+        'end': pd.Timestamp(end_time).to_pydatetime()
+    })
+    df = pd.DataFrame(result, columns=['ci_id', 'time', 'value'])
+    df['time'] = pd.to_datetime(df['time'])
+    return df
+
 # 准备时间序列数据
 def prepare_time_series(df):
     """将DataFrame转换为Darts的TimeSeries对象"""
@@ -103,55 +124,63 @@ def split_train_validation(series, train_ratio=0.8):
     
     return train, val
 
+# 参与对比的模型，按名称创建新的未训练实例（缺少可选依赖的模型在创建时报错，不影响其他模型）
+MODEL_FACTORIES = {
+    # 统计学习模型
+    "Prophet": lambda: Prophet(daily_seasonality=True, weekly_seasonality=False, yearly_seasonality=False),
+    "ARIMA": lambda: ARIMA(p=2, d=1, q=2),
+    "Exponential Smoothing": lambda: ExponentialSmoothing(seasonal_periods=24),
+
+    # 机器学习模型
+    "XGBoost": lambda: XGBModel(
+        lags=24, # 设置滞后项，可以是一个整数或列表
+        output_chunk_length=1,
+        random_state=42
+    ),
+    "LightGBM": lambda: LightGBMModel(
+        lags=24,
+        output_chunk_length=1,
+        random_state=42,
+        verbose=-1
+    ),
+    "CatBoost": lambda: CatBoostModel(
+        lags=4,
+        output_chunk_length=1,
+        random_state=42,
+        verbose=False
+    ),
+    "Random Forest": lambda: RandomForest(
+        lags=24,
+        output_chunk_length=1,
+        random_state=42,
+        n_estimators=100
+    ),
+    "Linear Regression": lambda: LinearRegressionModel(
+        lags=24,
+        output_chunk_length=1
+    )
+}
+
+# 按名称创建模型
+def build_model(name):
+    """按名称创建模型"""
+    if name not in MODEL_FACTORIES:
+        raise ValueError(f"不支持的模型: {name}，可选: {', '.join(MODEL_FACTORIES)}")
+    return MODEL_FACTORIES[name]()
+
 # 训练模型并进行预测
 def train_and_forecast(train, val):
     """训练多个模型并在验证集上进行预测"""
-    # 初始化模型
-    models = {
-        # 统计学习模型
-        "Prophet": Prophet(daily_seasonality=True, weekly_seasonality=False, yearly_seasonality=False),
-        "ARIMA": ARIMA(p=2, d=1, q=2),
-        "Exponential Smoothing": ExponentialSmoothing(seasonal_periods=24),
-        
-        # 机器学习模型
-        "XGBoost": XGBModel(
-            lags=24, # 设置滞后项，可以是一个整数或列表
-            output_chunk_length=1,
-            random_state=42
-        ),
-        "LightGBM": LightGBMModel(
-            lags=24,
-            output_chunk_length=1,
-            random_state=42,
-            verbose=-1
-        ),
-        "CatBoost": CatBoostModel(
-            lags=4,
-            output_chunk_length=1,
-            random_state=42,
-            verbose=False
-        ),
-        "Random Forest": RandomForest(
-            lags=24,
-            output_chunk_length=1,
-            random_state=42,
-            n_estimators=100
-        ),
-        "Linear Regression": LinearRegressionModel(
-            lags=24,
-            output_chunk_length=1
-        )
-    }
-    
     results = {}
     forecasts = {}
     
     # 训练每个模型并进行预测
-    for name, model in models.items():
+    for name in MODEL_FACTORIES:
         print(f"\n训练 {name} 模型...")
         
         try:
             # 训练模型
+            model = build_model(name)
             model.fit(train)
             
             # 进行预测
@@ -261,8 +290,8 @@ def ensemble_forecast(forecasts, val, method='average'):
     return ensemble_forecast, ensemble_mape, ensemble_rmse, ensemble_mae
 
 # 可视化结果
-def plot_results(train, val, results, ensemble_results=None):
-    """可视化训练数据、验证数据和预测结果"""
+def plot_results(train, val, results, ensemble_results=None, output_path=None):
+    """可视化训练数据、验证数据和预测结果，指定 output_path 时保存为图片而不打开窗口"""
     plt.figure(figsize=(18, 12))
     
     # 创建子图
@@ -326,7 +355,11 @@ def plot_results(train, val, results, ensemble_results=None):
     #             f'{height:.1f}%', ha='center', va='bottom')
     
     # plt.tight_layout()
-    plt.show()
+    if output_path:
+        plt.savefig(output_path, dpi=100, bbox_inches='tight')
+        plt.close()
+    else:
+        plt.show()
 
 # 模型排名和分析
 def analyze_model_performance(results, ensemble_results=None):